@@ -0,0 +1,92 @@
+"""
+Compares the fixed 1 inference/sec rate with the adaptive rate controller on a simulated print, in virtual time.
+
+The simulated camera shows a static scene (heating), then a slowly moving toolhead (printing) and finally a growing
+spaghetti blob (failure). A stand-in detector scores 'spaghetti' by the blob area, so the benchmark measures the
+controller itself: number of inferences and the time from the failure becoming detectable to the first inference
+that reports it. The controllers are compared on recorded clips, with the real model, by benchmarks.replay with
+--rate-controller.
+
+    python3 -m benchmarks.adaptive_rate
+"""
+import argparse
+
+import cv2
+import numpy as np
+
+from src.rate_controller import AdaptiveRateController, FixedRateController
+
+WIDTH, HEIGHT = 1280, 720
+THRESHOLDS = {'spaghetti': 0.6}
+
+
+class SimulatedPrint:
+    def __init__(self, heating, printing, failure_growth, seed=0):
+        self.printing_start = heating
+        self.failure_start = heating + printing
+        self.failure_growth = failure_growth
+        self.duration = self.failure_start + failure_growth
+        self._rng = np.random.default_rng(seed)
+        self._background = np.tile(np.linspace(40, 200, WIDTH, dtype=np.uint8)[None, :, None], (HEIGHT, 1, 3))
+        self._frame = np.empty_like(self._background)
+        self._noise = np.empty((HEIGHT, WIDTH, 3), dtype=np.int16)
+
+    def failure_progress(self, t):
+        """0 until the failure starts, 1 once fully developed."""
+        return min(1.0, max(0.0, (t - self.failure_start) / self.failure_growth))
+
+    def frame(self, t):
+        """Renders the camera frame at time t, with sensor noise."""
+        np.copyto(self._frame, self._background)
+        if t >= self.printing_start:
+            # The toolhead sweeps the bed every 20 seconds.
+            x = int(200 + 800 * abs(((t - self.printing_start) / 20) % 2 - 1))
+            cv2.rectangle(self._frame, (x, 200), (x + 60, 260), (30, 30, 30), -1)
+        radius = int(self.failure_progress(t) * 120)
+        if radius:
+            cv2.circle(self._frame, (640, 450), radius, (0, 0, 220), -1)
+        self._noise[:] = self._rng.normal(0, 3, size=self._noise.shape)
+        return np.clip(self._frame + self._noise, 0, 255).astype(np.uint8)
+
+    def spaghetti_confidence(self, t):
+        return self.failure_progress(t)
+
+
+def _simulate(controller, simulated_print, step):
+    inferences = 0
+    detected_at = None
+    t = 0.0
+    last_check = -float('inf')
+    while t < simulated_print.duration:
+        if t - last_check >= controller.interval(t):
+            last_check = t
+            if controller.should_infer(simulated_print.frame(t), t):
+                inferences += 1
+                confidence = simulated_print.spaghetti_confidence(t)
+                controller.update({'spaghetti': confidence}, THRESHOLDS, t)
+                if confidence >= THRESHOLDS['spaghetti'] and detected_at is None:
+                    detected_at = t
+        t += step
+
+    # The earliest time an inference could report the failure.
+    detectable_at = simulated_print.failure_start + THRESHOLDS['spaghetti'] * simulated_print.failure_growth
+    return inferences, (detected_at - detectable_at) if detected_at is not None else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--heating', type=float, default=120, help="Seconds of static scene")
+    parser.add_argument('--printing', type=float, default=600, help="Seconds of normal printing")
+    parser.add_argument('--failure-growth', type=float, default=60, help="Seconds for the failure to fully develop")
+    args = parser.parse_args()
+
+    print(f"{'controller':>10} {'inferences':>10} {'inf/min':>8} {'time to detection s':>20}")
+    for name, controller in (('fixed', FixedRateController()), ('adaptive', AdaptiveRateController())):
+        simulated_print = SimulatedPrint(args.heating, args.printing, args.failure_growth)
+        inferences, time_to_detection = _simulate(controller, simulated_print, step=0.05)
+        print(f"{name:>10} {inferences:>10} {inferences / simulated_print.duration * 60:>8.1f} "
+              f"{time_to_detection if time_to_detection is not None else float('nan'):>20.2f}")
+
+
+if __name__ == '__main__':
+    main()
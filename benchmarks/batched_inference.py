@@ -0,0 +1,77 @@
+"""
+Compares the pooled single-frame inference backend with the cross-stream batching one on the CPU.
+
+Every simulated stream submits frames back to back, which is the worst case for the device. The benchmark reports
+throughput, p50/p99 latency and, for the batching backend, the batch fill ratio.
+
+    python3 -m benchmarks.batched_inference
+"""
+import argparse
+import threading
+import time
+
+import numpy as np
+import openvino as ov
+
+from benchmarks.common import build_synthetic_model
+from src.inference import BatchingInferenceBackend, InferenceBackend, _prepare_model
+
+STREAM_COUNTS = (1, 4, 16)
+
+
+def _compile(max_batch=None):
+    return ov.Core().compile_model(_prepare_model(build_synthetic_model(), max_batch), 'CPU')
+
+
+def _run_streams(backend, stream_count, duration):
+    """Runs stream_count threads submitting frames for duration seconds. Returns the per-frame latencies."""
+    frame = np.random.default_rng(0).integers(0, 256, size=(720, 1280, 3), dtype=np.uint8)
+    latencies = []
+    deadline = time.perf_counter() + duration
+
+    def stream():
+        output = backend.create_output_buffer()
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            backend.infer(frame, output)
+            latencies.append(time.perf_counter() - start)
+
+    threads = [threading.Thread(target=stream) for _ in range(stream_count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--duration', type=float, default=5, help="Seconds to run each configuration")
+    parser.add_argument('--max-batch', type=int, default=4)
+    parser.add_argument('--max-wait-ms', type=float, default=50)
+    parser.add_argument('--jobs', type=int, default=2, help="Number of infer requests")
+    args = parser.parse_args()
+
+    pooled = InferenceBackend(_compile(), args.jobs)
+    batching = BatchingInferenceBackend(_compile(args.max_batch), args.max_batch, args.max_wait_ms / 1000, args.jobs)
+
+    print(f"{'backend':>9} {'streams':>7} {'frames/s':>9} {'p50 ms':>7} {'p99 ms':>7} {'fill':>5}")
+    try:
+        for stream_count in STREAM_COUNTS:
+            for name, backend in (('pooled', pooled), ('batching', batching)):
+                stats_before = backend.stats()
+                latencies = np.array(_run_streams(backend, stream_count, args.duration)) * 1000
+                stats = backend.stats()
+                fill = ''
+                if stats:
+                    batches = stats['batches'] - stats_before['batches']
+                    frames = stats['frames'] - stats_before['frames']
+                    fill = f"{frames / (batches * args.max_batch):.2f}" if batches else '0'
+                print(f"{name:>9} {stream_count:>7} {len(latencies) / args.duration:>9.1f} "
+                      f"{np.percentile(latencies, 50):>7.1f} {np.percentile(latencies, 99):>7.1f} {fill:>5}")
+    finally:
+        batching.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+"""
+Shared helpers for the benchmarks. The bundled model is stored in Git LFS and the benchmarks need to run on plain
+Linux boxes, so they use a synthetic model with the same input/output layout as the YOLOv5 one.
+"""
+import os
+import pathlib
+import tempfile
+
+import cv2
+import numpy as np
+import openvino as ov
+import openvino.opset13 as ops
+
+INPUT_SIZE = 640
+NUM_CLASSES = 4
+
+
+def build_synthetic_model():
+    """
+    Builds a small model with the YOLOv5 input [1, 3, 640, 640] and output [1, 25200, 5 + classes]. The output is
+    produced by one strided convolution per detection head (strides 8, 16 and 32, three anchors each) so the compute
+    grows with the input size similar to the real model, only much cheaper.
+    """
+    rng = np.random.default_rng(0)
+    values_per_anchor = 5 + NUM_CLASSES
+    image = ops.parameter([1, 3, INPUT_SIZE, INPUT_SIZE], ov.Type.f32, name='images')
+    heads = []
+    for stride in (8, 16, 32):
+        weights = rng.normal(0, 0.05, size=(3 * values_per_anchor, 3, stride, stride)).astype(np.float32)
+        head = ops.convolution(image, ops.constant(weights), [stride, stride], [0, 0], [0, 0], [1, 1])
+        cells = (INPUT_SIZE // stride) ** 2
+        head = ops.reshape(head, ops.constant(np.array([0, 3, values_per_anchor, cells], dtype=np.int64)), True)
+        head = ops.transpose(head, ops.constant(np.array([0, 1, 3, 2], dtype=np.int64)))
+        head = ops.reshape(head, ops.constant(np.array([0, 3 * cells, values_per_anchor], dtype=np.int64)), True)
+        heads.append(head)
+    output = ops.sigmoid(ops.concat(heads, 1))
+    output.output(0).get_tensor().set_names({'output0'})
+    return ov.Model([output], [image], 'synthetic_yolov5')
+
+
+def save_synthetic_model(directory):
+    """Saves the synthetic model as OpenVINO IR in the given directory and returns the .xml path."""
+    model_path = pathlib.Path(directory).joinpath('synthetic_model.xml')
+    ov.save_model(build_synthetic_model(), model_path, compress_to_fp16=False)
+    return model_path
+
+
+def write_synthetic_video(path, frames=300, width=1280, height=720, fps=10):
+    """Writes an MJPEG video of a rectangle moving over a gradient, a stand-in for a printer camera recording."""
+    writer = cv2.VideoWriter(str(path), cv2.VideoWriter_fourcc(*'MJPG'), fps, (width, height))
+    background = np.tile(np.linspace(0, 255, width, dtype=np.uint8)[None, :, None], (height, 1, 3))
+    for i in range(frames):
+        frame = background.copy()
+        x = (i * 10) % (width - 100)
+        cv2.rectangle(frame, (x, height // 3), (x + 100, height // 3 + 100), (0, 0, 255), -1)
+        writer.write(frame)
+    writer.release()
+    return path
+
+
+def temporary_directory():
+    return tempfile.TemporaryDirectory(prefix='printer_monitor_bench_')
+
+
+def rss_mb():
+    """Current resident set size of this process in MB."""
+    with open(f"/proc/{os.getpid()}/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
@@ -0,0 +1,200 @@
+"""
+Compares the FP model with its INT8 variant (see benchmarks.quantize) on the CPU, over the same frames.
+
+For each variant the report has the file size, the resident memory added by loading the model, the compile time,
+single-stream latency percentiles and the throughput of --streams concurrent streams. Detections are counted per class
+against the `confidence_thresholds` of the config, with the frames where only one of the variants detects the class.
+For clips with labels (see benchmarks.replay) the per-class precision/recall of both variants is printed too.
+
+Each variant runs in a fresh process so the memory footprints do not mix. --synthetic-model quantizes the synthetic
+benchmark model on the synthetic recording, which checks the tooling on a checkout without the Git LFS files.
+
+    python3 -m benchmarks.compare_models --synthetic-model
+    python3 -m benchmarks.compare_models recordings/*.mp4 --config config/config.yaml --max-recall-drop 0.02
+"""
+import argparse
+import concurrent.futures
+import multiprocessing
+import pathlib
+import sys
+import threading
+import time
+from collections import defaultdict
+
+import numpy as np
+import openvino as ov
+import yaml
+
+from benchmarks.common import rss_mb, save_synthetic_model, temporary_directory, write_synthetic_video
+from benchmarks.quantize import load_calibration_frames, model_input_size, quantize_model
+from benchmarks.replay import DEFAULT_CONFIG, _labeled_classes, _load_labels, _print_accuracy, _read_frames
+from src.inference import MODEL_PATH, MODEL_VARIANTS
+
+# Frames kept in memory for the throughput run.
+THROUGHPUT_FRAMES = 32
+
+
+def _throughput(compiled_model, frames, streams, duration):
+    """Frames per second of streams threads inferring the frames back to back on a pool of as many infer requests."""
+    from src.inference import InferenceBackend
+
+    backend = InferenceBackend(compiled_model, streams)
+    stop_event = threading.Event()
+    counts = [0] * streams
+
+    def run_stream(index):
+        output = backend.create_output_buffer()
+        while not stop_event.is_set():
+            backend.infer(frames[counts[index] % len(frames)], output)
+            counts[index] += 1
+
+    threads = [threading.Thread(target=run_stream, args=(i,)) for i in range(streams)]
+    start_time = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    time.sleep(duration)
+    stop_event.set()
+    for thread in threads:
+        thread.join()
+    return sum(counts) / (time.perf_counter() - start_time)
+
+
+def _measure_variant(model_path, clips, config, streams, duration):
+    """Runs in a fresh process. Returns the measurements of one model variant, see main."""
+    from src import issue_detector
+    from src.inference import InferenceBackend, load_compiled_model, performance_properties
+
+    detector_config = config['issue_detector']
+    thresholds = detector_config.get('confidence_thresholds', {})
+    area_of_interest = detector_config.get('detection_area_of_interest')
+
+    rss_before_model = rss_mb()
+    start_time = time.perf_counter()
+    compiled_model = load_compiled_model(model_path, 'CPU', properties=performance_properties('CPU', 'LATENCY'))
+    compile_seconds = time.perf_counter() - start_time
+    backend = InferenceBackend(compiled_model, 1)
+    output = backend.create_output_buffer()
+    model_rss = rss_mb() - rss_before_model
+
+    latencies = []
+    detected_classes = []
+    counts = defaultdict(lambda: {'tp': 0, 'fp': 0, 'fn': 0})
+    throughput_frames = []
+    for clip_path in clips:
+        labels = _load_labels(clip_path)
+        for frame_index, frame in enumerate(_read_frames(clip_path)):
+            start_time = time.perf_counter()
+            results = backend.infer(frame, output)
+            latencies.append(time.perf_counter() - start_time)
+
+            height, width = frame.shape[:2]
+            detections = issue_detector._pre_process_detection_results(
+                results[0], width, height, backend.input_width, backend.input_height, thresholds,
+                area_of_interest or [0, 0, width, height])
+            detected = {detection['name'] for detection in detections}
+            detected_classes.append(detected)
+            if len(throughput_frames) < THROUGHPUT_FRAMES:
+                throughput_frames.append(frame.copy())
+
+            if labels is not None:
+                expected = _labeled_classes(labels, frame_index)
+                for class_name in expected | detected:
+                    if class_name in expected and class_name in detected:
+                        counts[class_name]['tp'] += 1
+                    elif class_name in detected:
+                        counts[class_name]['fp'] += 1
+                    else:
+                        counts[class_name]['fn'] += 1
+
+    throughput_model = load_compiled_model(model_path, 'CPU',
+                                           properties=performance_properties('CPU', 'THROUGHPUT', streams))
+    return {
+        'size_mb': pathlib.Path(model_path).with_suffix('.bin').stat().st_size / (1024 * 1024),
+        'model_rss_mb': model_rss,
+        'compile_seconds': compile_seconds,
+        'latencies': latencies,
+        'throughput': _throughput(throughput_model, throughput_frames, streams, duration),
+        'detected_classes': detected_classes,
+        'counts': dict(counts),
+    }
+
+
+def _print_detection_changes(fp_classes, int8_classes):
+    """Prints per class the frames with a detection for each variant, and the frames where only one detects it."""
+    print(f"{'class':>11} {'fp':>6} {'int8':>6} {'change':>7} {'fp only':>8} {'int8 only':>9}")
+    for class_name in sorted(set().union(*fp_classes, *int8_classes)):
+        fp_frames = sum(class_name in classes for classes in fp_classes)
+        int8_frames = sum(class_name in classes for classes in int8_classes)
+        fp_only = sum(class_name in fp and class_name not in int8 for fp, int8 in zip(fp_classes, int8_classes))
+        int8_only = sum(class_name in int8 and class_name not in fp for fp, int8 in zip(fp_classes, int8_classes))
+        change = (int8_frames - fp_frames) / fp_frames if fp_frames else float('nan')
+        print(f"{class_name:>11} {fp_frames:>6} {int8_frames:>6} {change:>+7.1%} {fp_only:>8} {int8_only:>9}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('clips', nargs='*', type=pathlib.Path, help="Video files or image directories")
+    parser.add_argument('--config', help="Config file with the confidence thresholds and area of interest to use")
+    parser.add_argument('--fp', type=pathlib.Path, default=MODEL_PATH, help="FP model .xml")
+    parser.add_argument('--int8', type=pathlib.Path, default=MODEL_PATH.with_name(MODEL_VARIANTS['int8']),
+                        help="INT8 model .xml")
+    parser.add_argument('--synthetic-model', action='store_true', help="Quantize and compare the synthetic model")
+    parser.add_argument('--streams', type=int, default=4, help="Concurrent streams of the throughput run")
+    parser.add_argument('--duration', type=float, default=5, help="Duration of the throughput run, in seconds")
+    parser.add_argument('--max-recall-drop', type=float,
+                        help="Exit with an error if the overall recall of the INT8 model is lower by more than this")
+    args = parser.parse_args()
+
+    config = DEFAULT_CONFIG
+    if args.config:
+        with open(args.config) as f:
+            config = yaml.safe_load(f)
+
+    with temporary_directory() as directory:
+        clips = args.clips or [write_synthetic_video(pathlib.Path(directory).joinpath('synthetic.avi'))]
+        fp_path, int8_path = args.fp, args.int8
+        if args.synthetic_model:
+            fp_path = save_synthetic_model(directory)
+            model = ov.Core().read_model(fp_path)
+            int8_path = pathlib.Path(directory).joinpath('synthetic_model_int8.xml')
+            ov.save_model(quantize_model(model, load_calibration_frames(clips, model_input_size(model))), int8_path,
+                          compress_to_fp16=False)
+
+        results = {}
+        for variant, model_path in (('fp', fp_path), ('int8', int8_path)):
+            with concurrent.futures.ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as pool:
+                results[variant] = pool.submit(_measure_variant, model_path, clips, config, args.streams,
+                                               args.duration).result()
+
+    print(f"{'variant':>8} {'file MB':>8} {'rss MB':>7} {'compile s':>9} {'p50 ms':>7} {'p99 ms':>7} "
+          f"{'fps':>6} {f'fps x{args.streams}':>8}")
+    for variant, result in results.items():
+        latencies_ms = np.array(result['latencies']) * 1000
+        p50, p99 = np.percentile(latencies_ms, (50, 99))
+        print(f"{variant:>8} {result['size_mb']:>8.1f} {result['model_rss_mb']:>7.1f} "
+              f"{result['compile_seconds']:>9.2f} {p50:>7.2f} {p99:>7.2f} {1000 / latencies_ms.mean():>6.1f} "
+              f"{result['throughput']:>8.1f}")
+    print()
+    _print_detection_changes(results['fp']['detected_classes'], results['int8']['detected_classes'])
+
+    recalls = {}
+    for variant, result in results.items():
+        if result['counts']:
+            print()
+            print(f"{variant}:")
+            recalls[variant] = _print_accuracy(result['counts'])
+
+    if args.max_recall_drop is not None:
+        if recalls.get('fp') is None or recalls.get('int8') is None:
+            print()
+            print("FAILED: --max-recall-drop needs labeled clips")
+            sys.exit(1)
+        if recalls['fp'] - recalls['int8'] > args.max_recall_drop:
+            print()
+            print(f"FAILED: INT8 recall {recalls['int8']:.3f} is more than {args.max_recall_drop} below "
+                  f"FP recall {recalls['fp']:.3f}")
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
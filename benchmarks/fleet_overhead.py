@@ -0,0 +1,102 @@
+"""
+Measures the per-printer overhead of the fleet issue detector at 1, 4 and 16 simulated printers.
+
+Every run happens in a fresh interpreter. The simulated printers replay a synthetic MJPEG recording through the
+regular stream monitoring loop, all sharing one CPU compiled synthetic model.
+
+    python3 -m benchmarks.fleet_overhead
+"""
+import argparse
+import queue
+import subprocess
+import sys
+import threading
+import time
+from unittest.mock import patch
+
+from benchmarks.common import rss_mb, save_synthetic_model, temporary_directory, write_synthetic_video
+
+PRINTER_COUNTS = (1, 4, 16)
+
+
+def _run(printer_count, duration):
+    """Runs the detector process loop in this interpreter and prints the measurements as one tab separated line."""
+    with temporary_directory() as directory:
+        model_path = save_synthetic_model(directory)
+        video_path = write_synthetic_video(f"{directory}/stream.avi")
+        config = {
+            'issue_detector': {
+                'device': 'CPU',
+                'model_cache': False,
+                'confidence_thresholds': {},
+                'detection_area_of_interest': [0, 0, 1280, 720],
+            }
+        }
+        printers = [{
+            'name': f"printer_{i}",
+            'stream_url': str(video_path),
+            'confidence_thresholds': {},
+            'detection_area_of_interest': [0, 0, 1280, 720],
+        } for i in range(printer_count)]
+
+        from src import issue_detector, inference
+
+        rss_before_model = rss_mb()
+        inferences = []
+        original_infer = inference.InferenceBackend.infer
+
+        def counting_infer(self, frame, output):
+            inferences.append(time.perf_counter())
+            return original_infer(self, frame, output)
+
+        terminate_event = threading.Event()
+        control_queue = queue.Queue()
+        with patch('src.config._config', config), \
+                patch.object(inference, 'MODEL_PATH', model_path), \
+                patch.object(inference.InferenceBackend, 'infer', counting_infer), \
+                patch.object(issue_detector, 'send_notification'):
+            worker = threading.Thread(target=issue_detector._detect_issues_process,
+                                      args=(terminate_event, control_queue, printers))
+            worker.start()
+            control_queue.put(('active', {printer['name'] for printer in printers}))
+            time.sleep(duration)
+            rss_running = rss_mb()
+            threads = threading.active_count()
+            terminate_event.set()
+            worker.join()
+
+    print(f"{printer_count}\t{rss_before_model:.1f}\t{rss_running:.1f}\t{threads}\t{len(inferences) / duration:.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--duration', type=float, default=10, help="Seconds to run each configuration")
+    parser.add_argument('--printers', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.printers:
+        _run(args.printers, args.duration)
+        return
+
+    # The process-per-printer estimate assumes every printer pays for a whole interpreter with a compiled model, as
+    # the single printer run does.
+    print(f"{'printers':>8} {'rss MB':>8} {'MB/printer':>10} {'process/printer MB':>18} {'threads':>8} {'inf/s':>6}")
+    baseline = None
+    single_process = None
+    for printer_count in PRINTER_COUNTS:
+        output = subprocess.run([sys.executable, '-m', 'benchmarks.fleet_overhead', '--printers', str(printer_count),
+                                 '--duration', str(args.duration)], capture_output=True, text=True, check=True)
+        _, rss_before_model, rss_running, threads, inference_rate = output.stdout.strip().splitlines()[-1].split('\t')
+        if single_process is None:
+            single_process = float(rss_running)
+        rss_running = float(rss_running) - float(rss_before_model)
+        if baseline is None:
+            # A single printer pays for the compiled model, everything above that is per-printer overhead.
+            baseline = rss_running
+        per_printer = (rss_running - baseline) / (printer_count - 1) if printer_count > 1 else rss_running
+        print(f"{printer_count:>8} {rss_running:>8.1f} {per_printer:>10.1f} {printer_count * single_process:>18.1f} "
+              f"{threads:>8} {inference_rate:>6}")
+
+
+if __name__ == '__main__':
+    main()
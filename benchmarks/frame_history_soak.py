@@ -0,0 +1,85 @@
+"""
+Soak test of the frame history over a long print, in virtual time.
+
+A recording (the synthetic one by default) is replayed in a loop as the camera stream. Its frames are passed to the
+frame history as the stream loop would, one per --check-interval seconds of virtual time, with a reported detection
+every --alert-minutes. The resident memory and the bytes held by the history are printed for every virtual hour. The
+run fails if the memory grew by more than --max-growth-mb after the first hour, when the ring buffer is long full.
+
+    python3 -m benchmarks.frame_history_soak
+    python3 -m benchmarks.frame_history_soak recordings/print.mp4 --hours 20 --config config/config.yaml
+"""
+import argparse
+import pathlib
+import sys
+import time
+
+import yaml
+
+from benchmarks.common import rss_mb, temporary_directory, write_synthetic_video
+from benchmarks.replay import _read_frames
+from src.frame_history import create_frame_history, flush_contact_sheets
+
+
+def _replayed_stream(clip_path):
+    """Yields the frames of the clip, over and over."""
+    while True:
+        yield from _read_frames(clip_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('clip', nargs='?', type=pathlib.Path, help="Video file or image directory to replay")
+    parser.add_argument('--config', help="Config file with the `issue_detector.frame_history` settings to use")
+    parser.add_argument('--hours', type=float, default=20, help="Virtual duration of the print")
+    parser.add_argument('--check-interval', type=float, default=2, help="Virtual seconds between frames")
+    parser.add_argument('--alert-minutes', type=float, default=30, help="Virtual minutes between detections")
+    parser.add_argument('--max-growth-mb', type=float, default=5,
+                        help="Exit with an error if the RSS grew by more than this after the first hour")
+    args = parser.parse_args()
+
+    frame_history_config = True
+    if args.config:
+        with open(args.config) as f:
+            frame_history_config = yaml.safe_load(f)['issue_detector'].get('frame_history') or True
+    history = create_frame_history({'frame_history': frame_history_config})
+
+    contact_sheets = []
+    with temporary_directory() as directory:
+        clip_path = args.clip or write_synthetic_video(pathlib.Path(directory).joinpath('synthetic.avi'))
+        frames = _replayed_stream(clip_path)
+
+        print(f"{'hour':>5} {'rss MB':>7} {'history KB':>10} {'frames':>7} {'sheets':>7} {'sheet KB':>8}")
+        start_time = time.perf_counter()
+        rss_first_hour = None
+        frame_time = 0.0
+        next_alert = args.alert_minutes * 60
+        for hour in range(1, int(args.hours) + 1):
+            while frame_time < hour * 3600:
+                history.add(next(frames), frame_time)
+                if frame_time >= next_alert:
+                    history.trigger(frame_time, lambda sheet: contact_sheets.append(len(sheet)))
+                    next_alert += args.alert_minutes * 60
+                frame_time += args.check_interval
+            flush_contact_sheets()
+
+            rss = rss_mb()
+            if rss_first_hour is None:
+                rss_first_hour = rss
+            stats = history.stats()
+            sheet_kb = contact_sheets[-1] / 1024 if contact_sheets else 0
+            print(f"{hour:>5} {rss:>7.1f} {stats['history_bytes'] / 1024:>10.1f} {stats['history_frames']:>7} "
+                  f"{len(contact_sheets):>7} {sheet_kb:>8.1f}")
+
+    growth = rss - rss_first_hour
+    print()
+    print(f"samples={history.samples} rss_growth_after_first_hour_mb={growth:.1f} "
+          f"elapsed={time.perf_counter() - start_time:.1f}s")
+    if growth > args.max_growth_mb:
+        print()
+        print(f"FAILED: RSS grew by {growth:.1f} MB after the first hour, more than {args.max_growth_mb} MB")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+"""
+Measures per-frame pre-processing time and memory growth of the original NumPy pre-processing (resize, transpose,
+batch dimension, float64 normalization, then conversion by OpenVINO) against the in-graph pre-processing that
+resizes straight into the u8 NHWC input tensor.
+
+Both paths run the same synthetic model on the CPU, so the difference is the cost of getting a frame into the model.
+
+    python3 -m benchmarks.preprocessing
+"""
+import argparse
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+import openvino as ov
+
+from benchmarks.common import build_synthetic_model, rss_mb
+from src.inference import InferenceBackend, _prepare_model
+
+
+def _numpy_path(compiled_model, input_width, input_height):
+    output_layer = compiled_model.output(0)
+
+    def infer(frame):
+        resized_frame = cv2.resize(frame, (input_width, input_height))
+        input_frame = resized_frame.transpose((2, 0, 1))[None, :, :, :].astype(float) / 255.0
+        return compiled_model([input_frame])[output_layer]
+
+    return infer
+
+
+def _in_graph_path(backend):
+    output = backend.create_output_buffer()
+    return lambda frame: backend.infer(frame, output)
+
+
+def _measure(name, infer, frame, iterations):
+    # Warm up, so one-off allocations (infer request tensors, OpenCV buffers) are not counted.
+    for _ in range(5):
+        infer(frame)
+
+    rss_before = rss_mb()
+    tracemalloc.start()
+    start_time = time.perf_counter()
+    for _ in range(iterations):
+        infer(frame)
+    elapsed = time.perf_counter() - start_time
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{name:>9} {elapsed / iterations * 1000:>9.2f} {peak / (1024 * 1024):>16.2f} {rss_mb() - rss_before:>16.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--iterations', type=int, default=200)
+    args = parser.parse_args()
+
+    core = ov.Core()
+    plain_model = core.compile_model(build_synthetic_model(), 'CPU')
+    backend = InferenceBackend(core.compile_model(_prepare_model(build_synthetic_model()), 'CPU'), pool_size=1)
+    frame = np.random.default_rng(0).integers(0, 256, size=(720, 1280, 3), dtype=np.uint8)
+
+    print(f"{'path':>9} {'ms/frame':>9} {'traced peak MB':>16} {'RSS growth MB':>16}")
+    _measure('numpy', _numpy_path(plain_model, backend.input_width, backend.input_height), frame, args.iterations)
+    _measure('in-graph', _in_graph_path(backend), frame, args.iterations)
+
+
+if __name__ == '__main__':
+    main()
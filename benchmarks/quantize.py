@@ -0,0 +1,86 @@
+"""
+Builds the INT8 variant of the bundled model (model/model_torch_int8.xml, see `issue_detector.model_variant`) with
+NNCF post-training quantization, calibrated on printer camera frames.
+
+The calibration clips are video files or image directories, like the replay ones. Every --frame-step-th frame is used,
+up to --max-frames, so a few recordings covering the lighting conditions and print stages of the fleet (empty bed,
+first layers, tall prints, failures) are enough. Everything runs on the CPU. NNCF is only needed for this step:
+
+    pip install nncf
+    python3 -m benchmarks.quantize recordings/*.mp4 snapshots/
+    python3 -m benchmarks.compare_models recordings/*.mp4
+"""
+import argparse
+import pathlib
+import time
+
+import cv2
+import numpy as np
+import openvino as ov
+
+from benchmarks.replay import _read_frames
+from src.inference import MODEL_PATH, MODEL_VARIANTS
+
+# NNCF's default calibration subset size.
+MAX_CALIBRATION_FRAMES = 300
+
+
+def load_calibration_frames(clips, input_size, frame_step=10, max_frames=MAX_CALIBRATION_FRAMES):
+    """Returns every frame_step-th frame of the clips, resized to the (height, width) model input, as u8 BGR images."""
+    input_height, input_width = input_size
+    frames = []
+    for clip_path in clips:
+        for index, frame in enumerate(_read_frames(pathlib.Path(clip_path))):
+            if index % frame_step == 0:
+                frames.append(cv2.resize(frame, (input_width, input_height)))
+                if len(frames) >= max_frames:
+                    return frames
+    return frames
+
+
+def _model_input(frame):
+    """The input of the plain (not pre-processed) model for a resized frame: [1, 3, H, W] f32 in [0, 1]."""
+    return frame.transpose((2, 0, 1))[None].astype(np.float32) / 255.0
+
+
+def quantize_model(model, frames):
+    """
+    Quantizes the plain FP model (input [1, 3, H, W] f32, as exported) to INT8. The MIXED preset keeps the activations
+    asymmetric, which suits the sigmoid outputs of the detection heads. The in-graph pre-processing is added on load as
+    for the FP model.
+    """
+    import nncf
+
+    dataset = nncf.Dataset(frames, _model_input)
+    return nncf.quantize(model, dataset, preset=nncf.QuantizationPreset.MIXED, subset_size=len(frames))
+
+
+def model_input_size(model):
+    """Returns the (height, width) of the [1, 3, H, W] input of the plain model."""
+    _, _, height, width = model.input(0).partial_shape
+    return height.get_length(), width.get_length()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('clips', nargs='+', type=pathlib.Path, help="Calibration video files or image directories")
+    parser.add_argument('--model', type=pathlib.Path, default=MODEL_PATH, help="FP model .xml to quantize")
+    parser.add_argument('--output', type=pathlib.Path, default=MODEL_PATH.with_name(MODEL_VARIANTS['int8']))
+    parser.add_argument('--frame-step', type=int, default=10, help="Use every n-th frame of the clips")
+    parser.add_argument('--max-frames', type=int, default=MAX_CALIBRATION_FRAMES)
+    args = parser.parse_args()
+
+    model = ov.Core().read_model(args.model)
+    frames = load_calibration_frames(args.clips, model_input_size(model), args.frame_step, args.max_frames)
+    if not frames:
+        parser.error("The calibration clips have no frames.")
+
+    start_time = time.perf_counter()
+    quantized_model = quantize_model(model, frames)
+    ov.save_model(quantized_model, args.output, compress_to_fp16=False)
+    print(f"Quantized {args.model} on {len(frames)} frames in {time.perf_counter() - start_time:.1f}s, "
+          f"saved to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
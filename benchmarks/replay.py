@@ -0,0 +1,328 @@
+"""
+Replays recorded clips through the issue detector pipeline on the CPU, without a printer, camera or notification
+service: decode -> inference -> post-processing -> tracking, annotation and notification, the latter to a local stub.
+
+Every frame of every clip is processed. A clip is a video file or a directory of images (processed in name order).
+The report has per-stage latency percentiles and histograms, throughput, memory and, for clips with labels,
+frame-level precision/recall per class.
+
+Labels are read from a YAML file next to the clip (`<clip>.labels.yaml` for videos, `labels.yaml` inside image
+directories) mapping class names to the [start, end) frame ranges in which the class is visible:
+
+    spaghetti: [[120, 300], [410, 460]]
+
+Without clips a synthetic recording is replayed, and --synthetic-model uses the synthetic benchmark model instead of
+the bundled one, so the harness runs on a checkout without the Git LFS files.
+
+With --rate-controller the clips are replayed in virtual time at their frame rate, and the frames are checked and
+inferred as the rate controller of a stream decides (`fixed` 1/sec or `adaptive`, with the `adaptive_rate` settings of
+--config if any). The option can be repeated to compare the controllers on the same clips: the number of inferences
+and the time from the first labeled frame (the start of the clip without labels) to the first reported detection are
+reported per clip.
+
+    python3 -m benchmarks.replay --synthetic-model
+    python3 -m benchmarks.replay recordings/*.mp4 --min-recall 0.9 --max-p99-ms 250
+    python3 -m benchmarks.replay recordings/*.mp4 --rate-controller fixed --rate-controller adaptive
+"""
+import argparse
+import pathlib
+import sys
+import time
+from collections import defaultdict
+
+import cv2
+import numpy as np
+import yaml
+
+from benchmarks.common import rss_mb, save_synthetic_model, temporary_directory, write_synthetic_video
+
+STAGES = ('decode', 'inference', 'postprocess', 'notify')
+# Upper bounds of the latency histogram buckets, in milliseconds.
+HISTOGRAM_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+IMAGE_SUFFIXES = ('.jpg', '.jpeg', '.png', '.bmp')
+DEFAULT_CONFIG = {
+    'issue_detector': {
+        'confidence_thresholds': {
+            'error': 0.75,
+            'spaghetti': 0.60,
+        },
+        'detection_area_of_interest': None,
+    }
+}
+
+
+def _read_frames(clip_path):
+    """Yields the frames of a video file or an image directory."""
+    if clip_path.is_dir():
+        for image_path in sorted(path for path in clip_path.iterdir() if path.suffix.lower() in IMAGE_SUFFIXES):
+            frame = cv2.imread(str(image_path))
+            if frame is None:
+                raise RuntimeError(f"Failed to read image {image_path}")
+            yield frame
+        return
+
+    cap = cv2.VideoCapture(str(clip_path))
+    if not cap.isOpened():
+        raise RuntimeError(f"Failed to open video {clip_path}")
+    try:
+        frame = None
+        while True:
+            ret, frame = cap.read(frame)
+            if not ret:
+                return
+            yield frame
+    finally:
+        cap.release()
+
+
+def _clip_fps(clip_path, default_fps):
+    """Returns the frame rate of a video file, default_fps for image directories and videos without one."""
+    if clip_path.is_dir():
+        return default_fps
+    cap = cv2.VideoCapture(str(clip_path))
+    try:
+        return cap.get(cv2.CAP_PROP_FPS) or default_fps
+    finally:
+        cap.release()
+
+
+def _load_labels(clip_path):
+    """Returns {class name: [(start, end), ...]} from the labels file of the clip, or None if it has none."""
+    labels_path = clip_path / 'labels.yaml' if clip_path.is_dir() else clip_path.with_suffix('.labels.yaml')
+    if not labels_path.exists():
+        return None
+    with open(labels_path) as f:
+        return {class_name: [tuple(frame_range) for frame_range in frame_ranges]
+                for class_name, frame_ranges in (yaml.safe_load(f) or {}).items()}
+
+
+def _labeled_classes(labels, frame_index):
+    return {class_name for class_name, frame_ranges in labels.items()
+            if any(start <= frame_index < end for start, end in frame_ranges)}
+
+
+class _StubNotifier:
+    """Stands in for send_notification, keeps the messages and image sizes instead of sending them."""
+
+    def __init__(self):
+        self.notifications = []
+
+    def __call__(self, message, image=None, event_type='printer_event'):
+        self.notifications.append((message, len(image) if image else 0))
+
+
+def _replay_clip(clip_path, issue_detector, backend, tracker, region_planner, printer, notifier, latencies, counts,
+                 rate_controller=None, fps=10):
+    """
+    Replays one clip. Adds the stage latencies (seconds) and per-class true/false positive/negative counts of the
+    inferred frames. With a rate_controller, the frames (at fps) are checked and inferred as it decides in virtual
+    time, otherwise every frame is inferred.
+    Returns the number of frames and inferences, and the seconds from the first labeled frame (or the start of the clip)
+    to the first reported detection, None if there was none.
+    """
+    labels = _load_labels(clip_path)
+    onset_index = min((start for frame_ranges in (labels or {}).values() for start, _ in frame_ranges), default=0)
+    output_buffers = []
+    frames = _read_frames(clip_path)
+    frame_index = -1
+    inferences = 0
+    first_report = None
+    last_check_time = -float('inf')
+
+    while True:
+        start_time = time.perf_counter()
+        frame = next(frames, None)
+        if frame is None:
+            return frame_index + 1, inferences, first_report
+        decoded_time = time.perf_counter()
+        frame_index += 1
+
+        if rate_controller is not None:
+            frame_time = frame_index / fps
+            if frame_time - last_check_time < rate_controller.interval(frame_time):
+                continue
+            last_check_time = frame_time
+            if not rate_controller.should_infer(frame, frame_time):
+                continue
+        inferences += 1
+
+        original_height, original_width = frame.shape[:2]
+        area_of_interest = printer['detection_area_of_interest'] or [0, 0, original_width, original_height]
+        regions = region_planner.regions(original_width, original_height, printer['detection_area_of_interest'],
+                                         backend.input_width, backend.input_height)
+        region_results = issue_detector._infer_regions(backend, frame, regions, output_buffers)
+        inferred_time = time.perf_counter()
+
+        detections = issue_detector._pre_process_region_results(region_results, regions, backend.input_width,
+                                                                backend.input_height, printer['confidence_thresholds'],
+                                                                area_of_interest)
+        processed_time = time.perf_counter()
+        if rate_controller is not None:
+            rate_controller.update(issue_detector._max_class_confidences(*region_results),
+                                   printer['confidence_thresholds'], frame_time)
+
+        reported_detections = tracker.update(detections)
+        if reported_detections and first_report is None and frame_index >= onset_index:
+            first_report = (frame_index - onset_index) / fps
+        if reported_detections:
+            annotated_frame = frame.copy()
+            detection_messages = issue_detector._annotate_detections(annotated_frame, reported_detections)
+            issue_detector._send_detection_notification(printer, annotated_frame, detection_messages, notifier)
+        notified_time = time.perf_counter()
+
+        for stage, duration in zip(STAGES, (decoded_time - start_time, inferred_time - decoded_time,
+                                            processed_time - inferred_time, notified_time - processed_time)):
+            latencies[stage].append(duration)
+
+        if labels is not None:
+            expected = _labeled_classes(labels, frame_index)
+            detected = {detection['name'] for detection in detections}
+            for class_name in expected | detected:
+                if class_name in expected and class_name in detected:
+                    counts[class_name]['tp'] += 1
+                elif class_name in detected:
+                    counts[class_name]['fp'] += 1
+                else:
+                    counts[class_name]['fn'] += 1
+
+
+def _print_latencies(latencies):
+    print(f"{'stage':>11} {'mean ms':>8} {'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    for stage, values in latencies.items():
+        values_ms = np.array(values) * 1000
+        p50, p90, p99 = np.percentile(values_ms, (50, 90, 99))
+        print(f"{stage:>11} {values_ms.mean():>8.2f} {p50:>8.2f} {p90:>8.2f} {p99:>8.2f} {values_ms.max():>8.2f}")
+
+    print()
+    print(f"{'stage':>11} " + " ".join(f"{f'<{bucket}ms':>7}" for bucket in HISTOGRAM_BUCKETS_MS) + f" {'more':>7}")
+    for stage, values in latencies.items():
+        histogram, _ = np.histogram(np.array(values) * 1000, bins=(0,) + HISTOGRAM_BUCKETS_MS + (np.inf,))
+        print(f"{stage:>11} " + " ".join(f"{count:>7}" for count in histogram))
+
+
+def _print_accuracy(counts):
+    """Prints the per-class precision/recall. Returns the overall recall, or None without labeled detections."""
+    print(f"{'class':>11} {'tp':>6} {'fp':>6} {'fn':>6} {'precision':>9} {'recall':>7}")
+    for class_name, count in sorted(counts.items()):
+        tp, fp, fn = count['tp'], count['fp'], count['fn']
+        precision = tp / (tp + fp) if tp + fp else float('nan')
+        recall = tp / (tp + fn) if tp + fn else float('nan')
+        print(f"{class_name:>11} {tp:>6} {fp:>6} {fn:>6} {precision:>9.3f} {recall:>7.3f}")
+
+    tp = sum(count['tp'] for count in counts.values())
+    fn = sum(count['fn'] for count in counts.values())
+    return tp / (tp + fn) if tp + fn else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('clips', nargs='*', type=pathlib.Path, help="Video files or image directories")
+    parser.add_argument('--config', help="Config file with the confidence thresholds and area of interest to use")
+    parser.add_argument('--model', help="Model .xml to use instead of the bundled one")
+    parser.add_argument('--synthetic-model', action='store_true', help="Use the synthetic benchmark model")
+    parser.add_argument('--min-recall', type=float, help="Exit with an error if the overall recall is lower")
+    parser.add_argument('--max-p99-ms', type=float, help="Exit with an error if the p99 frame latency is higher")
+    parser.add_argument('--rate-controller', choices=('fixed', 'adaptive'), action='append',
+                        help="Infer the frames the rate controller picks in virtual time, can be repeated to compare")
+    parser.add_argument('--fps', type=float, default=10,
+                        help="Frame rate of image directories and of videos that don't have one")
+    args = parser.parse_args()
+
+    config = DEFAULT_CONFIG
+    if args.config:
+        with open(args.config) as f:
+            config = yaml.safe_load(f)
+    detector_config = config['issue_detector']
+    printer = {
+        'name': None,
+        'confidence_thresholds': detector_config.get('confidence_thresholds', {}),
+        'detection_area_of_interest': detector_config.get('detection_area_of_interest'),
+    }
+
+    from src import issue_detector
+    from src.detection_tracker import create_detection_tracker
+    from src.region_planner import create_region_planner
+    from src.inference import create_inference_backend
+    from src.rate_controller import create_rate_controller
+
+    # The rate controller configurations, None infers every frame.
+    rate_controller_configs = {None: None}
+    if args.rate_controller:
+        rate_controller_configs = {
+            name: dict(detector_config, adaptive_rate=(detector_config.get('adaptive_rate') or True
+                                                       if name == 'adaptive' else None))
+            for name in args.rate_controller}
+
+    failures = []
+    clip_results = []
+    with temporary_directory() as directory:
+        model_path = save_synthetic_model(directory) if args.synthetic_model else args.model
+        clips = args.clips or [write_synthetic_video(pathlib.Path(directory).joinpath('synthetic.avi'))]
+
+        rss_before_model = rss_mb()
+        backend = create_inference_backend({'device': 'CPU', 'inference_requests': 1, 'model_cache': False},
+                                           model_path)
+        rss_model = rss_mb()
+
+        try:
+            for rate_controller_name, rate_controller_config in rate_controller_configs.items():
+                notifier = _StubNotifier()
+                latencies = {stage: [] for stage in STAGES}
+                counts = defaultdict(lambda: {'tp': 0, 'fp': 0, 'fn': 0})
+                frames = 0
+                inferences = 0
+                start_time = time.perf_counter()
+                for clip_path in clips:
+                    clip_path = pathlib.Path(clip_path)
+                    rate_controller = (create_rate_controller(rate_controller_config)
+                                       if rate_controller_config is not None else None)
+                    clip_frames, clip_inferences, first_report = _replay_clip(
+                        clip_path, issue_detector, backend, create_detection_tracker(detector_config),
+                        create_region_planner(detector_config), printer, notifier, latencies, counts,
+                        rate_controller, _clip_fps(clip_path, args.fps))
+                    frames += clip_frames
+                    inferences += clip_inferences
+                    clip_results.append((rate_controller_name, clip_path.name, clip_frames, clip_inferences,
+                                         first_report))
+                elapsed = time.perf_counter() - start_time
+
+                if rate_controller_name is not None:
+                    print(f"== {rate_controller_name} rate controller ==")
+                frame_latencies_ms = np.sum([latencies[stage] for stage in STAGES], axis=0) * 1000
+                p99_ms = float(np.percentile(frame_latencies_ms, 99)) if inferences else 0.0
+                print(f"frames={frames} inferences={inferences} throughput={inferences / elapsed:.1f} fps "
+                      f"notifications={len(notifier.notifications)} "
+                      f"model_rss_mb={rss_model - rss_before_model:.1f} "
+                      f"rss_growth_mb={rss_mb() - rss_before_model:.1f} frame_p99_ms={p99_ms:.2f}")
+                print()
+                if inferences:
+                    _print_latencies(latencies)
+                recall = None
+                if counts:
+                    print()
+                    recall = _print_accuracy(counts)
+                print()
+
+                label = f"{rate_controller_name}: " if rate_controller_name is not None else ""
+                if args.min_recall is not None and (recall is None or recall < args.min_recall):
+                    failures.append(f"{label}recall {recall} is below {args.min_recall}")
+                if args.max_p99_ms is not None and p99_ms > args.max_p99_ms:
+                    failures.append(f"{label}p99 frame latency {p99_ms:.2f} ms is above {args.max_p99_ms} ms")
+        finally:
+            backend.close()
+
+    if args.rate_controller:
+        print(f"{'controller':<10} {'clip':<24} {'frames':>7} {'inferences':>10} {'first report s':>14}")
+        for rate_controller_name, clip_name, clip_frames, clip_inferences, first_report in clip_results:
+            first_report = f"{first_report:.1f}" if first_report is not None else '-'
+            print(f"{rate_controller_name:<10} {clip_name:<24} {clip_frames:>7} {clip_inferences:>10} "
+                  f"{first_report:>14}")
+        print()
+
+    if failures:
+        print("FAILED: " + "; ".join(failures))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
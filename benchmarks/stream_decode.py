@@ -0,0 +1,123 @@
+"""
+Compares the CPU cost of the stream decoders on an MJPEG camera stream.
+
+A local server streams the JPEG frames of a recording (the synthetic 720p one by default) as multipart MJPEG at the
+camera frame rate, from its own process so its CPU time is not counted. Each decoder reads the stream for --seconds
+while a consumer takes the latest frame once per --check-interval, as the issue detector does. The report has the CPU
+time of the reading process as a share of one core, the frames captured and decoded, and the size of the decoded frames.
+
+    python3 -m benchmarks.stream_decode
+    python3 -m benchmarks.stream_decode recordings/print.mp4 --fps 30 --seconds 60
+"""
+import argparse
+import http.server
+import multiprocessing
+import pathlib
+import time
+
+import cv2
+
+from benchmarks.common import temporary_directory, write_synthetic_video
+from benchmarks.replay import _read_frames
+from src.frame_source import create_frame_source
+
+DECODERS = (
+    ('opencv', 'opencv'),
+    ('opencv_hw', 'opencv_hw'),
+    ('mjpeg', 'mjpeg'),
+    ('mjpeg reduce 2', {'type': 'mjpeg', 'reduce': 2}),
+    ('mjpeg reduce 4', {'type': 'mjpeg', 'reduce': 4}),
+)
+
+
+def _serve(jpegs, fps, port_queue):
+    """Serves the JPEGs as an endless MJPEG stream at fps, to every client."""
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header('Content-Type', 'multipart/x-mixed-replace; boundary=frame')
+            self.end_headers()
+            next_frame_time = time.perf_counter()
+            try:
+                while True:
+                    for jpeg in jpegs:
+                        self.wfile.write(b'--frame\r\nContent-Type: image/jpeg\r\n'
+                                         b'Content-Length: %d\r\n\r\n' % len(jpeg) + jpeg + b'\r\n')
+                        next_frame_time += 1 / fps
+                        time.sleep(max(0.0, next_frame_time - time.perf_counter()))
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+
+        def log_message(self, format, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    port_queue.put(server.server_address[1])
+    server.serve_forever()
+
+
+def _measure(url, decoder, seconds, check_interval):
+    frame_source = create_frame_source(url, decoder=decoder)
+    frame_source.start()
+    try:
+        # Skip the connection and the first frames, e.g. the probing of FFmpeg. Getting the stats starts the window of
+        # the capture fps.
+        time.sleep(1)
+        decoded_frames = frame_source.stats().get('decoded_frames', 0)
+        shape = None
+        cpu_start = time.process_time()
+        start_time = time.perf_counter()
+        while time.perf_counter() - start_time < seconds:
+            frame, _ = frame_source.latest()
+            if frame is not None:
+                shape = frame.shape
+            time.sleep(check_interval)
+        elapsed = time.perf_counter() - start_time
+        cpu = time.process_time() - cpu_start
+        stats = frame_source.stats()
+    finally:
+        frame_source.stop()
+    decoded = stats['decoded_frames'] - decoded_frames if 'decoded_frames' in stats else stats['capture_fps'] * elapsed
+    return {
+        'cpu_percent': 100 * cpu / elapsed,
+        'capture_fps': stats['capture_fps'],
+        'decoded_per_second': decoded / elapsed,
+        'shape': f"{shape[1]}x{shape[0]}" if shape else '-',
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('clip', nargs='?', type=pathlib.Path, help="Video file or image directory to stream")
+    parser.add_argument('--fps', type=float, default=15, help="Frame rate of the camera stream")
+    parser.add_argument('--seconds', type=float, default=20, help="Measured duration per decoder")
+    parser.add_argument('--check-interval', type=float, default=1, help="Seconds between the frames consumed")
+    parser.add_argument('--jpeg-quality', type=int, default=80, help="JPEG quality of the streamed frames")
+    args = parser.parse_args()
+
+    with temporary_directory() as directory:
+        clip_path = args.clip or write_synthetic_video(pathlib.Path(directory).joinpath('synthetic.avi'), frames=100)
+        jpegs = [cv2.imencode('.jpg', frame, (cv2.IMWRITE_JPEG_QUALITY, args.jpeg_quality))[1].tobytes()
+                 for frame in _read_frames(clip_path)]
+
+    port_queue = multiprocessing.Queue()
+    server = multiprocessing.Process(target=_serve, args=(jpegs, args.fps, port_queue), daemon=True)
+    server.start()
+    url = f"http://127.0.0.1:{port_queue.get()}/stream.mjpg"
+    try:
+        print(f"{len(jpegs)} frames, {sum(map(len, jpegs)) / len(jpegs) / 1024:.0f} KB per JPEG, {args.fps:g} fps, "
+              f"a frame used every {args.check_interval:g}s")
+        print()
+        print(f"{'decoder':<16} {'cpu %':>6} {'capture fps':>11} {'decoded/s':>9} {'frame':>9}")
+        for name, decoder in DECODERS:
+            result = _measure(url, decoder, args.seconds, args.check_interval)
+            print(f"{name:<16} {result['cpu_percent']:>6.1f} {result['capture_fps']:>11.1f} "
+                  f"{result['decoded_per_second']:>9.1f} {result['shape']:>9}")
+    finally:
+        server.terminate()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""
+Measures the time from starting the issue detector to the first inference result, for a cold start (no compiled
+model cache), a start with the compiled blob cache populated, and a pre-warmed resident detector.
+
+Cold and cached starts run in fresh interpreters, so nothing is shared between them except the cache directory.
+
+    python3 -m benchmarks.warm_start
+"""
+import argparse
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+from benchmarks.common import save_synthetic_model, temporary_directory
+
+
+def _time_to_first_inference(model_path, cache_dir, device):
+    from src.inference import InferenceBackend, load_compiled_model
+
+    frame = np.zeros((720, 1280, 3), dtype=np.uint8)
+    start_time = time.perf_counter()
+    backend = InferenceBackend(load_compiled_model(model_path, device, cache_dir=cache_dir))
+    output = backend.create_output_buffer()
+    backend.infer(frame, output)
+    first_inference = time.perf_counter() - start_time
+
+    # A pre-warmed detector only pays for the inference itself when a print starts.
+    start_time = time.perf_counter()
+    backend.infer(frame, output)
+    return first_inference, time.perf_counter() - start_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--device', default='CPU')
+    parser.add_argument('--model', help="Model .xml to use instead of the synthetic one")
+    parser.add_argument('--cache-dir', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.cache_dir:
+        print('\t'.join(f"{value:.4f}" for value in _time_to_first_inference(args.model, args.cache_dir, args.device)))
+        return
+
+    with temporary_directory() as directory:
+        model_path = args.model or save_synthetic_model(directory)
+        results = []
+        for _ in ('cold', 'cached'):
+            output = subprocess.run([sys.executable, '-m', 'benchmarks.warm_start', '--device', args.device,
+                                     '--model', str(model_path), '--cache-dir', f"{directory}/cache"],
+                                    capture_output=True, text=True, check=True)
+            results.append([float(value) for value in output.stdout.strip().splitlines()[-1].split('\t')])
+
+    print(f"{'start':>8} {'time to first inference ms':>27}")
+    print(f"{'cold':>8} {results[0][0] * 1000:>27.1f}")
+    print(f"{'cached':>8} {results[1][0] * 1000:>27.1f}")
+    print(f"{'warm':>8} {results[1][1] * 1000:>27.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,40 @@
 import os
+import threading
 import yaml
 import logging
 
+CONFIG_PATH = 'config/config.yaml'
+# Takes the place of the printer name in the (CONFIG_CHANGED, config) events ConfigWatcher puts on the events queue of
+# the monitor, next to the (printer name, state) ones of the printer watchers.
+CONFIG_CHANGED = object()
+# The stream decoders of src.frame_source.FRAME_SOURCES and their options, listed here as the monitor process does not
+# import OpenCV.
+DECODER_OPTIONS = {
+    'opencv': (),
+    'opencv_hw': ('device',),
+    'mjpeg': ('reduce', 'timeout'),
+}
+# The settings of the stream components (src.issue_detector.STREAM_COMPONENT_FACTORIES), each true for the defaults or
+# a mapping of the arguments of its class: their type and minimum value.
+STREAM_COMPONENT_OPTIONS = {
+    'tracking': {'min_hits': (int, 1), 'window': (int, 1), 'iou_threshold': (float, 0), 'smoothing': (float, 0),
+                 'growth_ratio': (float, 0), 'max_misses': (int, 0)},
+    'adaptive_rate': {'base_interval': (float, 0), 'min_interval': (float, 0), 'max_interval': (float, 0),
+                      'change_threshold': (float, 0), 'boost_duration': (float, 0), 'hint_ratio': (float, 0)},
+    'crop_to_area_of_interest': {'margin': (float, 0), 'tiling': (bool, False), 'tile_overlap': (float, 0),
+                                 'max_tiles': (int, 1)},
+    'frame_history': {'interval': (float, 0), 'pre_frames': (int, 0), 'post_frames': (int, 0), 'max_bytes': (int, 1),
+                      'frame_width': (int, 1), 'columns': (int, 1), 'jpeg_quality': (int, 0)},
+}
+
 _config = None
 
-def _load_config_from_file(config_path='config/config.yaml'):
+
+class ConfigError(ValueError):
+    """The configuration file is invalid."""
+
+
+def _load_config_from_file(config_path=CONFIG_PATH):
     if not os.path.exists(config_path):
         raise RuntimeError(f"Configuration file not found at {config_path}")
 
@@ -19,8 +49,253 @@ def get_config():
     global _config
     if _config is None:
         try:
-            _config = _load_config_from_file()
+            config = _load_config_from_file()
+            validate_config(config)
+            _config = config
         except Exception:
             logging.exception("Failed to load configuration")
             raise
     return _config
+
+def set_config(config):
+    """
+    Validates the configuration and replaces the cached one with it, raising ConfigError if it is invalid. The swap is
+    a single assignment, so a thread calling get_config sees either the old or the new configuration, never a mix.
+    """
+    global _config
+    validate_config(config)
+    _config = config
+
+
+def _validate_thresholds(thresholds, path, errors):
+    if not isinstance(thresholds, dict):
+        errors.append(f"{path} must be a mapping of class names to confidences")
+        return
+    for class_name, threshold in thresholds.items():
+        if isinstance(threshold, bool) or not isinstance(threshold, (int, float)) or not 0 <= threshold <= 1:
+            errors.append(f"{path}.{class_name} must be a number between 0 and 1")
+
+
+def _validate_area_of_interest(area_of_interest, path, errors):
+    if area_of_interest is None:
+        return
+    if (not isinstance(area_of_interest, (list, tuple)) or len(area_of_interest) != 4
+            or not all(isinstance(value, (int, float)) and not isinstance(value, bool) and value >= 0
+                       for value in area_of_interest)):
+        errors.append(f"{path} must be null or [x_min, y_min, x_max, y_max] with non-negative coordinates")
+        return
+    x_min, y_min, x_max, y_max = area_of_interest
+    if x_min >= x_max or y_min >= y_max:
+        errors.append(f"{path} must have x_min < x_max and y_min < y_max")
+
+
+def _decoder_type(decoder):
+    return (decoder.get('type') if isinstance(decoder, dict) else decoder) or 'opencv'
+
+
+def _validate_decoder(decoder, path, errors):
+    if decoder is None:
+        return
+    decoder_type = _decoder_type(decoder)
+    if decoder_type not in DECODER_OPTIONS:
+        errors.append(f"{path} must be one of {', '.join(DECODER_OPTIONS)}, or a mapping with one of them as its type")
+        return
+    if not isinstance(decoder, dict):
+        return
+    unknown_options = sorted(set(decoder) - {'type', *DECODER_OPTIONS[decoder_type]})
+    if unknown_options:
+        errors.append(f"{path} has options {', '.join(unknown_options)} the {decoder_type} decoder does not take "
+                      f"({', '.join(DECODER_OPTIONS[decoder_type]) or 'none'})")
+    if decoder.get('reduce', 1) not in (1, 2, 4, 8):
+        errors.append(f"{path}.reduce must be 1, 2, 4 or 8")
+    device = decoder.get('device', 0)
+    if isinstance(device, bool) or not isinstance(device, int) or device < 0:
+        errors.append(f"{path}.device must be a device index")
+    timeout = decoder.get('timeout', 1)
+    if isinstance(timeout, bool) or not isinstance(timeout, (int, float)) or timeout <= 0:
+        errors.append(f"{path}.timeout must be a positive number of seconds")
+
+
+def _validate_stream_component(settings, options, path, errors):
+    if settings is None or isinstance(settings, bool):
+        return
+    if not isinstance(settings, dict):
+        errors.append(f"{path} must be true, false or a mapping")
+        return
+    unknown_options = sorted(set(settings) - set(options))
+    if unknown_options:
+        errors.append(f"{path} has unknown options {', '.join(map(str, unknown_options))} "
+                      f"(expected {', '.join(options)})")
+    for option, value in settings.items():
+        if option not in options:
+            continue
+        option_type, minimum = options[option]
+        if option_type is bool:
+            if not isinstance(value, bool):
+                errors.append(f"{path}.{option} must be true or false")
+        elif option_type is int and (isinstance(value, bool) or not isinstance(value, int) or value < minimum):
+            errors.append(f"{path}.{option} must be an integer of at least {minimum}")
+        elif option_type is float and (isinstance(value, bool) or not isinstance(value, (int, float))
+                                       or value < minimum):
+            errors.append(f"{path}.{option} must be a number of at least {minimum}")
+    tile_overlap = settings.get('tile_overlap', 0)
+    if isinstance(tile_overlap, (int, float)) and not isinstance(tile_overlap, bool) and tile_overlap >= 1:
+        errors.append(f"{path}.tile_overlap must be below 1")
+
+
+def _validate_decoder_stream(decoder, stream_url, path, errors):
+    """Checks that the decoder can read the stream: the mjpeg one only reads HTTP streams."""
+    if (_decoder_type(decoder) == 'mjpeg' and isinstance(stream_url, str)
+            and not stream_url.startswith(('http://', 'https://'))):
+        errors.append(f"{path} is mjpeg, which reads HTTP streams only, not {stream_url}")
+
+
+def validate_config(config):
+    """
+    Checks the parts of the configuration the monitor can't run without, and the detection settings that can be changed
+    while it runs. Raises ConfigError listing all the problems found.
+    """
+    if not isinstance(config, dict):
+        raise ConfigError("The configuration must be a mapping")
+
+    errors = []
+    notifier_config = config.get('notifier')
+    if not isinstance(notifier_config, dict) or not notifier_config.get('url') or not notifier_config.get('token'):
+        errors.append("notifier must have a url and a token")
+
+    polling_interval = config.get('polling_interval_seconds')
+    if isinstance(polling_interval, bool) or not isinstance(polling_interval, (int, float)) or polling_interval <= 0:
+        errors.append("polling_interval_seconds must be a positive number")
+
+    detector_config = config.get('issue_detector') or {}
+    if not isinstance(detector_config, dict):
+        errors.append("issue_detector must be a mapping")
+        detector_config = {}
+    if 'confidence_thresholds' in detector_config:
+        _validate_thresholds(detector_config['confidence_thresholds'], 'issue_detector.confidence_thresholds', errors)
+    _validate_area_of_interest(detector_config.get('detection_area_of_interest'),
+                               'issue_detector.detection_area_of_interest', errors)
+    _validate_decoder(detector_config.get('decoder'), 'issue_detector.decoder', errors)
+    for key, options in STREAM_COMPONENT_OPTIONS.items():
+        _validate_stream_component(detector_config.get(key), options, f"issue_detector.{key}", errors)
+
+    if 'printers' in config:
+        printers = config['printers']
+        if not isinstance(printers, list) or not printers:
+            errors.append("printers must be a non-empty list")
+            printers = []
+        names = set()
+        for index, printer in enumerate(printers):
+            path = f"printers[{index}]"
+            if not isinstance(printer, dict) or not all(key in printer for key in ('name', 'ip', 'port')):
+                errors.append(f"{path} must have a name, ip and port")
+                continue
+            if printer['name'] in names:
+                errors.append(f"{path}.name '{printer['name']}' is not unique")
+            names.add(printer['name'])
+            if 'confidence_thresholds' in printer:
+                _validate_thresholds(printer['confidence_thresholds'], f"{path}.confidence_thresholds", errors)
+            _validate_area_of_interest(printer.get('detection_area_of_interest'),
+                                       f"{path}.detection_area_of_interest", errors)
+            _validate_decoder(printer.get('decoder'), f"{path}.decoder", errors)
+            _validate_decoder_stream(printer.get('decoder', detector_config.get('decoder')), printer.get('stream_url'),
+                                     f"{path}.decoder" if 'decoder' in printer else 'issue_detector.decoder', errors)
+    elif not isinstance(config.get('printer'), dict) or not all(key in config['printer'] for key in ('ip', 'port')):
+        errors.append("printer must have an ip and port, or printers must list the printers")
+    else:
+        _validate_decoder_stream(detector_config.get('decoder'), detector_config.get('stream_url'),
+                                 'issue_detector.decoder', errors)
+
+    if errors:
+        raise ConfigError("Invalid configuration: " + "; ".join(errors))
+
+
+class ConfigWatcher:
+    """
+    Watches the configuration file and puts (CONFIG_CHANGED, config) on the events queue whenever it changes, after
+    making the new configuration the one returned by get_config.
+
+    The file is checked every interval seconds, by its modification time, size and inode, so both in-place edits and
+    editors that replace the file are noticed. An edit that does not parse or does not validate is logged and ignored,
+    the previous configuration stays in effect until the file is fixed.
+    """
+
+    def __init__(self, events, interval=2, config_path=CONFIG_PATH):
+        self._events = events
+        self._interval = interval
+        self._config_path = config_path
+        self._signature = self._file_signature()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._watch, name="config_watcher", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _file_signature(self):
+        try:
+            stat = os.stat(self._config_path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+    def _watch(self):
+        while not self._stop_event.wait(self._interval):
+            self.check()
+
+    def check(self):
+        """Reloads the configuration if the file changed. Returns the new configuration, or None."""
+        signature = self._file_signature()
+        # A missing file is most likely being replaced, it is checked again on the next interval.
+        if signature is None or signature == self._signature:
+            return None
+        self._signature = signature
+
+        try:
+            config = _load_config_from_file(self._config_path)
+            if config == _config:
+                return None
+            set_config(config)
+        except (ConfigError, yaml.YAMLError, OSError, RuntimeError) as e:
+            logging.error(f"Ignoring the change of {self._config_path}, keeping the previous configuration: {e}")
+            return None
+
+        logging.info(f"Reloaded the configuration from {self._config_path}")
+        self._events.put((CONFIG_CHANGED, config))
+        return config
+
+def get_printers(config=None):
+    """
+    Returns the list of monitored printers as dicts with name, ip, port, stream_url, decoder, confidence_thresholds and
+    detection_area_of_interest.
+
+    Supports both the fleet configuration (a `printers` list) and the single printer one (`printer` +
+    `issue_detector.stream_url`). In the single printer case the name is None, so messages are not prefixed with a
+    printer name. Detection settings not specified for a printer default to the ones in the `issue_detector` section.
+    """
+    if config is None:
+        config = get_config()
+
+    detector_config = config.get('issue_detector', {})
+
+    if 'printers' in config:
+        printers = config['printers']
+    else:
+        printers = [dict(config['printer'], name=None, stream_url=detector_config.get('stream_url'))]
+
+    return [{
+        'name': printer['name'],
+        'ip': printer['ip'],
+        'port': printer['port'],
+        'stream_url': printer.get('stream_url'),
+        'decoder': printer.get('decoder', detector_config.get('decoder')),
+        'confidence_thresholds': printer.get('confidence_thresholds',
+                                             detector_config.get('confidence_thresholds', {})),
+        'detection_area_of_interest': printer.get('detection_area_of_interest',
+                                                  detector_config.get('detection_area_of_interest')),
+    } for printer in printers]
@@ -0,0 +1,100 @@
+from collections import deque
+
+
+def _area(box):
+    x_min, y_min, x_max, y_max = box
+    return max(0, x_max - x_min) * max(0, y_max - y_min)
+
+
+def _iou(box_a, box_b):
+    intersection = _area((max(box_a[0], box_b[0]), max(box_a[1], box_b[1]),
+                          min(box_a[2], box_b[2]), min(box_a[3], box_b[3])))
+    union = _area(box_a) + _area(box_b) - intersection
+    return intersection / union if union else 0.0
+
+
+class Track:
+    """A detected region of one class followed over the inferred frames."""
+
+    def __init__(self, detection, window):
+        self.name = detection['name']
+        self.box = detection['box']
+        self.confidence = detection['confidence']
+        self.hits = deque([True], maxlen=window)
+        self.misses = 0
+        # Box area when the track was last reported, None if it was never reported.
+        self.reported_area = None
+
+    def as_detection(self):
+        return {'name': self.name, 'confidence': self.confidence, 'box': self.box}
+
+
+class DetectionTracker:
+    """
+    Follows detections across frames, so an issue is reported once when it persists instead of on every frame.
+
+    Detections are matched to the tracks of the same class by IoU (at least iou_threshold, best matches first). A
+    track keeps the hits of its last window frames and an exponentially smoothed confidence (weight smoothing for the
+    newest one), and is dropped after max_misses frames without a match. A track is reported once it was hit in
+    min_hits of the last window frames, and reported again only when its box grew to growth_ratio times the area it
+    had when last reported. A new region shows up as a new track and is reported on its own.
+    """
+
+    def __init__(self, min_hits=3, window=5, iou_threshold=0.3, smoothing=0.5, growth_ratio=1.5, max_misses=30):
+        self._min_hits = min_hits
+        self._window = window
+        self._iou_threshold = iou_threshold
+        self._smoothing = smoothing
+        self._growth_ratio = growth_ratio
+        self._max_misses = max_misses
+        self.tracks = []
+
+    def update(self, detections):
+        """Updates the tracks with the detections of a frame. Returns the detections of the tracks to report."""
+        pairs = sorted(((_iou(track.box, detection['box']), track_index, detection_index)
+                        for track_index, track in enumerate(self.tracks)
+                        for detection_index, detection in enumerate(detections)
+                        if track.name == detection['name']), reverse=True)
+        matched_tracks = set()
+        matched_detections = set()
+        for iou, track_index, detection_index in pairs:
+            if iou < self._iou_threshold:
+                break
+            if track_index in matched_tracks or detection_index in matched_detections:
+                continue
+            matched_tracks.add(track_index)
+            matched_detections.add(detection_index)
+
+            track = self.tracks[track_index]
+            detection = detections[detection_index]
+            track.box = detection['box']
+            track.confidence = self._smoothing * detection['confidence'] + (1 - self._smoothing) * track.confidence
+            track.hits.append(True)
+            track.misses = 0
+
+        for track_index, track in enumerate(self.tracks):
+            if track_index not in matched_tracks:
+                track.hits.append(False)
+                track.misses += 1
+        self.tracks = [track for track in self.tracks if track.misses <= self._max_misses]
+        self.tracks.extend(Track(detection, self._window) for detection_index, detection in enumerate(detections)
+                           if detection_index not in matched_detections)
+
+        reported = []
+        for track in self.tracks:
+            if track.misses or sum(track.hits) < self._min_hits:
+                continue
+            area = _area(track.box)
+            if track.reported_area is None or area >= track.reported_area * self._growth_ratio:
+                track.reported_area = area
+                reported.append(track.as_detection())
+        return reported
+
+
+def create_detection_tracker(config):
+    """
+    Creates the detection tracker for a stream from the `issue_detector` configuration section. `tracking` is either
+    unset, true or a dict with the DetectionTracker arguments.
+    """
+    tracking = config.get('tracking')
+    return DetectionTracker(**(tracking if isinstance(tracking, dict) else {}))
@@ -0,0 +1,166 @@
+import concurrent.futures
+import logging
+import threading
+from collections import deque
+
+import cv2
+import numpy as np
+
+from src import metrics
+
+_contact_sheet_seconds = metrics.histogram('contact_sheet_seconds', "Time to assemble and encode a contact sheet.")
+
+# Contact sheets of all streams are assembled on one thread, they are rare and should not compete with inference.
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix='contact_sheet')
+        return _executor
+
+
+def flush_contact_sheets():
+    """Waits for the contact sheets being assembled, so they are queued for delivery before the process exits."""
+    global _executor
+    with _executor_lock:
+        executor, _executor = _executor, None
+    if executor is not None:
+        executor.shutdown(wait=True)
+
+
+class FrameHistory:
+    """
+    Keeps the recent frames of a stream, so a detection can be sent with the frames showing how it developed.
+
+    A frame is sampled every `interval` seconds, downscaled to frame_width and kept JPEG encoded, so no raw frames are
+    held. The ring buffer keeps the last pre_frames samples, and drops the oldest ones beyond max_bytes, so its memory
+    is capped whatever the length of the print. After trigger(), post_frames more samples are collected, then the
+    contact sheet of the frames before and after the detection is assembled and encoded on a worker thread and passed
+    to the callback. A trigger while a contact sheet is being collected is ignored.
+    """
+
+    def __init__(self, interval=2, pre_frames=10, post_frames=5, max_bytes=2 * 1024 * 1024, frame_width=320,
+                 columns=5, jpeg_quality=70):
+        self.interval = interval
+        self.pre_frames = pre_frames
+        self.post_frames = post_frames
+        self.max_bytes = max_bytes
+        self.frame_width = frame_width
+        self.columns = columns
+        self.jpeg_quality = jpeg_quality
+        self._frames = deque()
+        self._bytes = 0
+        self._last_sample_time = None
+        # (trigger time, frames before it, frames after it, callback) while a contact sheet is being collected.
+        self._pending = None
+
+        self.samples = 0
+        self.dropped = 0
+        self.sheets = 0
+
+    def add(self, frame, frame_time):
+        """Samples the frame if interval seconds passed since the last sample. Returns whether it was sampled."""
+        if self._last_sample_time is not None and frame_time - self._last_sample_time < self.interval:
+            return False
+        self._last_sample_time = frame_time
+
+        height, width = frame.shape[:2]
+        thumbnail_size = (self.frame_width, max(1, round(height * self.frame_width / width)))
+        ret, buffer = cv2.imencode('.jpg', cv2.resize(frame, thumbnail_size, interpolation=cv2.INTER_AREA),
+                                   (cv2.IMWRITE_JPEG_QUALITY, self.jpeg_quality))
+        if not ret:
+            return False
+        sample = (frame_time, buffer.tobytes())
+        self.samples += 1
+
+        self._frames.append(sample)
+        self._bytes += len(sample[1])
+        while len(self._frames) > self.pre_frames or (self._bytes > self.max_bytes and len(self._frames) > 1):
+            self._bytes -= len(self._frames.popleft()[1])
+            self.dropped += 1
+
+        if self._pending is not None:
+            self._pending[2].append(sample)
+            if len(self._pending[2]) >= self.post_frames:
+                self._submit()
+        return True
+
+    def trigger(self, trigger_time, callback):
+        """
+        Starts collecting the contact sheet of a detection at trigger_time, see the class docstring. Returns False if
+        one is already being collected.
+        """
+        if self._pending is not None:
+            return False
+        self._pending = (trigger_time, list(self._frames), [], callback)
+        if self.post_frames <= 0:
+            self._submit()
+        return True
+
+    def close(self):
+        """Sends the contact sheet being collected, if any, with the frames collected so far."""
+        if self._pending is not None:
+            self._submit()
+
+    def _submit(self):
+        trigger_time, before, after, callback = self._pending
+        self._pending = None
+        self.sheets += 1
+        _get_executor().submit(self._send_contact_sheet, trigger_time, before + after, callback)
+
+    def _send_contact_sheet(self, trigger_time, samples, callback):
+        try:
+            with _contact_sheet_seconds.time():
+                sheet = build_contact_sheet(samples, trigger_time, self.columns, self.jpeg_quality)
+            if sheet is not None:
+                callback(sheet)
+        except Exception:
+            logging.exception("Failed to send the contact sheet of a detection")
+
+    def stats(self):
+        return {'history_frames': len(self._frames), 'history_bytes': self._bytes, 'history_dropped': self.dropped,
+                'contact_sheets': self.sheets}
+
+
+def build_contact_sheet(samples, trigger_time, columns=5, jpeg_quality=70):
+    """
+    Lays out the (time, JPEG bytes) samples in a grid of the given number of columns, labeled with their time relative
+    to trigger_time, and returns it JPEG encoded. The first frame at or after trigger_time is framed in red. Returns
+    None without samples.
+    """
+    thumbnails = [cv2.imdecode(np.frombuffer(jpeg, dtype=np.uint8), cv2.IMREAD_COLOR) for _, jpeg in samples]
+    if not thumbnails:
+        return None
+    height, width = thumbnails[0].shape[:2]
+    columns = min(columns, len(thumbnails))
+    rows = (len(thumbnails) + columns - 1) // columns
+    sheet = np.zeros((rows * height, columns * width, 3), dtype=np.uint8)
+
+    trigger_index = next((i for i, (sample_time, _) in enumerate(samples) if sample_time >= trigger_time),
+                         len(samples) - 1)
+    for i, ((sample_time, _), thumbnail) in enumerate(zip(samples, thumbnails)):
+        y, x = (i // columns) * height, (i % columns) * width
+        # Thumbnails of a stream share a size, unless its resolution changed in between.
+        sheet[y:y + height, x:x + width] = cv2.resize(thumbnail, (width, height))
+        cv2.putText(sheet, f"{sample_time - trigger_time:+.0f}s", (x + 4, y + 16), cv2.FONT_HERSHEY_SIMPLEX, 0.5,
+                    (255, 255, 255), 1, cv2.LINE_AA)
+        if i == trigger_index:
+            cv2.rectangle(sheet, (x, y), (x + width - 1, y + height - 1), (0, 0, 255), 2)
+
+    ret, buffer = cv2.imencode('.jpg', sheet, (cv2.IMWRITE_JPEG_QUALITY, jpeg_quality))
+    return buffer.tobytes() if ret else None
+
+
+def create_frame_history(config):
+    """
+    Creates the frame history for a stream from the `issue_detector` configuration section, None unless enabled.
+    `frame_history` is either true or a dict with the FrameHistory arguments.
+    """
+    frame_history = config.get('frame_history')
+    if not frame_history:
+        return None
+    return FrameHistory(**(frame_history if isinstance(frame_history, dict) else {}))
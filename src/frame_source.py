@@ -0,0 +1,382 @@
+import http.client
+import os
+import time
+import threading
+import logging
+import urllib.request
+
+import cv2
+import numpy as np
+
+from src import metrics
+
+logger = logging.getLogger(__name__)
+
+# Reconnect backoff, in seconds.
+INITIAL_RECONNECT_DELAY = 1
+MAX_RECONNECT_DELAY = 30
+# cv2.imdecode flags of the MJPEG frame source, by the factor the frames are reduced by while decoding.
+REDUCED_DECODE_FLAGS = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+# Limits of a part of an MJPEG stream, so a broken stream can't exhaust the memory.
+MAX_HEADER_LINE = 1024
+MAX_FRAME_BYTES = 16 * 1024 * 1024
+HW_ACCELERATION_NAMES = {
+    cv2.VIDEO_ACCELERATION_NONE: 'none',
+    cv2.VIDEO_ACCELERATION_D3D11: 'D3D11',
+    cv2.VIDEO_ACCELERATION_VAAPI: 'VAAPI',
+    cv2.VIDEO_ACCELERATION_MFX: 'MFX',
+}
+
+_read_seconds = metrics.histogram('frame_read_seconds', "Time to read and decode a frame.", ('printer',))
+_captured_frames = metrics.counter('frames_captured_total', "Frames read from the camera stream.", ('printer',))
+_dropped_frames = metrics.counter('frames_dropped_total', "Frames replaced before being consumed.", ('printer',))
+_reconnects = metrics.counter('stream_reconnects_total', "Camera stream reconnects.", ('printer',))
+_decode_seconds = metrics.histogram('frame_decode_seconds', "Time to decode a used frame of an MJPEG stream.",
+                                    ('printer',))
+
+
+class FrameSource:
+    """
+    Captures and decodes a video stream on its own thread and keeps only the newest frame.
+
+    The stream is read as fast as the camera delivers frames, so OpenCV's internal buffer never fills up with stale
+    frames, and `latest()` always returns the most recent one. Frames are decoded into a pool of three buffers: the
+    one held by the consumer, the latest one and the one being written, so no frame buffers are allocated in steady
+    state and the consumer's frame is never overwritten while it is being used.
+
+    Lost streams are reopened with exponential backoff. `error` is 'open' or 'read' while the stream is down, None
+    otherwise.
+    """
+
+    def __init__(self, stream_url, name=None):
+        self.stream_url = stream_url
+        self.error = None
+        self._log_prefix = f"[{name}] " if name else ""
+        # Recordings are read as fast as the disk allows, pace them to their frame rate as a live camera would be.
+        self._is_file = os.path.exists(stream_url)
+
+        self._lock = threading.Lock()
+        self._buffers = [None, None, None]
+        self._latest_index = None
+        self._reading_index = None
+        self._latest_time = None
+        self._latest_consumed = True
+
+        self._captured_frames = 0
+        self._dropped_frames = 0
+        self._reconnects = 0
+        self._frame_age = 0.0
+        self._stats_time = time.time()
+        self._stats_captured_frames = 0
+
+        self._read_seconds = _read_seconds.labels(name or '')
+        self._captured_frames_metric = _captured_frames.labels(name or '')
+        self._dropped_frames_metric = _dropped_frames.labels(name or '')
+        self._reconnects_metric = _reconnects.labels(name or '')
+
+        self._cap = None
+        self._frame_interval = 0
+        # Decoded frames are in full resolution, frame coordinates are divided by scale otherwise.
+        self.scale = 1
+
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._capture, name=f"capture_{self.stream_url}", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def latest(self):
+        """
+        Returns (frame, capture timestamp) of the newest frame, or (None, None) if nothing was captured yet.
+        The frame stays valid until the next call.
+        """
+        with self._lock:
+            if self._latest_index is None:
+                return None, None
+            self._reading_index = self._latest_index
+            self._latest_consumed = True
+            self._frame_age = time.time() - self._latest_time
+            return self._buffers[self._reading_index], self._latest_time
+
+    def stats(self):
+        """Returns the capture fps since the previous call, dropped (never consumed) frames, reconnects and frame age."""
+        with self._lock:
+            current_time = time.time()
+            capture_fps = (self._captured_frames - self._stats_captured_frames) / max(current_time - self._stats_time,
+                                                                                      1e-6)
+            self._stats_time = current_time
+            self._stats_captured_frames = self._captured_frames
+            return {
+                'capture_fps': capture_fps,
+                'dropped_frames': self._dropped_frames,
+                'reconnects': self._reconnects,
+                'frame_age': self._frame_age,
+            }
+
+    def _free_buffer_index(self):
+        with self._lock:
+            return next(i for i in range(len(self._buffers)) if i not in (self._latest_index, self._reading_index))
+
+    def _open(self):
+        """Opens the stream. Returns False if it can't be opened."""
+        os.environ['OPENCV_FFMPEG_LOGLEVEL'] = 'quiet'
+        self._cap = cv2.VideoCapture(self.stream_url, *self._capture_args())
+        if not self._cap.isOpened():
+            self._cap = None
+            return False
+        self._cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+        if self._is_file:
+            self._frame_interval = 1 / (self._cap.get(cv2.CAP_PROP_FPS) or 10)
+        return True
+
+    def _capture_args(self):
+        return ()
+
+    def _read(self, buffer):
+        """Reads the next frame, into the buffer when its size matches. Returns (success, frame)."""
+        return self._cap.read(buffer)
+
+    def _release(self):
+        if self._cap is not None:
+            self._cap.release()
+            self._cap = None
+
+    def _capture(self):
+        opened = False
+        reconnect_delay = INITIAL_RECONNECT_DELAY
+        try:
+            while not self._stop_event.is_set():
+                if not opened:
+                    opened = self._open()
+                    if not opened:
+                        logger.error(f"{self._log_prefix}Could not open video stream from {self.stream_url}. "
+                                     f"Retrying in {reconnect_delay} seconds...")
+                        self.error = 'open'
+                        self._stop_event.wait(reconnect_delay)
+                        reconnect_delay = min(reconnect_delay * 2, MAX_RECONNECT_DELAY)
+                        continue
+
+                index = self._free_buffer_index()
+                # Decode into the free buffer, OpenCV reuses it when the size matches.
+                read_start = time.perf_counter()
+                ret, frame = self._read(self._buffers[index])
+                self._read_seconds.observe(time.perf_counter() - read_start)
+
+                if not ret:
+                    logger.error(f"{self._log_prefix}Failed to read frame from stream. "
+                                 f"Reconnecting in {reconnect_delay} seconds...")
+                    self.error = 'read'
+                    self._release()
+                    opened = False
+                    self._reconnects += 1
+                    self._reconnects_metric.inc()
+                    self._stop_event.wait(reconnect_delay)
+                    reconnect_delay = min(reconnect_delay * 2, MAX_RECONNECT_DELAY)
+                    continue
+
+                self.error = None
+                reconnect_delay = INITIAL_RECONNECT_DELAY
+                with self._lock:
+                    self._buffers[index] = frame
+                    if not self._latest_consumed:
+                        self._dropped_frames += 1
+                        self._dropped_frames_metric.inc()
+                    self._latest_index = index
+                    self._latest_time = time.time()
+                    self._latest_consumed = False
+                    self._captured_frames += 1
+                self._captured_frames_metric.inc()
+
+                if self._frame_interval:
+                    self._stop_event.wait(self._frame_interval)
+        finally:
+            self._release()
+            logger.info(f"{self._log_prefix}Video stream released.")
+
+
+class HardwareFrameSource(FrameSource):
+    """
+    FrameSource decoding through FFmpeg with hardware acceleration (VAAPI, MFX, D3D11, whichever OpenCV was built
+    with), on the given device index if any. Without a usable accelerator OpenCV decodes on the CPU, which is logged
+    when the stream is opened.
+    """
+
+    def __init__(self, stream_url, name=None, device=None):
+        super().__init__(stream_url, name)
+        self._device = device
+        self.acceleration = None
+
+    def _capture_args(self):
+        params = [cv2.CAP_PROP_HW_ACCELERATION, cv2.VIDEO_ACCELERATION_ANY]
+        if self._device is not None:
+            params += [cv2.CAP_PROP_HW_DEVICE, self._device]
+        return cv2.CAP_FFMPEG, params
+
+    def _open(self):
+        if not super()._open():
+            return False
+        acceleration = HW_ACCELERATION_NAMES.get(int(self._cap.get(cv2.CAP_PROP_HW_ACCELERATION)), 'unknown')
+        if acceleration != self.acceleration:
+            if acceleration == 'none':
+                logger.warning(f"{self._log_prefix}Hardware decoding is not available, decoding on the CPU.")
+            else:
+                logger.info(f"{self._log_prefix}Decoding with {acceleration} hardware acceleration.")
+            self.acceleration = acceleration
+        return True
+
+
+class MjpegFrameSource(FrameSource):
+    """
+    Reads an MJPEG stream over HTTP (multipart/x-mixed-replace, as served by mjpg-streamer and most printer cameras)
+    without decoding every frame. The capture thread only keeps the JPEG of the newest frame, and latest() decodes the
+    frames that are actually used, so at one inference per second a 15 fps camera costs one decode instead of 15.
+    With reduce set to 2, 4 or 8 the JPEG is decoded at that fraction of its resolution, which is much cheaper. The
+    frames and their coordinates are then scaled down by `scale`, see the area of interest in the issue detector.
+    """
+
+    def __init__(self, stream_url, name=None, reduce=1, timeout=10):
+        if not stream_url.startswith(('http://', 'https://')):
+            raise ValueError(f"The mjpeg decoder reads HTTP streams, not {stream_url}")
+        if reduce not in REDUCED_DECODE_FLAGS:
+            raise ValueError(f"reduce must be one of {sorted(REDUCED_DECODE_FLAGS)}, not {reduce}")
+        super().__init__(stream_url, name)
+        self.scale = reduce
+        self._imread_flags = REDUCED_DECODE_FLAGS[reduce]
+        self._timeout = timeout
+        self._response = None
+        self._delimiters = ()
+        self._at_part = False
+        self._decoded_time = None
+        self._decoded_frame = None
+        self._decoded_frames = 0
+        self._decode_errors = 0
+        self._decode_seconds = _decode_seconds.labels(name or '')
+
+    def latest(self):
+        jpeg, frame_time = super().latest()
+        if jpeg is None:
+            return None, None
+        if frame_time != self._decoded_time:
+            decode_start = time.perf_counter()
+            frame = cv2.imdecode(np.frombuffer(jpeg, dtype=np.uint8), self._imread_flags)
+            self._decode_seconds.observe(time.perf_counter() - decode_start)
+            self._decoded_time = frame_time
+            self._decoded_frame = frame
+            self._decoded_frames += 1
+            if frame is None:
+                self._decode_errors += 1
+                logger.warning(f"{self._log_prefix}Failed to decode a frame of the MJPEG stream.")
+        if self._decoded_frame is None:
+            return None, None
+        return self._decoded_frame, frame_time
+
+    def stats(self):
+        stats = super().stats()
+        stats['decoded_frames'] = self._decoded_frames
+        stats['decode_errors'] = self._decode_errors
+        return stats
+
+    def _open(self):
+        # urllib rather than requests, whose reads block until the requested size arrived instead of returning the
+        # data available, which would hold back the frames of a slow stream.
+        try:
+            self._response = urllib.request.urlopen(self.stream_url, timeout=self._timeout)
+        except (OSError, http.client.HTTPException):
+            return False
+
+        boundary = self._response.headers.get_param('boundary')
+        if self._response.headers.get_content_maintype() != 'multipart' or not boundary:
+            logger.error(f"{self._log_prefix}{self.stream_url} is not an MJPEG stream "
+                         f"({self._response.headers.get_content_type()}).")
+            self._release()
+            return False
+        # Some cameras already put the leading dashes in the boundary parameter.
+        self._delimiters = (b'--' + boundary.encode(), boundary.encode())
+        self._at_part = False
+        return True
+
+    def _read(self, buffer):
+        try:
+            jpeg = self._read_part()
+        except (OSError, http.client.HTTPException, ValueError) as e:
+            logger.debug(f"{self._log_prefix}Failed to read the MJPEG stream: {e}")
+            return False, None
+        return jpeg is not None, jpeg
+
+    def _read_part(self):
+        """Returns the bytes of the next part of the stream, None at its end."""
+        # Skip to the next delimiter, unless the previous part (without a length) ended at it.
+        while not self._at_part:
+            line = self._response.readline(MAX_HEADER_LINE)
+            if not line:
+                return None
+            self._at_part = line.strip() in self._delimiters
+        self._at_part = False
+
+        content_length = None
+        while True:
+            line = self._response.readline(MAX_HEADER_LINE)
+            if not line:
+                return None
+            name, _, value = line.strip().partition(b':')
+            if not name:
+                break
+            if name.strip().lower() == b'content-length':
+                content_length = int(value)
+
+        if content_length is not None:
+            if content_length > MAX_FRAME_BYTES:
+                raise ValueError(f"Part of {content_length} bytes in the MJPEG stream")
+            jpeg = self._response.read(content_length)
+            return jpeg if len(jpeg) == content_length else None
+
+        # Without a length, the part ends at the next delimiter.
+        lines = []
+        size = 0
+        while True:
+            line = self._response.readline(MAX_FRAME_BYTES)
+            if not line:
+                return None
+            if line.strip() in self._delimiters:
+                self._at_part = True
+                # The line break before the delimiter belongs to it.
+                return b''.join(lines).removesuffix(b'\r\n').removesuffix(b'\n')
+            size += len(line)
+            if size > MAX_FRAME_BYTES:
+                raise ValueError("Part of the MJPEG stream too large")
+            lines.append(line)
+
+    def _release(self):
+        if self._response is not None:
+            self._response.close()
+        self._response = None
+
+
+FRAME_SOURCES = {
+    'opencv': FrameSource,
+    'opencv_hw': HardwareFrameSource,
+    'mjpeg': MjpegFrameSource,
+}
+
+
+def create_frame_source(stream_url, name=None, decoder=None):
+    """
+    Creates the frame source of a stream for the `decoder` setting of its printer: the name of a frame source
+    (FRAME_SOURCES, 'opencv' by default) or a dict with its `type` and arguments.
+    """
+    options = dict(decoder) if isinstance(decoder, dict) else {'type': decoder}
+    decoder_type = options.pop('type', None) or 'opencv'
+    if decoder_type not in FRAME_SOURCES:
+        raise ValueError(f"Unknown decoder '{decoder_type}', expected one of {', '.join(FRAME_SOURCES)}")
+    return FRAME_SOURCES[decoder_type](stream_url, name, **options)
@@ -0,0 +1,360 @@
+"""
+Print history: printer states, print jobs and per-inference detection summaries in an SQLite database, for tuning the
+thresholds and planning the fleet capacity from data.
+
+    python3 -m src.history_store jobs --days 7
+    python3 -m src.history_store classes --printer q1-left
+"""
+import argparse
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import defaultdict, deque
+from datetime import datetime
+
+import yaml
+
+from src import metrics
+from src.config import get_config
+
+_history_records = metrics.counter('history_records_total', "Print history records by outcome: written, dropped.",
+                                   ('result',))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS states (time REAL NOT NULL, printer TEXT NOT NULL, state TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS states_time ON states (time);
+-- A job starts when a printer starts printing and ends with the state it changes to (complete, cancelled, error, ...).
+CREATE TABLE IF NOT EXISTS jobs (id INTEGER PRIMARY KEY, printer TEXT NOT NULL, start REAL NOT NULL, end REAL,
+                                 result TEXT);
+CREATE INDEX IF NOT EXISTS jobs_printer_start ON jobs (printer, start);
+CREATE TABLE IF NOT EXISTS inferences (time REAL NOT NULL, printer TEXT NOT NULL, inference_seconds REAL NOT NULL,
+                                       postprocess_seconds REAL NOT NULL, detections INTEGER NOT NULL);
+CREATE INDEX IF NOT EXISTS inferences_printer_time ON inferences (printer, time);
+-- The inferences older than the raw retention, per printer and hour.
+CREATE TABLE IF NOT EXISTS inference_hours (hour REAL NOT NULL, printer TEXT NOT NULL, frames INTEGER NOT NULL,
+                                            inference_seconds_sum REAL NOT NULL, inference_seconds_max REAL NOT NULL,
+                                            postprocess_seconds_sum REAL NOT NULL, PRIMARY KEY (hour, printer));
+-- The detections passing the thresholds (reported = 0) and the ones reported by the tracker (reported = 1).
+CREATE TABLE IF NOT EXISTS detections (time REAL NOT NULL, printer TEXT NOT NULL, class TEXT NOT NULL,
+                                       confidence REAL NOT NULL, reported INTEGER NOT NULL);
+CREATE INDEX IF NOT EXISTS detections_printer_time ON detections (printer, time);
+"""
+
+
+def connect(path, timeout=30):
+    """Opens the database in WAL mode, so the monitor and detector processes write while the CLI reads."""
+    connection = sqlite3.connect(path, timeout=timeout)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('PRAGMA synchronous=NORMAL')
+    connection.executescript(SCHEMA)
+    return connection
+
+
+class HistoryStore:
+    """
+    Appends the print history to the database from a background thread, so recording never waits for the disk.
+
+    Records are queued in memory and written in one transaction every flush_interval seconds, or as soon as batch_size
+    of them are waiting. Beyond max_pending queued records (the disk is stalled) the oldest are dropped. Once an hour
+    the inferences older than raw_retention_days are downsampled to per-hour rows, and everything older than
+    retention_days is deleted.
+    """
+
+    def __init__(self, path, flush_interval=5, batch_size=1000, max_pending=100000, raw_retention_days=7,
+                 retention_days=365, maintenance_interval=3600):
+        self.path = path
+        self._flush_interval = flush_interval
+        self._batch_size = batch_size
+        self._raw_retention_days = raw_retention_days
+        self._retention_days = retention_days
+        self._maintenance_interval = maintenance_interval
+
+        self._condition = threading.Condition()
+        self._pending = deque(maxlen=max_pending)
+        self._writing = False
+        self._written = 0
+        self._dropped = 0
+        self._closed = False
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._thread = threading.Thread(target=self._write_loop, name='history_store', daemon=True)
+        self._thread.start()
+
+    def _append(self, record):
+        with self._condition:
+            if len(self._pending) == self._pending.maxlen:
+                self._dropped += 1
+                _history_records.labels('dropped').inc()
+            self._pending.append(record)
+            if len(self._pending) >= self._batch_size:
+                self._condition.notify()
+
+    def record_state(self, printer, state, state_time=None):
+        """Records a printer state change, which also starts and ends the jobs of the printer."""
+        self._append(('state', state_time or time.time(), printer or '', state))
+
+    def record_inference(self, printer, inference_time, inference_seconds, postprocess_seconds, detections,
+                         reported_detections=()):
+        """Records an inference with its detections passing the thresholds and the ones reported for it."""
+        self._append(('inference', inference_time, printer or '', inference_seconds, postprocess_seconds,
+                      [(detection['name'], detection['confidence']) for detection in detections],
+                      [(detection['name'], detection['confidence']) for detection in reported_detections]))
+
+    def flush(self, timeout=None):
+        """Waits until the queued records are written. Returns False on timeout."""
+        deadline = None if timeout is None else time.time() + timeout
+        with self._condition:
+            self._condition.notify()
+            while self._pending or self._writing:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+        return True
+
+    def close(self, timeout=None):
+        """Writes what it can within the timeout and stops the writer thread."""
+        self.flush(timeout)
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join(timeout)
+
+    def stats(self):
+        with self._condition:
+            return {'history_pending': len(self._pending), 'history_written': self._written,
+                    'history_dropped': self._dropped}
+
+    def _write_loop(self):
+        connection = None
+        last_maintenance = 0
+        while True:
+            with self._condition:
+                if not self._closed and len(self._pending) < self._batch_size:
+                    self._condition.wait(self._flush_interval)
+                if self._closed and not self._pending:
+                    break
+                records = list(self._pending)
+                self._pending.clear()
+                self._writing = bool(records)
+
+            try:
+                if connection is None:
+                    connection = connect(self.path)
+                if records:
+                    with connection:
+                        _write_records(connection, records)
+                    _history_records.labels('written').inc(len(records))
+                if time.time() - last_maintenance >= self._maintenance_interval:
+                    last_maintenance = time.time()
+                    with connection:
+                        downsample(connection, time.time() - self._raw_retention_days * 86400,
+                                   time.time() - self._retention_days * 86400)
+            except sqlite3.Error:
+                logging.exception(f"Failed to write {len(records)} records to the print history {self.path}.")
+                _history_records.labels('dropped').inc(len(records))
+                records = []
+
+            with self._condition:
+                self._written += len(records)
+                self._writing = False
+                self._condition.notify_all()
+        if connection is not None:
+            connection.close()
+
+
+def _write_records(connection, records):
+    for record in records:
+        if record[0] == 'state':
+            _, state_time, printer, state = record
+            connection.execute('INSERT INTO states VALUES (?, ?, ?)', (state_time, printer, state))
+            open_job = connection.execute('SELECT id FROM jobs WHERE printer = ? AND end IS NULL',
+                                          (printer,)).fetchone()
+            if state == 'printing' and open_job is None:
+                connection.execute('INSERT INTO jobs (printer, start) VALUES (?, ?)', (printer, state_time))
+            elif state != 'printing' and open_job is not None:
+                connection.execute('UPDATE jobs SET end = ?, result = ? WHERE id = ?', (state_time, state, open_job[0]))
+        else:
+            _, inference_time, printer, inference_seconds, postprocess_seconds, detections, reported = record
+            connection.execute('INSERT INTO inferences VALUES (?, ?, ?, ?, ?)',
+                               (inference_time, printer, inference_seconds, postprocess_seconds, len(detections)))
+            connection.executemany('INSERT INTO detections VALUES (?, ?, ?, ?, ?)',
+                                   [(inference_time, printer, name, confidence, 0) for name, confidence in detections] +
+                                   [(inference_time, printer, name, confidence, 1) for name, confidence in reported])
+
+
+def downsample(connection, raw_cutoff, cutoff):
+    """
+    Replaces the inferences before raw_cutoff (rounded down to the hour) by per-hour rows, and deletes all records
+    before cutoff.
+    """
+    raw_cutoff = raw_cutoff // 3600 * 3600
+    connection.execute("""
+        INSERT INTO inference_hours
+        SELECT CAST(time / 3600 AS INTEGER) * 3600, printer, COUNT(*), SUM(inference_seconds), MAX(inference_seconds),
+               SUM(postprocess_seconds)
+        FROM inferences WHERE time < ? GROUP BY 1, 2
+        ON CONFLICT (hour, printer) DO UPDATE SET
+            frames = frames + excluded.frames,
+            inference_seconds_sum = inference_seconds_sum + excluded.inference_seconds_sum,
+            inference_seconds_max = MAX(inference_seconds_max, excluded.inference_seconds_max),
+            postprocess_seconds_sum = postprocess_seconds_sum + excluded.postprocess_seconds_sum""", (raw_cutoff,))
+    connection.execute('DELETE FROM inferences WHERE time < ?', (raw_cutoff,))
+    for table, column in (('inference_hours', 'hour'), ('detections', 'time'), ('states', 'time'), ('jobs', 'end')):
+        connection.execute(f'DELETE FROM {table} WHERE {column} < ?', (cutoff,))
+
+
+def _percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))] if sorted_values else None
+
+
+def job_summaries(connection, printer=None, since=None):
+    """
+    Returns a dict per job, oldest first: id, printer, start, end, result, inferred frames, inference latency mean, p50
+    and p99 (seconds, p50/p99 are None once the job is downsampled, the max of its hours is given instead) and, per
+    class, the detections passing the thresholds and the reported ones. A job still printing ends now.
+    """
+    query = 'SELECT id, printer, start, end, result FROM jobs WHERE start >= ?'
+    parameters = [since or 0]
+    if printer is not None:
+        query += ' AND printer = ?'
+        parameters.append(printer)
+
+    summaries = []
+    for job_id, job_printer, start, end, result in connection.execute(query + ' ORDER BY start', parameters).fetchall():
+        job_end = end if end is not None else time.time()
+        latencies = sorted(row[0] for row in connection.execute(
+            'SELECT inference_seconds FROM inferences WHERE printer = ? AND time BETWEEN ? AND ?',
+            (job_printer, start, job_end)))
+        hours = connection.execute(
+            'SELECT SUM(frames), SUM(inference_seconds_sum), MAX(inference_seconds_max) FROM inference_hours '
+            'WHERE printer = ? AND hour BETWEEN ? AND ?', (job_printer, start // 3600 * 3600, job_end)).fetchone()
+        frames = len(latencies) + (hours[0] or 0)
+        classes = defaultdict(lambda: {'detections': 0, 'reports': 0})
+        for class_name, reported, count in connection.execute(
+                'SELECT class, reported, COUNT(*) FROM detections WHERE printer = ? AND time BETWEEN ? AND ? '
+                'GROUP BY class, reported', (job_printer, start, job_end)):
+            classes[class_name]['reports' if reported else 'detections'] = count
+
+        summaries.append({
+            'id': job_id,
+            'printer': job_printer,
+            'start': start,
+            'end': end,
+            'result': result,
+            'frames': frames,
+            'latency_mean': (sum(latencies) + (hours[1] or 0)) / frames if frames else None,
+            'latency_p50': _percentile(latencies, 0.5) if not hours[0] else None,
+            'latency_p99': _percentile(latencies, 0.99) if not hours[0] else None,
+            'latency_max': max(latencies[-1:] + [hours[2] or 0]) if frames else None,
+            'classes': dict(classes),
+        })
+    return summaries
+
+
+def class_summaries(jobs):
+    """
+    Returns per class, over the finished jobs: the detections, the reports, the jobs with reports and the estimated
+    false positive rate, the fraction of the reports made during jobs that completed anyway. A print that completed
+    after a report was most likely not failing, so its reports count as false positives.
+    """
+    classes = defaultdict(lambda: {'detections': 0, 'reports': 0, 'jobs_reported': 0, 'completed_reports': 0})
+    for job in jobs:
+        if job['end'] is None:
+            continue
+        for class_name, counts in job['classes'].items():
+            summary = classes[class_name]
+            summary['detections'] += counts['detections']
+            summary['reports'] += counts['reports']
+            if counts['reports']:
+                summary['jobs_reported'] += 1
+                if job['result'] == 'complete':
+                    summary['completed_reports'] += counts['reports']
+    for summary in classes.values():
+        summary['false_positive_rate'] = (summary['completed_reports'] / summary['reports']
+                                          if summary['reports'] else None)
+    return dict(classes)
+
+
+_store = None
+_store_pid = None
+_store_lock = threading.Lock()
+
+
+def get_history_store():
+    """
+    Returns the history store of this process, created from the `history` configuration section on first use, or None
+    if the history is not enabled. A forked process (the issue detector) gets its own, as the writer thread is not
+    inherited.
+    """
+    global _store, _store_pid
+    with _store_lock:
+        if _store_pid != os.getpid():
+            config = get_config().get('history') or {}
+            _store = None
+            if config.get('path'):
+                _store = HistoryStore(config['path'], flush_interval=config.get('flush_seconds', 5),
+                                      raw_retention_days=config.get('raw_retention_days', 7),
+                                      retention_days=config.get('retention_days', 365))
+            _store_pid = os.getpid()
+        return _store
+
+
+def close_history_store(timeout=None):
+    """Writes the queued records of this process, if it has a history store."""
+    if _store is not None and _store_pid == os.getpid():
+        _store.close(timeout)
+
+
+def _format_time(timestamp):
+    return datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M') if timestamp is not None else '-'
+
+
+def _format_ms(seconds):
+    return f"{seconds * 1000:.1f}" if seconds is not None else '-'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('report', choices=('jobs', 'classes'),
+                        help="Per-job summaries, or per-class detection statistics over the jobs")
+    parser.add_argument('--db', help="Database to read, `history.path` of the config by default")
+    parser.add_argument('--config', default='config/config.yaml')
+    parser.add_argument('--printer', help="Only the jobs of this printer")
+    parser.add_argument('--days', type=float, help="Only the jobs started in the last days")
+    args = parser.parse_args()
+
+    path = args.db
+    if path is None:
+        with open(args.config) as f:
+            path = (yaml.safe_load(f).get('history') or {}).get('path')
+        if not path:
+            parser.error(f"No --db given and no history.path in {args.config}")
+
+    connection = connect(path)
+    jobs = job_summaries(connection, args.printer, time.time() - args.days * 86400 if args.days else None)
+    if args.report == 'jobs':
+        print(f"{'id':>5} {'printer':>12} {'start':>16} {'min':>6} {'result':>10} {'frames':>7} {'mean ms':>8} "
+              f"{'p50 ms':>7} {'p99 ms':>7} {'max ms':>7}  detections/reports")
+        for job in jobs:
+            minutes = ((job['end'] or time.time()) - job['start']) / 60
+            classes = ", ".join(f"{name} {counts['detections']}/{counts['reports']}"
+                                for name, counts in sorted(job['classes'].items()))
+            print(f"{job['id']:>5} {job['printer']:>12} {_format_time(job['start']):>16} {minutes:>6.0f} "
+                  f"{job['result'] or 'printing':>10} {job['frames']:>7} {_format_ms(job['latency_mean']):>8} "
+                  f"{_format_ms(job['latency_p50']):>7} {_format_ms(job['latency_p99']):>7} "
+                  f"{_format_ms(job['latency_max']):>7}  {classes}")
+    else:
+        print(f"{'class':>11} {'detections':>10} {'reports':>8} {'jobs':>5} {'completed':>9} {'fp rate':>7}")
+        for class_name, summary in sorted(class_summaries(jobs).items()):
+            rate = f"{summary['false_positive_rate']:.2f}" if summary['false_positive_rate'] is not None else '-'
+            print(f"{class_name:>11} {summary['detections']:>10} {summary['reports']:>8} {summary['jobs_reported']:>5} "
+                  f"{summary['completed_reports']:>9} {rate:>7}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,521 @@
+import hashlib
+import os
+import pathlib
+import queue
+import re
+import threading
+import time
+import logging
+from collections import deque
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+
+import cv2
+import numpy as np
+from openvino import AsyncInferQueue, Core, Dimension, Layout, PartialShape, Tensor, Type, get_version
+from openvino.preprocess import PrePostProcessor
+
+from src import metrics
+
+logger = logging.getLogger(__name__)
+
+MODEL_PATH = pathlib.Path(__file__).parent.resolve().parent.joinpath('model/model_torch.xml')
+# Model files of the `model_variant` options, next to MODEL_PATH. The INT8 one is built by benchmarks.quantize.
+MODEL_VARIANTS = {'fp': 'model_torch.xml', 'int8': 'model_torch_int8.xml'}
+MODEL_CACHE_DIR = pathlib.Path(__file__).parent.resolve().parent.joinpath('model/cache')
+
+_resize_seconds = metrics.histogram('inference_resize_seconds', "Time to resize a frame into the model input.")
+_infer_seconds = metrics.histogram('inference_seconds',
+                                   "Time from submitting a frame to its result, waiting for a batch included.")
+_batch_size = metrics.histogram('inference_batch_size', "Frames per inference call.",
+                                buckets=(1, 2, 4, 8, 16, 32))
+_failovers = metrics.counter('inference_failovers_total', "Switches to the fallback device after inference errors.",
+                             ('device',))
+
+# Devices compared by `device: auto`, in order of preference when they are equally fast.
+AUTO_DEVICES = ('GPU', 'CPU')
+# Inferences timed per candidate device by `device: auto`, after one untimed warm-up inference.
+DEVICE_WARMUP_ITERATIONS = 5
+# An inference taking longer than this, in seconds, is considered failed (e.g. a hung GPU driver).
+INFERENCE_TIMEOUT = 10
+# How long a timed out inference may take to stop once cancelled, in seconds, before its infer request is replaced.
+CANCEL_TIMEOUT = 1
+
+
+class InferenceError(RuntimeError):
+    """Raised by the backends when an inference fails or times out on the device."""
+
+
+def _model_cache_path(cache_dir, model_xml_path, device, max_batch, properties=None):
+    """
+    Returns the path of the compiled blob for the model. The file name is keyed by the hash of the model files, the
+    device, the OpenVINO version, the batch shape and the compile properties, so any of them changing results in a
+    cache miss.
+    """
+    digest = hashlib.sha256()
+    for path in (model_xml_path, model_xml_path.with_suffix('.bin')):
+        if path.exists():
+            digest.update(path.read_bytes())
+    key = f"{digest.hexdigest()[:16]}-{device}-{get_version()}-b{max_batch or 1}-u8nhwc"
+    if properties:
+        key += '-' + hashlib.sha256(repr(sorted(properties.items())).encode()).hexdigest()[:8]
+    return pathlib.Path(cache_dir).joinpath(re.sub(r'[^\w.-]', '_', key) + '.blob')
+
+
+def _prepare_model(model, max_batch=None):
+    """
+    Builds the pre-processing into the model: the input becomes a u8 NHWC (BGR, as read by OpenCV) image and the
+    conversion to f32, normalization to [0, 1] and the NHWC -> NCHW layout change run as part of the graph.
+    If max_batch is given, the batch dimension of the model input is made dynamic in the range [1, max_batch].
+    """
+    if max_batch is not None:
+        _, channels, height, width = model.input(0).partial_shape
+        model.reshape({model.input(0): PartialShape([Dimension(1, max_batch), channels, height, width])})
+
+    ppp = PrePostProcessor(model)
+    ppp.input().tensor().set_element_type(Type.u8).set_layout(Layout('NHWC'))
+    ppp.input().preprocess().convert_element_type(Type.f32).scale(255.0)
+    ppp.input().model().set_layout(Layout('NCHW'))
+    return ppp.build()
+
+
+def load_compiled_model(model_path=None, device='GPU', max_batch=None, cache_dir=None, properties=None):
+    """
+    Reads, prepares (see _prepare_model) and compiles the OpenVINO model for the given device, with the given compile
+    properties (see performance_properties).
+    If cache_dir is given, the compiled model is imported from there when available and exported there otherwise, which
+    skips the (slow on GPU) kernel compilation on the next start.
+    """
+    model_xml_path = pathlib.Path(model_path or MODEL_PATH)
+
+    if not model_xml_path.exists():
+        logger.error(f"OpenVINO model not found at {model_xml_path}.")
+        raise FileNotFoundError(f"OpenVINO model files not found.")
+
+    core = Core()
+    start_time = time.perf_counter()
+
+    cache_path = None
+    if cache_dir is not None:
+        cache_path = _model_cache_path(cache_dir, model_xml_path, device, max_batch, properties)
+        if cache_path.exists():
+            try:
+                compiled_model = core.import_model(cache_path.read_bytes(), device, properties or {})
+                logger.info(f"Loaded compiled model from {cache_path} in {time.perf_counter() - start_time:.2f}s")
+                return compiled_model
+            except Exception:
+                logger.exception(f"Failed to import compiled model from {cache_path}. Compiling it again.")
+
+    logger.info(f"Loading OpenVINO model from {model_xml_path}")
+    model = _prepare_model(core.read_model(model_xml_path), max_batch)
+    compiled_model = core.compile_model(model, device, properties or {})
+    logger.info(f"Compiled model for {device} in {time.perf_counter() - start_time:.2f}s")
+
+    if cache_path is not None:
+        try:
+            cache_path.parent.mkdir(parents=True, exist_ok=True)
+            # Write to a temporary file first so a concurrent reader never sees a partial blob.
+            temporary_path = cache_path.with_suffix(f".{os.getpid()}.tmp")
+            temporary_path.write_bytes(compiled_model.export_model())
+            os.replace(temporary_path, cache_path)
+        except Exception:
+            logger.exception(f"Failed to store compiled model in {cache_path}.")
+
+    return compiled_model
+
+
+def _input_size(compiled_model):
+    """Returns the (height, width) of the NHWC model input, the batch dimension may be dynamic."""
+    _, input_height, input_width, _ = compiled_model.input(0).partial_shape
+    return input_height.get_length(), input_width.get_length()
+
+
+class InferenceBackend:
+    """
+    A single compiled model shared by all camera streams of the detector process.
+
+    Streams borrow an infer request from a fixed size pool, so they can run inference concurrently (OpenVINO releases
+    the GIL while inferring) without each stream holding its own compiled model and device context.
+    An inference not done within timeout seconds raises InferenceError, see _cancel for its infer request.
+    """
+
+    def __init__(self, compiled_model, pool_size=2, timeout=INFERENCE_TIMEOUT):
+        self._compiled_model = compiled_model
+        self._timeout_ms = int(timeout * 1000)
+        self._output_layer = compiled_model.output(0)
+        self._stuck_requests = []
+        self._requests = queue.Queue()
+        for _ in range(pool_size):
+            self._requests.put(compiled_model.create_infer_request())
+
+        # The model input is [1, H, W, 3] u8, see _prepare_model
+        self.input_height, self.input_width = _input_size(compiled_model)
+        self.output_shape = [dimension.get_length() for dimension in list(self._output_layer.partial_shape)[1:]]
+
+    def create_output_buffer(self):
+        """Allocates a [1, ...] output buffer that a stream can reuse for all of its inferences."""
+        return np.empty([1] + self.output_shape, dtype=np.float32)
+
+    def infer(self, frame, output):
+        """
+        Runs inference for a single BGR frame of any size and writes the [1, ...] result to the output buffer.
+        The frame is resized straight into the input tensor of the infer request, so no per-frame buffers are
+        allocated.
+        """
+        request = self._requests.get()
+        try:
+            start_time = time.perf_counter()
+            cv2.resize(frame, (self.input_width, self.input_height), dst=request.get_input_tensor().data[0])
+            resized_time = time.perf_counter()
+            request.start_async()
+            if not request.wait_for(self._timeout_ms):
+                request = self._cancel(request)
+                raise InferenceError(f"Inference did not finish in {self._timeout_ms} ms")
+            _resize_seconds.observe(resized_time - start_time)
+            _infer_seconds.observe(time.perf_counter() - resized_time)
+            _batch_size.observe(1)
+            # The output tensor is owned by the request, copy it before returning the request to the pool.
+            np.copyto(output, request.get_tensor(self._output_layer).data)
+            return output
+        finally:
+            self._requests.put(request)
+
+    def _cancel(self, request):
+        """
+        Cancels a timed out infer request and returns the request to put back in the pool: the same one once it stopped,
+        or a new one if it is still running after CANCEL_TIMEOUT, as a running request can't be started again. A stuck
+        request is kept referenced, releasing it would wait for the inference to finish.
+        """
+        request.cancel()
+        try:
+            if request.wait_for(int(CANCEL_TIMEOUT * 1000)):
+                return request
+        except RuntimeError:
+            # Waiting on a cancelled request raises, it can be started again.
+            return request
+        self._stuck_requests.append(request)
+        return self._compiled_model.create_infer_request()
+
+    def stats(self):
+        """The plain pool has no metrics of its own."""
+        return {}
+
+    def close(self):
+        pass
+
+
+class BatchingInferenceBackend:
+    """
+    Inference backend that groups frames from all streams into batches.
+
+    Streams submit single frames and wait for their own result. A scheduler thread collects pending frames until
+    either max_batch frames are queued or the oldest one has waited max_wait seconds, then submits them as one batch
+    through an AsyncInferQueue. The compiled model must have a dynamic batch dimension covering [1, max_batch].
+
+    Frames are resized in the calling thread into a per-thread staging buffer and copied into a batch buffer
+    preallocated for each infer request, so the steady state does not allocate frame-sized buffers.
+    """
+
+    def __init__(self, compiled_model, max_batch=4, max_wait=0.05, jobs=2, timeout=INFERENCE_TIMEOUT):
+        self._timeout = timeout
+        self.input_height, self.input_width = _input_size(compiled_model)
+        self.output_shape = [dimension.get_length() for dimension in list(compiled_model.output(0).partial_shape)[1:]]
+        self._max_batch = max_batch
+        self._max_wait = max_wait
+        self._pending = queue.Queue()
+        self._staging = threading.local()
+        self._infer_queue = AsyncInferQueue(compiled_model, jobs)
+        self._infer_queue.set_callback(self._on_batch_done)
+        self._batch_buffers = [np.empty((max_batch, self.input_height, self.input_width, 3), dtype=np.uint8)
+                               for _ in range(jobs)]
+
+        self._stats_lock = threading.Lock()
+        self._batches = 0
+        self._frames = 0
+        self._latencies = deque(maxlen=1000)
+
+        self._closed = threading.Event()
+        self._scheduler = threading.Thread(target=self._schedule, name='inference_scheduler', daemon=True)
+        self._scheduler.start()
+
+    def create_output_buffer(self):
+        """Allocates a [1, ...] output buffer that a stream can reuse for all of its inferences."""
+        return np.empty([1] + self.output_shape, dtype=np.float32)
+
+    def infer_async(self, frame, output):
+        """
+        Queues a single BGR frame of any size. Returns a Future resolved with the output buffer once the [1, ...]
+        result is written to it. The calling thread must not submit another frame before the Future is done, as the
+        staging buffer is reused.
+        """
+        staging_buffer = getattr(self._staging, 'buffer', None)
+        if staging_buffer is None:
+            staging_buffer = self._staging.buffer = np.empty((self.input_height, self.input_width, 3), dtype=np.uint8)
+        with _resize_seconds.time():
+            cv2.resize(frame, (self.input_width, self.input_height), dst=staging_buffer)
+
+        future = Future()
+        self._pending.put((staging_buffer, output, future, time.perf_counter()))
+        return future
+
+    def infer(self, frame, output):
+        """Runs inference for a single BGR frame of any size and writes the [1, ...] result to the output buffer."""
+        try:
+            return self.infer_async(frame, output).result(self._timeout)
+        except FutureTimeoutError:
+            raise InferenceError(f"Inference did not finish in {self._timeout} seconds") from None
+
+    def _collect_batch(self):
+        """Blocks for the first frame, then collects more until the batch is full or the latency budget is spent."""
+        try:
+            batch = [self._pending.get(timeout=0.5)]
+        except queue.Empty:
+            return []
+
+        deadline = batch[0][3] + self._max_wait
+        while len(batch) < self._max_batch:
+            remaining = deadline - time.perf_counter()
+            try:
+                batch.append(self._pending.get(timeout=remaining) if remaining > 0 else self._pending.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _schedule(self):
+        while not self._closed.is_set():
+            batch = self._collect_batch()
+            if not batch:
+                continue
+
+            try:
+                # Blocks while all infer requests are busy, meanwhile more frames are queued for the next batch.
+                request_id = self._infer_queue.get_idle_request_id()
+                batch_buffer = self._batch_buffers[request_id]
+                for i, (staging_buffer, _, _, _) in enumerate(batch):
+                    np.copyto(batch_buffer[i], staging_buffer)
+                self._infer_queue[request_id].set_input_tensor(Tensor(batch_buffer[:len(batch)], shared_memory=True))
+                # start_async picks the idle request found above, as this is the only thread submitting work.
+                self._infer_queue.start_async(None, batch)
+            except Exception as e:
+                for _, _, future, _ in batch:
+                    future.set_exception(e)
+
+    def _on_batch_done(self, request, batch):
+        try:
+            output = request.get_output_tensor(0).data
+            done_time = time.perf_counter()
+            for i, (_, output_buffer, future, _) in enumerate(batch):
+                np.copyto(output_buffer, output[i:i + 1])
+                future.set_result(output_buffer)
+            with self._stats_lock:
+                self._batches += 1
+                self._frames += len(batch)
+                self._latencies.extend(done_time - submit_time for _, _, _, submit_time in batch)
+            _batch_size.observe(len(batch))
+            for _, _, _, submit_time in batch:
+                _infer_seconds.observe(done_time - submit_time)
+        except Exception as e:
+            for _, _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+
+    def stats(self):
+        """Returns the scheduler metrics: queue depth, batch fill ratio and p99 latency (seconds)."""
+        with self._stats_lock:
+            batches = self._batches
+            frames = self._frames
+            latencies = sorted(self._latencies)
+        return {
+            'queue_depth': self._pending.qsize(),
+            'batches': batches,
+            'frames': frames,
+            'batch_fill_ratio': frames / (batches * self._max_batch) if batches else 0.0,
+            'latency_p99': latencies[int(len(latencies) * 0.99)] if latencies else 0.0,
+        }
+
+    def close(self):
+        self._closed.set()
+        self._scheduler.join()
+        self._infer_queue.wait_all()
+
+
+class FailoverInferenceBackend:
+    """
+    Runs inference on a primary backend and switches to a fallback one, created by fallback_factory on first use, when
+    an inference on the primary device fails or times out. The failed inference is retried on the fallback, so a GPU
+    driver fault costs a frame's latency instead of the detector process. The fallback is kept until the process
+    restarts.
+    """
+
+    def __init__(self, backend, fallback_factory, device, fallback_device):
+        self._backend = backend
+        self._fallback_factory = fallback_factory
+        self._device = device
+        self._fallback_device = fallback_device
+        self._primary = backend
+        self._lock = threading.Lock()
+        self._failovers = 0
+        self.input_height, self.input_width = backend.input_height, backend.input_width
+
+    def create_output_buffer(self):
+        return self._backend.create_output_buffer()
+
+    def infer(self, frame, output):
+        backend = self._backend
+        try:
+            return backend.infer(frame, output)
+        except Exception as e:
+            if backend is not self._primary:
+                # The fallback failed, there is nothing left to switch to.
+                raise
+            # Streams failing at the same time (e.g. on a hung GPU) all retry on the fallback, created once.
+            self._fail_over(backend, e)
+        return self._backend.infer(frame, output)
+
+    def _fail_over(self, failed_backend, error):
+        with self._lock:
+            if self._backend is not failed_backend:
+                # Another stream already switched while this inference was failing.
+                return
+            logger.error(f"Inference on {self._device} failed ({error}), switching to {self._fallback_device}.")
+            self._backend = self._fallback_factory()
+            self._failovers += 1
+            _failovers.labels(self._device).inc()
+        # Closing waits for the pending inferences, which never finish on a hung device.
+        threading.Thread(target=failed_backend.close, name='inference_close', daemon=True).start()
+
+    def stats(self):
+        """The stats of the current backend, and the number of failovers once there was one."""
+        stats = self._backend.stats()
+        if self._failovers:
+            stats['failovers'] = self._failovers
+        return stats
+
+    def close(self):
+        self._backend.close()
+
+
+def performance_properties(device, hint, streams=None, threads=None):
+    """
+    Returns the OpenVINO compile properties for the device: the LATENCY or THROUGHPUT performance hint and, if given,
+    the number of device streams and (on the CPU) inference threads.
+    """
+    properties = {'PERFORMANCE_HINT': hint}
+    if streams:
+        properties['NUM_STREAMS'] = str(streams)
+    if threads and device == 'CPU':
+        properties['INFERENCE_NUM_THREADS'] = str(threads)
+    return properties
+
+
+def _warmup_latency(compiled_model, iterations=DEVICE_WARMUP_ITERATIONS):
+    """Returns the median latency, in seconds, of iterations single-frame inferences after an untimed warm-up one."""
+    input_height, input_width = _input_size(compiled_model)
+    request = compiled_model.create_infer_request()
+    frame = np.zeros((1, input_height, input_width, 3), dtype=np.uint8)
+    request.infer({0: frame})
+    latencies = []
+    for _ in range(iterations):
+        start_time = time.perf_counter()
+        request.infer({0: frame})
+        latencies.append(time.perf_counter() - start_time)
+    return float(np.median(latencies))
+
+
+def select_device(devices, compile_model, benchmark=True, available_devices=None):
+    """
+    Compiles the model for the candidate devices with compile_model(device) and returns (device, compiled model).
+    Devices that are not present (see Core.available_devices) or fail to compile are skipped. With benchmark=True all
+    remaining candidates are timed with a few warm-up inferences and the fastest one wins, otherwise the first one that
+    compiles is used. Composite devices like AUTO:GPU,CPU are always considered present.
+    """
+    if available_devices is None:
+        available_devices = Core().available_devices
+    present = {device.split('.')[0] for device in available_devices}
+
+    candidates = []
+    for device in devices:
+        if ':' in device or device.split('.')[0] in present:
+            candidates.append(device)
+        else:
+            logger.info(f"Inference device {device} is not available, skipping it.")
+    # A single candidate has nothing to be compared with.
+    benchmark = benchmark and len(candidates) > 1
+
+    selected = None
+    for device in candidates:
+        try:
+            compiled_model = compile_model(device)
+        except FileNotFoundError:
+            # A missing model is not a device problem.
+            raise
+        except Exception as e:
+            logger.error(f"Failed to compile the model for {device}: {e}")
+            continue
+        if not benchmark:
+            return device, compiled_model
+
+        try:
+            latency = _warmup_latency(compiled_model)
+        except Exception as e:
+            logger.error(f"Warm-up inference on {device} failed: {e}")
+            continue
+        logger.info(f"Warm-up inference on {device} takes {latency * 1000:.1f} ms")
+        if selected is None or latency < selected[2]:
+            selected = (device, compiled_model, latency)
+
+    if selected is None:
+        raise InferenceError(f"The model could not be compiled for any of {', '.join(devices)}.")
+    return selected[0], selected[1]
+
+
+def create_inference_backend(config, model_path=None):
+    """
+    Creates the shared inference backend from the `issue_detector` configuration section. The model is the bundled
+    one or its `model_variant` (see MODEL_VARIANTS) unless model_path is given. Frames are batched across streams when
+    `batching` is configured.
+
+    With `device: auto` the model is compiled for every available device of AUTO_DEVICES and the one with the lowest
+    warm-up latency is used. An explicit device falls back to `fallback_device` (CPU by default) when it cannot be
+    compiled for, and at runtime when an inference on it fails. The performance hint is LATENCY for the pooled backend
+    and THROUGHPUT when batching, unless `performance_hint` is set.
+    """
+    device = config.get('device', 'auto')
+    fallback_device = config.get('fallback_device', 'CPU')
+    inference_requests = config.get('inference_requests', 2)
+    batching = config.get('batching')
+    cache_dir = config.get('model_cache_dir', MODEL_CACHE_DIR) if config.get('model_cache', True) else None
+    variant = config.get('model_variant', 'fp')
+    if variant not in MODEL_VARIANTS:
+        raise ValueError(f"Unknown model variant {variant!r}, expected one of {', '.join(MODEL_VARIANTS)}.")
+    if model_path is None and variant != 'fp':
+        model_path = MODEL_PATH.with_name(MODEL_VARIANTS[variant])
+    hint = config.get('performance_hint') or ('THROUGHPUT' if batching else 'LATENCY')
+    timeout = config.get('inference_timeout', INFERENCE_TIMEOUT)
+    max_batch = batching.get('max_batch', 4) if batching else None
+
+    def compile_model(device):
+        # Throughput needs a device stream per infer request to keep them all busy.
+        streams = config.get('inference_streams') or (inference_requests if hint == 'THROUGHPUT' else None)
+        properties = performance_properties(device, hint, streams, config.get('inference_threads'))
+        return load_compiled_model(model_path, device, max_batch=max_batch, cache_dir=cache_dir,
+                                   properties=properties)
+
+    def create_backend(compiled_model):
+        if batching:
+            return BatchingInferenceBackend(compiled_model, max_batch=max_batch,
+                                            max_wait=batching.get('max_wait_ms', 50) / 1000,
+                                            jobs=inference_requests, timeout=timeout)
+        return InferenceBackend(compiled_model, inference_requests, timeout=timeout)
+
+    if device == 'auto':
+        device, compiled_model = select_device(AUTO_DEVICES, compile_model)
+    else:
+        candidates = [device] + ([fallback_device] if fallback_device and fallback_device != device else [])
+        device, compiled_model = select_device(candidates, compile_model, benchmark=False)
+    logger.info(f"Running inference on {device} with the {hint} performance hint")
+
+    backend = create_backend(compiled_model)
+    if not fallback_device or device == fallback_device:
+        return backend
+    return FailoverInferenceBackend(backend, lambda: create_backend(compile_model(fallback_device)), device,
+                                    fallback_device)
@@ -1,281 +1,637 @@
-import pathlib
+import math
 import time
+import functools
 import cv2
-import os
+import queue
+import threading
 import multiprocessing
 import logging
 import numpy as np
-from openvino import Core, Layout
 
-from src.config import get_config
-from src.notifier import send_notification
+from src import metrics
+from src.config import ConfigError, get_config, get_printers, set_config
+from src.frame_source import create_frame_source
+from src.inference import create_inference_backend
+from src.detection_tracker import create_detection_tracker
+from src.rate_controller import create_rate_controller
+from src.region_planner import create_region_planner
+from src.frame_history import create_frame_history, flush_contact_sheets
+from src.history_store import close_history_store, get_history_store
+from src.notifier import send_notification, flush_notifications, format_printer_message, notification_stats
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-CONFIDENCE_THRESHOLDS = get_config()['issue_detector']['confidence_thresholds']
 MODEL_CLASS_NAMES = {
     0: 'error',
     1: 'extrusor',
     2: 'part',
     3: 'spaghetti'
 }
-DETECTION_AREA_OF_INTEREST = get_config()['issue_detector']['detection_area_of_interest']
+# How often the inference backend and capture metrics are logged, in seconds.
+INFERENCE_STATS_INTERVAL = 60
+# Delay before restarting a stream thread that failed, doubled while it keeps failing, in seconds.
+STREAM_RESTART_INITIAL_DELAY = 1
+STREAM_RESTART_MAX_DELAY = 60
+# The `issue_detector` settings of the stream components, which are recreated when the configuration is reloaded.
+STREAM_COMPONENT_FACTORIES = {
+    'adaptive_rate': ('rate_controller', create_rate_controller),
+    'tracking': ('tracker', create_detection_tracker),
+    'crop_to_area_of_interest': ('region_planner', create_region_planner),
+    'frame_history': ('frame_history', create_frame_history),
+}
+# The `issue_detector` settings applied to the running process when the configuration is reloaded. The other ones (the
+# device, model, batching, ...) need a new compiled model and take effect when the process is started again.
+RELOADABLE_SETTINGS = {'stream_url', 'decoder', 'confidence_thresholds', 'detection_area_of_interest', 'keep_warm',
+                       *STREAM_COMPONENT_FACTORIES}
+
+_postprocess_seconds = metrics.histogram('postprocess_seconds', "Time to post-process the model output of a frame.",
+                                         ('printer',))
+_encode_seconds = metrics.histogram('notification_encode_seconds', "Time to JPEG-encode an annotated frame.")
+_inferred_frames = metrics.counter('frames_inferred_total', "Frames run through the model.", ('printer',))
+_skipped_frames = metrics.counter('frames_skipped_total', "Frames skipped by the rate controller.", ('printer',))
+_detections = metrics.counter('detections_total', "Detections passing the thresholds.", ('printer', 'class'))
+_reported_detections = metrics.counter('reported_detections_total', "Detections reported by the tracker.",
+                                       ('printer', 'class'))
+
+def _build_class_thresholds(confidence_thresholds, num_classes):
+    """
+    Builds a per-class-id threshold vector from the configured confidence thresholds. Classes without an explicit
+    threshold (and unknown class ids) get 1.0, which effectively filters them out.
+
+    float32 is used to match the dtype of the model output, so the vectorized comparison behaves exactly as the
+    per-row scalar comparison did.
+    """
+    thresholds = np.ones(num_classes, dtype=np.float32)
+    for class_id in range(num_classes):
+        class_name = MODEL_CLASS_NAMES.get(class_id, f"unknown_class_{class_id}")
+        thresholds[class_id] = confidence_thresholds.get(class_name, 1.0)
+    return thresholds
+
+
+_class_thresholds = {}
+
+
+def _get_class_thresholds(confidence_thresholds, num_classes):
+    """Returns the cached per-class threshold vector, building it on first use."""
+    key = (frozenset(confidence_thresholds.items()), num_classes)
+    thresholds = _class_thresholds.get(key)
+    if thresholds is None:
+        thresholds = _class_thresholds[key] = _build_class_thresholds(confidence_thresholds, num_classes)
+    return thresholds
+
+
+def _pre_process_detection_results(detection_results, original_width, original_height, input_width, input_height,
+                                   confidence_thresholds=None, area_of_interest=None):
+    """Post-processes the model output for a whole frame, see _pre_process_region_results."""
+    return _pre_process_region_results([detection_results], [(0, 0, original_width, original_height)], input_width,
+                                       input_height, confidence_thresholds, area_of_interest)
+
 
-def _pre_process_detection_results(detection_results, original_width, original_height, input_width, input_height):
+def _pre_process_region_results(region_results, regions, input_width, input_height, confidence_thresholds=None,
+                                area_of_interest=None, edge_margin=0):
     """
     1. Process detections and apply the thresholds.
     2. Apply non-maximum suppression.
     3. Provide a list of {class name, confidence and bounding box} for the detections.
     4. Filter detections based on the pre-defined detection area of interest.
+
+    region_results holds the model output for each of the regions (x_min, y_min, x_max, y_max) of the frame that were
+    inferred (see RegionPlanner), the boxes are mapped back to frame coordinates and suppressed across regions, so
+    an object in the overlap of two tiles is reported once. Detections less than edge_margin pixels from the edges of
+    the area of interest are logged at debug level.
+
+    The thresholds and the area of interest default to the ones in the `issue_detector` configuration section. Without
+    an area of interest there as well, detections anywhere in the frame are kept.
+
+    Steps 1 and the box conversion are done as whole-array operations over the raw model output, so only the few
+    rows passing the thresholds are ever touched from Python.
     """
+    if confidence_thresholds is None:
+        confidence_thresholds = get_config()['issue_detector']['confidence_thresholds']
+
     boxes = []
     confidences = []
     class_ids = []
-
-    # Loop through detections
-    for detection in detection_results:
+    for detection_results, (region_x_min, region_y_min, region_x_max, region_y_max) in zip(region_results, regions):
         #  Each detection is an array of numbers. The numbers specify the location of the object and the
         #  confidence scores for each detected object:
         # (center_x, center_y, w, h, objectness_score, class_0_score, class_1_score, class_2_score, ...)
         # Score for "spaghetti" would be class_3_score * objectness_score.
+        detection_results = np.asarray(detection_results)
 
-        # 1. Extract detection data.
-        center_x, center_y, w, h = detection[0:4]
-        objectness_score = detection[4]
-        class_confidences = detection[5:]
+        # 1. Determine the class ID and its confidence for every detection.
+        class_confidences = detection_results[:, 5:]
+        region_class_ids = np.argmax(class_confidences, axis=1)
+        max_class_confidences = np.take_along_axis(class_confidences, region_class_ids[:, None], axis=1)[:, 0]
 
-        # Determine the class ID and its confidence
-        class_id_raw = np.argmax(class_confidences)
-        max_class_confidence = class_confidences[class_id_raw]
+        # 2. Combine objectness and class confidence and check it against the per-class thresholds.
+        region_confidences = detection_results[:, 4] * max_class_confidences
+        thresholds = _get_class_thresholds(confidence_thresholds, class_confidences.shape[1])
+        passing = ~(region_confidences < thresholds[region_class_ids])
 
-        # 2. Check if this is object of interest and is it passing the confidence thresholds
-
-        # Combine objectness and class confidence for the final confidence score
-        confidence = objectness_score * max_class_confidence
-        class_name = MODEL_CLASS_NAMES.get(class_id_raw, f"unknown_class_{class_id_raw}")
-
-        # Confidence score as specified or 1 to filter out objects we don't care about.
-        threshold = CONFIDENCE_THRESHOLDS.get(class_name, 1.0)
-
-        if confidence < threshold:
-            # Not passing the thresholds, ignore.
-            continue
+        candidates = detection_results[passing]
+        class_ids.append(region_class_ids[passing])
+        confidences.append(region_confidences[passing])
 
         # 3. Convert detection coordinates to image coordinates.
-        x_min = int((center_x - w / 2) * original_width / input_width)
-        y_min = int((center_y - h / 2) * original_height / input_height)
-        x_max = int((center_x + w / 2) * original_width / input_width)
-        y_max = int((center_y + h / 2) * original_height / input_height)
-
-        # 4. Store detection for next steps.
-        boxes.append([x_min, y_min, x_max, y_max])
-        confidences.append(float(confidence))
-        class_ids.append(class_id_raw)
+        region_width = region_x_max - region_x_min
+        region_height = region_y_max - region_y_min
+        center_x, center_y, w, h = candidates[:, 0], candidates[:, 1], candidates[:, 2], candidates[:, 3]
+        boxes.append(np.stack([
+            region_x_min + (center_x - w / 2) * region_width / input_width,
+            region_y_min + (center_y - h / 2) * region_height / input_height,
+            region_x_min + (center_x + w / 2) * region_width / input_width,
+            region_y_min + (center_y + h / 2) * region_height / input_height,
+        ], axis=1).astype(np.int64))
+
+    boxes = np.concatenate(boxes)
+    confidences = np.concatenate(confidences)
+    class_ids = np.concatenate(class_ids)
+
+    # 4. Check which detections are in the area of interest.
+    if area_of_interest is None:
+        area_of_interest = get_config()['issue_detector'].get('detection_area_of_interest')
+    aoi_x_min, aoi_y_min, aoi_x_max, aoi_y_max = area_of_interest or (-np.inf, -np.inf, np.inf, np.inf)
+    centers_x = (boxes[:, 0] + boxes[:, 2]) / 2
+    centers_y = (boxes[:, 1] + boxes[:, 3]) / 2
+    in_area_of_interest = ((aoi_x_min <= centers_x) & (centers_x <= aoi_x_max) &
+                           (aoi_y_min <= centers_y) & (centers_y <= aoi_y_max))
 
     # 5. Apply Non-Maximum Suppression
     NMS_IOU_THRESHOLD = 0.4
     NMS_SCORE_THRESHOLD = 0  # The confidence score criteria was already applied
 
+    boxes = boxes.tolist()
+    confidences = confidences.tolist()
     indices = cv2.dnn.NMSBoxes(boxes, confidences, NMS_SCORE_THRESHOLD, NMS_IOU_THRESHOLD)
 
-    filtered_detections = []
+    # 6. Filter out detection that are not in the area of interest. The mask is applied only after NMS so that
+    # detections outside the area still take part in the suppression, and to enable logging for filtered out
+    # detections.
+    detections_of_interest = []
     if len(indices) > 0:
         for i in indices.flatten():
-            class_id_retained = class_ids[i]
-            confidence_retained = confidences[i]
-            class_name_retained = MODEL_CLASS_NAMES.get(class_id_retained)
-
-            filtered_detections.append({
-                "name": class_name_retained,
-                "confidence": confidence_retained,
+            detection = {
+                "name": MODEL_CLASS_NAMES.get(int(class_ids[i])),
+                "confidence": confidences[i],
                 "box": boxes[i]
-            })
+            }
+            center = (float(centers_x[i]), float(centers_y[i]))
+            if in_area_of_interest[i]:
+                detections_of_interest.append(detection)
+                edge_distance = min(center[0] - aoi_x_min, aoi_x_max - center[0],
+                                    center[1] - aoi_y_min, aoi_y_max - center[1])
+                if edge_distance < edge_margin:
+                    logger.debug(f"{detection['name']} detection at {center} is {edge_distance:.0f}px inside the "
+                                 f"area of interest edge")
+            else:
+                logger.info(f"Skipping {detection['name']} detection at {center}")
+
+    return detections_of_interest
+
+
+def _max_class_confidences(*region_results):
+    """Returns {class name: highest objectness * class score} over all detections, thresholds not applied."""
+    scores = np.concatenate([detection_results[:, 4:5] * detection_results[:, 5:]
+                             for detection_results in region_results])
+    return {MODEL_CLASS_NAMES.get(class_id, f"unknown_class_{class_id}"): float(score)
+            for class_id, score in enumerate(scores.max(axis=0))}
+
+
+def _infer_regions(backend, frame, regions, output_buffers):
+    """
+    Runs inference on each region (x_min, y_min, x_max, y_max) of the frame. The regions are resized straight from
+    the frame into the model input, without copying the crops. Returns the model output of each region, written to
+    output_buffers, which is extended with new buffers when there are more regions than buffers.
+    """
+    while len(output_buffers) < len(regions):
+        output_buffers.append(backend.create_output_buffer())
+    return [backend.infer(frame[y_min:y_max, x_min:x_max], output_buffer)[0]
+            for (x_min, y_min, x_max, y_max), output_buffer in zip(regions, output_buffers)]
 
-    # 6. Filter out detection that are not in the area of interest. Not the optimal approach if done last, but enables
-    # logging for filtered out detections.
-    detections_of_interest = []
-    aoi_x_min, aoi_y_min, aoi_x_max, aoi_y_max = DETECTION_AREA_OF_INTEREST
 
-    for detection in filtered_detections:
+def _annotate_detections(frame, detections):
+    """Draws the boxes and labels of the detections on the frame in place. Returns a message for each detection."""
+    original_height, original_width = frame.shape[:2]
+    detection_messages = []
+
+    for detection in detections:
+        class_name = detection['name']
+        confidence = detection['confidence']
         x_min, y_min, x_max, y_max = detection['box']
-        detection_center_x = (x_min + x_max) / 2
-        detection_center_y = (y_min + y_max) / 2
 
-        if aoi_x_min <= detection_center_x <= aoi_x_max and aoi_y_min <= detection_center_y <= aoi_y_max:
-            detections_of_interest.append(detection)
-        else:
-            logger.info(f"Skipping {detection['name']} detection at {(detection_center_x, detection_center_y)}")
+        # Draw rectangle
+        color = (0, 255, 0) # Green color for bounding box
+        cv2.rectangle(frame, (x_min, y_min), (x_max, y_max), color, 2)
 
-    return detections_of_interest
+        # Prepare text for class name and confidence
+        text = f"{class_name} {confidence:.2f}"
+        font = cv2.FONT_HERSHEY_SIMPLEX
+        font_scale = 0.7
+        font_thickness = 2
+        text_size = cv2.getTextSize(text, font, font_scale, font_thickness)[0]
+
+        # Position text below the bounding box
+        text_x = x_min
+        text_y = y_max + text_size[1] + 5 # 5 pixels padding below the box
+
+        # Ensure text is within frame bounds
+        if text_y > original_height:
+            text_y = y_min - 5 # If it goes off screen, place above the box
+            if text_y < 0:
+                text_y = y_min + text_size[1] + 5 # Fallback if above also goes off
 
+        if text_x + text_size[0] > original_width:
+            text_x = original_width - text_size[0]
 
-def _detect_issues_process(terminate_event: multiprocessing.Event):
+        cv2.putText(frame, text, (text_x, text_y), font, font_scale, color, font_thickness)
+        detection_messages.append(f"'{class_name}' with confidence {confidence:.2f}")
+
+    return detection_messages
+
+
+def _send_detection_notification(printer, annotated_frame, detection_messages, notify=None):
     """
-    Worker function for the issue detection process.
-    It manages the video stream, captures frames, runs inference, and sends notifications directly.
-    The process runs continuously until a terminate_event is set.
+    Sends the detection messages with the annotated frame attached, through send_notification unless another notify
+    function is given. Returns whether the notification was sent.
     """
-    config = get_config()['issue_detector']
+    log_prefix = f"[{printer['name']}] " if printer['name'] else ""
+    summary_message = "Detected issues: " + ", ".join(detection_messages)
+    logger.info(f"{log_prefix}{summary_message}")
+
+    # Encode annotated frame to JPEG bytes
+    with _encode_seconds.time():
+        ret, buffer = cv2.imencode('.jpg', annotated_frame)
+    if not ret:
+        logger.error("Failed to encode annotated image to JPEG.")
+        return False
+
+    (notify or send_notification)(format_printer_message(printer, summary_message), image=buffer.tobytes())
+    return True
 
-    stream_url = config['stream_url']
 
-    model_xml_path = pathlib.Path(__file__).parent.resolve().parent.joinpath('model/model_torch.xml')
+def _send_contact_sheet(printer, contact_sheet):
+    send_notification(format_printer_message(printer, "Frames before and after the detected issues"),
+                      image=contact_sheet)
+
+
+def _scale_area_of_interest(area_of_interest, scale):
+    """
+    The area of interest, configured in camera pixels, in the whole pixels of frames decoded at 1/scale of the size.
+    It is rounded outwards, so it still covers all of the configured area.
+    """
+    if area_of_interest is None or scale == 1:
+        return area_of_interest
+    x_min, y_min, x_max, y_max = area_of_interest
+    return [math.floor(x_min / scale), math.floor(y_min / scale), math.ceil(x_max / scale), math.ceil(y_max / scale)]
+
+
+def _detect_issues_in_stream(printer, backend, rate_controller, tracker, region_planner, stop_event, updates=None,
+                             frame_history=None):
+    """
+    Monitors the video stream of a single printer until the stop_event is set.
+    It captures frames, runs inference on the shared backend, and sends notifications directly. The rate_controller
+    decides how often frames are checked and which of them are inferred, the tracker which detections are reported and
+    the region_planner which parts of a frame are inferred. The frame_history, if given, keeps the recent frames and
+    sends the contact sheet of the frames around a reported detection as a follow-up notification. Every inference is
+    recorded in the print history, if enabled.
+    Configuration changes are received over the updates queue as dicts with the printer and, if their settings changed,
+    new stream components (see _apply_config_change). They are applied between two frames, without reconnecting.
+    """
+    stream_url = printer['stream_url']
+    confidence_thresholds = printer['confidence_thresholds']
+    log_prefix = f"[{printer['name']}] " if printer['name'] else ""
 
-    if not model_xml_path.exists():
-        logger.error(f"OpenVINO model not found at {model_xml_path}.")
-        raise FileNotFoundError(f"OpenVINO model files not found.")
+    input_width = backend.input_width
+    input_height = backend.input_height
+    output_buffers = []
 
-    logger.info(f"Loading OpenVINO model from {model_xml_path}")
-    core = Core()
-    model = core.read_model(model_xml_path)
-    compiled_model = core.compile_model(model, "GPU")
+    stream_start_time = time.time()
+    first_inference_done = False
 
-    # Assuming model input name and shape
-    input_layer = compiled_model.input(0)
-    output_layer = compiled_model.output(0)
+    metric_label = printer['name'] or ''
+    postprocess_seconds = _postprocess_seconds.labels(metric_label)
+    inferred_frames = _inferred_frames.labels(metric_label)
+    skipped_frames = _skipped_frames.labels(metric_label)
+    history = get_history_store()
 
-    # Get input shape and resize accordingly
-    # OpenVINO model input shape is usually [1, 3, H, W] for NCHW layout
-    _, _, input_height, input_width = input_layer.shape
+    frame_source = None
+    last_frame_time = None
+    last_stats_time = stream_start_time
 
-    cap = None
-    # Inference reduced to 1 per second to reduce CPU load.
-    last_inference_time = 0
+    # Inference rate limited by the rate controller (by default 1 per second) to reduce CPU load.
+    last_check_time = 0
 
-    # Issues reported once per 60 seconds to avoid constant spam.
+    # Stream failures reported once per 60 seconds to avoid constant spam.
     last_issue_reported_time = 0
 
     try:
-        while not terminate_event.is_set():
+        frame_source = create_frame_source(stream_url, printer['name'], printer.get('decoder'))
+        frame_source.start()
+        area_of_interest = _scale_area_of_interest(printer['detection_area_of_interest'], frame_source.scale)
+
+        while not stop_event.is_set():
+            while updates is not None and not updates.empty():
+                update = updates.get_nowait()
+                printer = update['printer']
+                confidence_thresholds = printer['confidence_thresholds']
+                area_of_interest = _scale_area_of_interest(printer['detection_area_of_interest'], frame_source.scale)
+                rate_controller = update.get('rate_controller', rate_controller)
+                tracker = update.get('tracker', tracker)
+                region_planner = update.get('region_planner', region_planner)
+                if 'frame_history' in update:
+                    if frame_history is not None:
+                        frame_history.close()
+                    frame_history = update['frame_history']
+                logger.info(f"{log_prefix}Applied the configuration change")
+
             current_time = time.time()
-            # Open camera if not already open or if it was closed
-            if cap is None or not cap.isOpened():
-                os.environ['OPENCV_FFMPEG_LOGLEVEL'] = 'quiet'
-                cap = cv2.VideoCapture(stream_url)
-                if not cap.isOpened():
-                    logger.error(f"Could not open video stream from {stream_url}. Retrying in 5 seconds...")
-                    if current_time - last_issue_reported_time >= 600:
-                        send_notification("Failed to open video stream")
-                        last_issue_reported_time = current_time
-                    time.sleep(5) # Wait before retrying
-                    continue # Skip to next loop iteration
-
-            ret, frame = cap.read()
-
-            if not ret:
-                logger.error("Failed to read frame from stream. Reconnecting in 5 seconds...")
-                if current_time - last_issue_reported_time >= 60:
-                    send_notification("Failed to read from video stream")
-                    last_issue_reported_time = current_time
-                if cap is not None and cap.isOpened():
-                    cap.release()
-                cap = None # Reset cap to force re-opening
-                time.sleep(5)
+            # The frame source reconnects on its own, only report the failures.
+            if frame_source.error == 'open' and current_time - last_issue_reported_time >= 600:
+                send_notification(format_printer_message(printer, "Failed to open video stream"))
+                last_issue_reported_time = current_time
+            elif frame_source.error == 'read' and current_time - last_issue_reported_time >= 60:
+                send_notification(format_printer_message(printer, "Failed to read from video stream"))
+                last_issue_reported_time = current_time
+
+            if current_time - last_stats_time >= INFERENCE_STATS_INTERVAL:
+                stats = frame_source.stats()
+                stats.update(rate_controller.stats())
+                if frame_history is not None:
+                    stats.update(frame_history.stats())
+                logger.info(f"{log_prefix}Capture stats: " +
+                            ", ".join(f"{key}={value:.3g}" for key, value in stats.items()))
+                last_stats_time = current_time
+
+            if current_time - last_check_time < rate_controller.interval(current_time):
+                stop_event.wait(0.1)
+                continue
+
+            frame, frame_time = frame_source.latest()
+            if frame is None or frame_time == last_frame_time:
+                # Nothing new was captured since the last inference.
+                stop_event.wait(0.1)
+                continue
+
+            last_check_time = current_time
+            last_frame_time = frame_time
+            if frame_history is not None:
+                frame_history.add(frame, frame_time)
+            if not rate_controller.should_infer(frame, current_time):
+                skipped_frames.inc()
                 continue
 
-            if current_time - last_inference_time >= 1: # Process frame every second
-                # Pre-process frame for OpenVINO model
-                # 1. Resize to model input size (input_width, input_height)
-                resized_frame = cv2.resize(frame, (input_width, input_height))
+            # 1. Resize the frame (or its regions of interest) straight into the model input and perform inference
+            # using the shared OpenVINO backend. The layout change and normalization are part of the model graph, see
+            # _prepare_model.
+            original_height, original_width = frame.shape[:2]
+            regions = region_planner.regions(original_width, original_height, area_of_interest, input_width,
+                                             input_height)
+            inference_start = time.perf_counter()
+            region_results = _infer_regions(backend, frame, regions, output_buffers)
+            inference_seconds = time.perf_counter() - inference_start
+            inferred_frames.inc()
+            if not first_inference_done:
+                logger.info(f"{log_prefix}Time to first inference: {time.time() - stream_start_time:.2f}s")
+                first_inference_done = True
+
+            # 2. Pre-process detection results
+            postprocess_start = time.perf_counter()
+            # A printer without an area of interest keeps the detections in the whole frame, rather than falling back
+            # to the one of the `issue_detector` section.
+            frame_area_of_interest = area_of_interest or [0, 0, original_width, original_height]
+            filtered_detections = _pre_process_region_results(region_results, regions, input_width, input_height,
+                                                              confidence_thresholds, frame_area_of_interest,
+                                                              region_planner.margin if region_planner.crop else 0)
+            postprocess_duration = time.perf_counter() - postprocess_start
+            postprocess_seconds.observe(postprocess_duration)
+            for detection in filtered_detections:
+                _detections.labels(metric_label, detection['name']).inc()
+            rate_controller.update(_max_class_confidences(*region_results), confidence_thresholds, current_time)
+
+            # Only issues that persisted over several frames, or grew since they were reported, are sent.
+            reported_detections = tracker.update(filtered_detections)
+            if reported_detections:
+                # The frame buffer is reused for the next capture, copy it before drawing.
+                annotated_frame = frame.copy()
+                detection_messages = _annotate_detections(annotated_frame, reported_detections)
+                _send_detection_notification(printer, annotated_frame, detection_messages)
+                for detection in reported_detections:
+                    _reported_detections.labels(metric_label, detection['name']).inc()
+                if frame_history is not None:
+                    frame_history.trigger(frame_time, functools.partial(_send_contact_sheet, printer))
+            if history is not None:
+                history.record_inference(metric_label, current_time, inference_seconds, postprocess_duration,
+                                         filtered_detections, reported_detections)
 
-                # 2. Convert HWC to CHW (channels first)
-                input_frame = resized_frame.transpose((2, 0, 1))
+    except Exception as e:
+        logger.exception(f"{log_prefix}An unexpected error occurred: {e}")
+    finally:
+        if frame_source is not None:
+            frame_source.stop()
+        if frame_history is not None:
+            frame_history.close()
 
-                # 3. Add batch dimension
-                input_frame = input_frame[None, :, :, :]
 
-                # 4. Normalize pixel values to [0, 1] and convert to float32
-                input_frame = input_frame.astype(float) / 255.0
+def _run_stream(printer, backend, config, stop_event, updates):
+    """
+    Creates the stream components from the `issue_detector` configuration section and monitors the stream. They are
+    created on the stream thread, so settings a component rejects only end this stream, which is then restarted like
+    any failed one (see _restart_failed_streams).
+    """
+    try:
+        rate_controller = create_rate_controller(config)
+        tracker = create_detection_tracker(config)
+        region_planner = create_region_planner(config)
+        frame_history = create_frame_history(config)
+    except Exception as e:
+        logger.exception(format_printer_message(printer, f"Failed to create the stream components: {e}"))
+        return
+    _detect_issues_in_stream(printer, backend, rate_controller, tracker, region_planner, stop_event, updates,
+                             frame_history=frame_history)
 
-                # 5. Perform inference using OpenVINO compiled model
-                results_ov = compiled_model([input_frame])[output_layer]
 
-                # 6. Pre-process detection results
-                original_height, original_width = frame.shape[:2]
-                filtered_detections = _pre_process_detection_results(results_ov[0], original_width, original_height, input_width, input_height)
+def _start_stream(printer, backend, config):
+    """Starts the stream monitoring thread of a printer. Returns the thread, its stop event and its updates queue."""
+    stop_event = threading.Event()
+    updates = queue.Queue()
+    thread = threading.Thread(target=_run_stream, args=(printer, backend, config, stop_event, updates),
+                              name=f"stream_{printer['name']}", daemon=True)
+    thread.start()
+    return thread, stop_event, updates
 
-                annotated_frame = frame.copy()
 
-                detection_messages = []
+def _stop_stream(stream_worker):
+    thread, stop_event, _ = stream_worker
+    stop_event.set()
+    thread.join()
 
-                for detection in filtered_detections:
-                    class_name = detection['name']
-                    confidence = detection['confidence']
-                    x_min, y_min, x_max, y_max = detection['box']
 
-                    # Draw rectangle
-                    color = (0, 255, 0) # Green color for bounding box
-                    cv2.rectangle(annotated_frame, (x_min, y_min), (x_max, y_max), color, 2)
+def _restart_failed_streams(stream_workers, printers_by_name, backend, config, failed_streams):
+    """
+    Restarts the streams whose thread ended on an error (without its stop event set). The restart delay starts at
+    STREAM_RESTART_INITIAL_DELAY and doubles, up to STREAM_RESTART_MAX_DELAY, while a stream fails again within
+    STREAM_RESTART_MAX_DELAY of its restart. The first failure of a stream is notified, the repeated ones are logged.
+    failed_streams maps the printer names to their (restart delay, restart time, start time) and is updated in place.
+    """
+    current_time = time.time()
+    for name, (thread, stop_event, _) in list(stream_workers.items()):
+        delay, restart_time, start_time = failed_streams.get(name, (0, None, None))
+        if thread.is_alive() or stop_event.is_set():
+            if start_time is not None and current_time - start_time >= STREAM_RESTART_MAX_DELAY:
+                del failed_streams[name]
+            continue
 
-                    # Prepare text for class name and confidence
-                    text = f"{class_name} {confidence:.2f}"
-                    font = cv2.FONT_HERSHEY_SIMPLEX
-                    font_scale = 0.7
-                    font_thickness = 2
-                    text_size = cv2.getTextSize(text, font, font_scale, font_thickness)[0]
+        printer = printers_by_name[name]
+        if restart_time is None:
+            delay = min(max(delay * 2, STREAM_RESTART_INITIAL_DELAY), STREAM_RESTART_MAX_DELAY)
+            message = f"Issue detection stopped on an error, restarting it in {delay} seconds"
+            logger.error(format_printer_message(printer, message))
+            if delay == STREAM_RESTART_INITIAL_DELAY:
+                send_notification(format_printer_message(printer, message))
+            failed_streams[name] = (delay, current_time + delay, None)
+        elif current_time >= restart_time:
+            stream_workers[name] = _start_stream(printer, backend, config)
+            failed_streams[name] = (delay, None, current_time)
 
-                    # Position text below the bounding box
-                    text_x = x_min
-                    text_y = y_max + text_size[1] + 5 # 5 pixels padding below the box
 
-                    # Ensure text is within frame bounds
-                    if text_y > original_height:
-                        text_y = y_min - 5 # If it goes off screen, place above the box
-                        if text_y < 0:
-                            text_y = y_min + text_size[1] + 5 # Fallback if above also goes off
+def _apply_config_change(new_config, config, printers_by_name, stream_workers, backend):
+    """
+    Applies a reloaded configuration to the running streams, without recompiling the model. The thresholds, area of
+    interest and the stream components whose settings changed are handed to the streams, a stream whose URL or decoder
+    changed is reconnected. Raises, leaving everything as it was, if the configuration is invalid (ConfigError) or a
+    stream component can't be created from it.
+    Returns the new `issue_detector` configuration section and printers.
+    """
+    new_detector_config = new_config.get('issue_detector', {})
+    changed = {key for key in config.keys() | new_detector_config.keys()
+               if config.get(key) != new_detector_config.get(key)}
+    # The printers are watched by the monitor from its start, removed ones keep their settings until it restarts.
+    new_printers = {printer['name']: printer for printer in get_printers(new_config)}
+    new_printers_by_name = {name: new_printers.get(name, printer) for name, printer in printers_by_name.items()}
+
+    # Everything that can fail is done before anything is changed.
+    updates = {}
+    for name in stream_workers:
+        if all(new_printers_by_name[name].get(key) == printers_by_name[name].get(key)
+               for key in ('stream_url', 'decoder')):
+            updates[name] = {'printer': new_printers_by_name[name]}
+            for key, (component, factory) in STREAM_COMPONENT_FACTORIES.items():
+                if key in changed:
+                    updates[name][component] = factory(new_detector_config)
+    set_config(new_config)
+
+    for name, stream_worker in list(stream_workers.items()):
+        if name in updates:
+            stream_worker[2].put(updates[name])
+        else:
+            _stop_stream(stream_worker)
+            stream_workers[name] = _start_stream(new_printers_by_name[name], backend, new_detector_config)
+    if changed - RELOADABLE_SETTINGS:
+        logger.warning(f"Changes of {', '.join(sorted(changed - RELOADABLE_SETTINGS))} take effect when the issue "
+                       f"detector is started again.")
+    logger.info("Applied the reloaded configuration")
+    return new_detector_config, new_printers_by_name
 
-                    if text_x + text_size[0] > original_width:
-                        text_x = original_width - text_size[0]
 
-                    cv2.putText(annotated_frame, text, (text_x, text_y), font, font_scale, color, font_thickness)
-                    detection_messages.append(f"'{class_name}' with confidence {confidence:.2f}")
+def _detect_issues_process(terminate_event: multiprocessing.Event, control_queue, printers, metrics_queue=None):
+    """
+    Worker function for the issue detection process.
+    It loads the model once and runs one stream monitoring thread per printer that is currently printing, all of them
+    sharing the same inference backend. The set of printing printers is received over the control_queue as
+    ('active', {printer names}) messages. An empty set pauses all streams while keeping the model loaded.
+    ('config', config) messages carry a reloaded configuration, see _apply_config_change. A stream thread that fails is
+    restarted, see _restart_failed_streams.
+    The metrics of the process are sent to the monitor over the metrics_queue, if given.
+    The process runs continuously until a terminate_event is set.
+    """
+    start_time = time.time()
+    metrics_config = get_config().get('metrics') or {}
+    if metrics_config.get('profile_dir'):
+        metrics.install_profiler_signal(metrics_config['profile_dir'], metrics_config.get('profile_seconds', 10))
+    metrics_stop_event = threading.Event()
+    metrics_exporter = None
+    if metrics_queue is not None:
+        metrics_exporter = metrics.start_exporter(metrics_queue, 'detector', metrics_stop_event)
 
-                if detection_messages and current_time - last_issue_reported_time >= 900:  # Limit to 1 message per 15 minutes.
-                    summary_message = "Detected issues: " + ", ".join(detection_messages)
-                    logger.info(f"{summary_message}")
+    config = get_config()['issue_detector']
+    backend = create_inference_backend(config)
+    logger.info(f"Issue detector ready in {time.time() - start_time:.2f}s")
 
-                    # Encode annotated frame to JPEG bytes
-                    ret, buffer = cv2.imencode('.jpg', annotated_frame)
-                    if ret:
-                        image_bytes = buffer.tobytes()
-                        send_notification(summary_message, image=image_bytes)
-                        last_issue_reported_time = current_time
-                    else:
-                        logger.error("Failed to encode annotated image to JPEG.")
+    printers_by_name = {printer['name']: printer for printer in printers}
+    stream_workers = {}
+    failed_streams = {}
+    last_stats_time = time.time()
 
-                last_inference_time = current_time
+    try:
+        while not terminate_event.is_set():
+            if time.time() - last_stats_time >= INFERENCE_STATS_INTERVAL:
+                stats = backend.stats()
+                if stats:
+                    logger.info("Inference stats: " + ", ".join(f"{key}={value:.3g}" for key, value in stats.items()))
+                stats = notification_stats()
+                if stats:
+                    logger.info("Notification stats: " +
+                                ", ".join(f"{key}={value:.3g}" for key, value in stats.items()))
+                last_stats_time = time.time()
+            _restart_failed_streams(stream_workers, printers_by_name, backend, config, failed_streams)
+
+            try:
+                command, argument = control_queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
 
-            time.sleep(0.1)
+            if command == 'active':
+                for name in list(stream_workers):
+                    if name not in argument:
+                        _stop_stream(stream_workers.pop(name))
+                        failed_streams.pop(name, None)
+
+                for name in argument:
+                    if name not in stream_workers and name in printers_by_name:
+                        stream_workers[name] = _start_stream(printers_by_name[name], backend, config)
+            elif command == 'config':
+                # A bad configuration must not take the running streams down with it.
+                try:
+                    config, printers_by_name = _apply_config_change(argument, config, printers_by_name,
+                                                                    stream_workers, backend)
+                except ConfigError as e:
+                    logger.error(f"Ignoring the reloaded configuration: {e}")
+                except Exception:
+                    logger.exception("Failed to apply the reloaded configuration, keeping the previous one")
+            else:
+                logger.warning(f"Unknown issue detector command: {command}")
     except KeyboardInterrupt:
         logger.info("KeyboardInterrupt received. Worker stopping.")
-    except Exception as e:
-        logger.exception(f"An unexpected error occurred: {e}")
     finally:
-        if cap is not None and cap.isOpened():
-            cap.release()
-        logger.info("Video stream released.")
+        for thread, stop_event, _ in stream_workers.values():
+            stop_event.set()
+        for thread, stop_event, _ in stream_workers.values():
+            thread.join()
+        backend.close()
+        flush_contact_sheets()
+        close_history_store(timeout=1)
+        # The monitor stops the process after 5 seconds, leave some of it for the last notifications.
+        flush_notifications(timeout=3)
+        metrics_stop_event.set()
+        if metrics_exporter is not None:
+            metrics_exporter.join(timeout=1)
 
-def start_issue_detector_process():
-    """
-    Initializes and starts the issue detection process.
-    Returns the process object and the terminate_event.
-    """
-    terminate_event = multiprocessing.Event()
-    process = multiprocessing.Process(target=_detect_issues_process, args=(terminate_event,))
-    process.start()
-    return process, terminate_event
 
 if __name__ == '__main__':
     logger.info("[Main] Starting issue detector controller.")
 
     try:
-        # Run directly the inference code
+        # Run directly the inference code for all configured printers
+        printers = get_printers()
         terminate_event = multiprocessing.Event()
-        _detect_issues_process(terminate_event)
+        control_queue = multiprocessing.Queue()
+        control_queue.put(('active', {printer['name'] for printer in printers}))
+        _detect_issues_process(terminate_event, control_queue, printers)
 
         # Run for 60 seconds in a dedicated process
-        # detector_process, terminate_event = start_issue_detector_process()
+        # detector_process, terminate_event, control_queue = monitor.start_issue_detector_process(get_printers())
         # time.sleep(30) # Run for a fixed duration for testing this simplified model
     finally:
         # terminate_event.set() # Signal the worker to stop completely
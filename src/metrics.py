@@ -0,0 +1,374 @@
+import bisect
+import collections
+import logging
+import multiprocessing
+import os
+import signal
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+PREFIX = 'printer_monitor_'
+# Histogram buckets of the stage latencies, in seconds.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# How often the issue detector process sends its metrics to the monitor process, in seconds.
+EXPORT_INTERVAL = 5
+# Sampling interval of the stack profiler, in seconds.
+PROFILER_INTERVAL = 0.005
+
+
+class _Metric:
+    """
+    Base class of the metrics. A metric has one child per combination of label values; children are created on first
+    use and cached, so hot paths should keep the child returned by `labels` instead of looking it up on every call.
+    """
+
+    type_name = None
+
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._lock = threading.Lock()
+        self._children = {}
+
+    def labels(self, *label_values):
+        label_values = tuple(str(value) for value in label_values)
+        child = self._children.get(label_values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(label_values, self._new_child())
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def snapshot(self):
+        """Returns {label values: value} with the current values of the children."""
+        with self._lock:
+            children = list(self._children.items())
+        return {label_values: child.value() for label_values, child in children}
+
+
+class _CounterChild:
+
+    def __init__(self):
+        self._value = 0
+
+    def inc(self, amount=1):
+        # A single += on an int is not atomic, but the few lost increments under contention do not matter for the
+        # metrics, and skipping the lock keeps the per-frame cost down.
+        self._value += amount
+
+    def value(self):
+        return self._value
+
+
+class _GaugeChild(_CounterChild):
+
+    def set(self, value):
+        self._value = value
+
+    def dec(self, amount=1):
+        self._value -= amount
+
+
+class _HistogramChild:
+
+    def __init__(self, buckets):
+        self._buckets = buckets
+        self._lock = threading.Lock()
+        self._counts = [0] * (len(buckets) + 1)
+        self._sum = 0.0
+
+    def observe(self, value):
+        index = bisect.bisect_left(self._buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+
+    def time(self):
+        """Context manager observing the duration of the block."""
+        return _Timer(self)
+
+    def value(self):
+        with self._lock:
+            return list(self._counts), self._sum
+
+
+class _Timer:
+
+    def __init__(self, histogram):
+        self._histogram = histogram
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._histogram.observe(time.perf_counter() - self._start)
+
+
+class Counter(_Metric):
+    type_name = 'counter'
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+
+class Gauge(_Metric):
+    type_name = 'gauge'
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def set(self, value):
+        self.labels().set(value)
+
+
+class Histogram(_Metric):
+    type_name = 'histogram'
+
+    def __init__(self, name, documentation, label_names=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(buckets)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def time(self):
+        return self.labels().time()
+
+
+_registry = {}
+_registry_lock = threading.Lock()
+
+
+def _register(metric_class, name, documentation, label_names, **kwargs):
+    with _registry_lock:
+        metric = _registry.get(name)
+        if metric is None:
+            metric = _registry[name] = metric_class(PREFIX + name, documentation, label_names, **kwargs)
+        return metric
+
+
+def _reset_after_fork():
+    """
+    Starts the metrics of a forked process from scratch. It inherits the registry with the values of its parent, which
+    it would otherwise export again as its own, and the locks in whatever state they were at the fork. The metrics
+    stay registered, their children (and so the values) are dropped.
+    """
+    global _registry_lock, _remote_lock
+    _registry_lock = threading.Lock()
+    for metric in _registry.values():
+        metric._lock = threading.Lock()
+        metric._children = {}
+    _remote_lock = threading.Lock()
+    _remote_snapshots.clear()
+
+
+def counter(name, documentation, label_names=()):
+    """Returns the counter with the given name, creating it on first use."""
+    return _register(Counter, name, documentation, label_names)
+
+
+def gauge(name, documentation, label_names=()):
+    """Returns the gauge with the given name, creating it on first use."""
+    return _register(Gauge, name, documentation, label_names)
+
+
+def histogram(name, documentation, label_names=(), buckets=LATENCY_BUCKETS):
+    """Returns the histogram with the given name, creating it on first use."""
+    return _register(Histogram, name, documentation, label_names, buckets=buckets)
+
+
+def snapshot():
+    """Returns a picklable copy of all metrics of this process."""
+    with _registry_lock:
+        metrics = list(_registry.values())
+    return [{
+        'name': metric.name,
+        'type': metric.type_name,
+        'documentation': metric.documentation,
+        'label_names': metric.label_names,
+        'buckets': getattr(metric, 'buckets', None),
+        'samples': metric.snapshot(),
+    } for metric in metrics]
+
+
+def _format_labels(label_names, label_values):
+    if not label_names:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in label_values)
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(label_names, escaped)) + '}'
+
+
+def render(snapshots):
+    """Renders {process name: snapshot} in the Prometheus text format, with the process as an extra label."""
+    metrics = collections.OrderedDict()
+    for process_name, process_snapshot in snapshots.items():
+        for metric in process_snapshot:
+            entry = metrics.setdefault(metric['name'], (metric, []))
+            entry[1].append((process_name, metric['samples']))
+
+    lines = []
+    for name, (metric, processes) in metrics.items():
+        lines.append(f"# HELP {name} {metric['documentation']}")
+        lines.append(f"# TYPE {name} {metric['type']}")
+        label_names = ('process',) + metric['label_names']
+        for process_name, samples in processes:
+            for label_values, value in sorted(samples.items()):
+                label_values = (process_name,) + label_values
+                if metric['type'] != 'histogram':
+                    lines.append(f"{name}{_format_labels(label_names, label_values)} {value}")
+                    continue
+                counts, total = value
+                cumulative = 0
+                for bound, count in zip(metric['buckets'] + ('+Inf',), counts):
+                    cumulative += count
+                    bucket_labels = _format_labels(label_names + ('le',), label_values + (bound,))
+                    lines.append(f"{name}_bucket{bucket_labels} {cumulative}")
+                lines.append(f"{name}_sum{_format_labels(label_names, label_values)} {total}")
+                lines.append(f"{name}_count{_format_labels(label_names, label_values)} {cumulative}")
+    return '\n'.join(lines) + '\n'
+
+
+_collector_queue = None
+_remote_snapshots = {}
+_remote_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def collector_queue():
+    """
+    Returns the queue other processes send their metrics on, or None if the metrics server is not running in this
+    process, in which case there is nobody to send them to.
+    """
+    return _collector_queue
+
+
+def _collect_remote_snapshots(metrics_queue):
+    """Keeps the latest snapshot sent by each process, draining the queue so the senders never block on it."""
+    while True:
+        try:
+            process_name, process_snapshot = metrics_queue.get()
+        except (EOFError, OSError, ValueError):
+            return
+        with _remote_lock:
+            _remote_snapshots[process_name] = process_snapshot
+
+
+def _remote_snapshots_copy():
+    with _remote_lock:
+        return dict(_remote_snapshots)
+
+
+def start_exporter(metrics_queue, process_name, stop_event):
+    """
+    Sends the metrics of this process on metrics_queue every EXPORT_INTERVAL seconds, and a last time when the
+    stop_event is set. Returns the exporter thread.
+    """
+    def export():
+        while not stop_event.wait(EXPORT_INTERVAL):
+            metrics_queue.put((process_name, snapshot()))
+        metrics_queue.put((process_name, snapshot()))
+        # Flush the last snapshot before the process exits, the monitor drains the queue so this does not block.
+        metrics_queue.close()
+        metrics_queue.join_thread()
+
+    thread = threading.Thread(target=export, name='metrics_exporter', daemon=True)
+    thread.start()
+    return thread
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        snapshots = {'monitor': snapshot()}
+        snapshots.update(_remote_snapshots_copy())
+        body = render(snapshots).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(host='127.0.0.1', port=9108):
+    """
+    Serves the metrics of this process and the ones sent on collector_queue() by other processes on
+    http://host:port/metrics. Returns the server, stop it with server.shutdown() and server.server_close().
+    """
+    global _collector_queue
+    _collector_queue = multiprocessing.Queue()
+    threading.Thread(target=_collect_remote_snapshots, args=(_collector_queue,), name='metrics_collector',
+                     daemon=True).start()
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics_server', daemon=True).start()
+    logger.info(f"Serving metrics on http://{host}:{server.server_address[1]}/metrics")
+    return server
+
+
+def sample_stacks(duration, interval=PROFILER_INTERVAL):
+    """
+    Samples the stacks of all threads of this process for duration seconds. Returns them in the folded format of
+    flamegraph.pl ("thread;outer;...;inner count" lines), with the thread name as the root frame, so the stages (stream,
+    capture, inference, notifier threads) are separate towers.
+    """
+    own_thread_id = threading.get_ident()
+    stacks = collections.Counter()
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_thread_id:
+                continue
+            frames = []
+            while frame is not None:
+                code = frame.f_code
+                frames.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            frames.append(thread_names.get(thread_id, str(thread_id)))
+            stacks[';'.join(reversed(frames))] += 1
+        time.sleep(interval)
+    return ''.join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+
+def install_profiler_signal(output_dir, duration=10):
+    """
+    Makes SIGUSR2 sample the stacks of this process for duration seconds (see sample_stacks) and write them to
+    <output_dir>/profile-<pid>-<timestamp>.folded. Must be called from the main thread.
+    """
+    def profile():
+        path = os.path.join(output_dir, f"profile-{os.getpid()}-{int(time.time())}.folded")
+        try:
+            folded_stacks = sample_stacks(duration)
+            os.makedirs(output_dir, exist_ok=True)
+            with open(path, 'w') as f:
+                f.write(folded_stacks)
+            logger.info(f"Wrote profile to {path}")
+        except Exception:
+            logger.exception(f"Failed to write profile to {path}")
+
+    def on_signal(signum, frame):
+        threading.Thread(target=profile, name='profiler', daemon=True).start()
+
+    signal.signal(signal.SIGUSR2, on_signal)
@@ -1,18 +1,46 @@
-import time
+import multiprocessing
+import queue
 import logging
 
-from src.config import get_config
-from src.printer import get_printer_status
-from src.notifier import send_notification
-from src.issue_detector import start_issue_detector_process
+from src import metrics
+from src.history_store import close_history_store, get_history_store
+from src.config import CONFIG_CHANGED, ConfigWatcher, get_config, get_printers
+from src.printer import PrinterWatcher
+from src.notifier import send_notification, flush_notifications, format_printer_message
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 _issue_detector_process = None
 _issue_detector_terminate_event = None
+_issue_detector_control_queue = None
+_issue_detector_active_printers = None
+
+def _run_issue_detector(*args):
+    """
+    Entry point of the issue detector process. OpenCV, NumPy and OpenVINO are only imported here, so the monitor
+    process stays small and starts fast while the printers are idle.
+    """
+    from src.issue_detector import _detect_issues_process
+    _detect_issues_process(*args)
+
+
+def start_issue_detector_process(printers):
+    """
+    Initializes and starts the issue detection process for the given printers.
+    Returns the process object, the terminate_event and the control queue used to tell the process which printers
+    are printing.
+    """
+    terminate_event = multiprocessing.Event()
+    control_queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_run_issue_detector,
+                                      args=(terminate_event, control_queue, printers, metrics.collector_queue()))
+    process.start()
+    return process, terminate_event, control_queue
+
 
 def terminate_issue_detector():
-    global _issue_detector_process, _issue_detector_terminate_event
+    global _issue_detector_process, _issue_detector_terminate_event, _issue_detector_control_queue
+    global _issue_detector_active_printers
     if _issue_detector_process is not None:
         _issue_detector_terminate_event.set()  # Signal the worker to stop completely
         _issue_detector_process.join(timeout=5)  # Wait for worker to finish gracefully
@@ -21,44 +49,136 @@ def terminate_issue_detector():
             _issue_detector_process.terminate()
         _issue_detector_process = None
         _issue_detector_terminate_event = None
+        _issue_detector_control_queue = None
+        _issue_detector_active_printers = None
         logging.info("Issue detector process shut down.")
 
 
+def update_issue_detector(printers, printing, keep_warm=False):
+    """
+    Makes sure a single issue detector process is running while any of the printers is printing, and tells it which
+    printers are printing. The process is shut down once none of them is, unless keep_warm is set. In that case the
+    process (and its compiled model) stays resident with all streams paused, ready for the next print.
+    """
+    global _issue_detector_process, _issue_detector_terminate_event, _issue_detector_control_queue
+    global _issue_detector_active_printers
+    if printing or keep_warm:
+        if _issue_detector_process is None:
+            # Start issue detector process
+            if printing:
+                logging.info("Printer is 'printing'. Starting issue detection process.")
+            else:
+                logging.info("Starting pre-warmed issue detection process.")
+            _issue_detector_process, _issue_detector_terminate_event, _issue_detector_control_queue = \
+                start_issue_detector_process(printers)
+        elif not _issue_detector_process.is_alive():
+            # Check if the issue detector process is alive, it will be restarted on the next poll
+            logging.error("Issue detector process died unexpectedly.")
+            _issue_detector_process = None
+            _issue_detector_active_printers = None
+            return
+
+        if printing != _issue_detector_active_printers:
+            _issue_detector_control_queue.put(('active', printing))
+            _issue_detector_active_printers = printing
+    elif _issue_detector_process is not None:
+        terminate_issue_detector()
+
+
+def apply_config_change(printers, config):
+    """
+    Applies a reloaded configuration: returns the printers with their new detection settings and sends the
+    configuration to the issue detector process, if it is running, which applies it to its streams. The printers are
+    watched from the start, so adding or removing printers or changing their address takes effect after a restart.
+    """
+    new_printers = {printer['name']: printer for printer in get_printers(config)}
+    addresses = {printer['name']: (printer['ip'], printer['port']) for printer in printers}
+    if addresses != {name: (printer['ip'], printer['port']) for name, printer in new_printers.items()}:
+        logging.warning("Changes to the list of printers or their addresses take effect after a restart.")
+
+    if _issue_detector_control_queue is not None:
+        _issue_detector_control_queue.put(('config', config))
+    return [dict(new_printers[printer['name']], ip=printer['ip'], port=printer['port'])
+            if printer['name'] in new_printers else printer for printer in printers]
+
+
 def main():
-    """Main function to run the printer monitor."""
+    """
+    Main function to run the printer monitor. The printer states are pushed by one PrinterWatcher per printer, the
+    issue detector is started and stopped as soon as they change. Without changes, the detector process is still
+    checked every polling interval. Changes of the configuration file are picked up by a ConfigWatcher, see
+    apply_config_change.
+    """
     config = get_config()
+    printers = get_printers(config)
+    printers_by_name = {printer['name']: printer for printer in printers}
 
     polling_interval = config['polling_interval_seconds']
-    last_state = get_printer_status(config)
+    keep_warm = config.get('issue_detector', {}).get('keep_warm', False)
+    events = queue.Queue()
+    watchers = {printer['name']: PrinterWatcher(printer, events, polling_interval, config.get('websocket', True),
+                                                config.get('print_progress', False))
+                for printer in printers}
+    states = {printer['name']: None for printer in printers}
+    history = get_history_store()
+    config_watcher = None
+    if config.get('config_reload_seconds', 2):
+        config_watcher = ConfigWatcher(events, config.get('config_reload_seconds', 2))
+
+    metrics_config = config.get('metrics') or {}
+    metrics_server = None
+    if metrics_config.get('port'):
+        metrics_server = metrics.start_metrics_server(metrics_config.get('host', '127.0.0.1'), metrics_config['port'])
+    if metrics_config.get('profile_dir'):
+        metrics.install_profiler_signal(metrics_config['profile_dir'], metrics_config.get('profile_seconds', 10))
 
     logging.info("Starting Qidi Q1 Printer Monitor")
 
     try:
+        for watcher in watchers.values():
+            watcher.start()
+        if config_watcher is not None:
+            config_watcher.start()
+
         while True:
-            current_state = get_printer_status(config)
-
-            global _issue_detector_process, _issue_detector_terminate_event
-            if current_state == 'printing':
-                if _issue_detector_process is None:
-                    # Start issue detector process
-                    logging.info("Printer is 'printing'. Starting issue detection process.")
-                    _issue_detector_process, _issue_detector_terminate_event = start_issue_detector_process()
-                else:
-                    # Check if the issue detector process is alive
-                    if not _issue_detector_process.is_alive():
-                        logging.error("Issue detector process died unexpectedly.")
-                        _issue_detector_process = None
-            elif current_state != 'printing' and _issue_detector_process is not None:
-                terminate_issue_detector()
-
-            if last_state == 'printing' and current_state != 'printing':
-                message = f"Printer state changed from 'printing' to '{current_state}'."
-                send_notification(message)
-
-            last_state = current_state
-            time.sleep(polling_interval)
+            try:
+                event = events.get(timeout=polling_interval)
+            except queue.Empty:
+                event = None
+
+            # In single printer mode the printer name is None.
+            if event is not None and event[0] is CONFIG_CHANGED:
+                config = event[1]
+                printers = apply_config_change(printers, config)
+                printers_by_name = {printer['name']: printer for printer in printers}
+                keep_warm = config.get('issue_detector', {}).get('keep_warm', False)
+            elif event is not None:
+                name, current_state = event
+                last_state = states[name]
+                states[name] = current_state
+                if history is not None:
+                    history.record_state(name, current_state)
+                # The first state of a printer is not a change.
+                if last_state == 'printing' and current_state != 'printing':
+                    message = f"Printer state changed from 'printing' to '{current_state}'."
+                    progress = watchers[name].progress
+                    if progress and current_state != 'complete':
+                        message += f" The print was {progress:.0%} done."
+                    send_notification(format_printer_message(printers_by_name[name], message))
+
+            printing = frozenset(name for name, state in states.items() if state == 'printing')
+            update_issue_detector(printers, printing, keep_warm)
     finally:
+        if config_watcher is not None:
+            config_watcher.stop()
         terminate_issue_detector()
+        for watcher in watchers.values():
+            watcher.stop()
+        flush_notifications(timeout=10)
+        close_history_store(timeout=5)
+        if metrics_server is not None:
+            metrics_server.shutdown()
+            metrics_server.server_close()
 
 if __name__ == "__main__":
     main()
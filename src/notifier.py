@@ -1,35 +1,283 @@
+import base64
+import json
 import logging
-import requests
+import os
+import pathlib
+import random
+import threading
+import time
 import uuid
+from collections import deque
+
+import requests
 
+from src import metrics
 from src.config import get_config
 
+_delivery_seconds = metrics.histogram('notification_delivery_seconds',
+                                      "Time from queueing a notification to its delivery.")
+_notifications = metrics.counter('notifications_total', "Notifications by outcome: sent, failed, dropped, spilled.",
+                                 ('result',))
+_outbox_depth = metrics.gauge('notification_outbox_depth', "Notifications waiting in the in-memory outbox.")
 
-def send_notification(message, image=None, event_type='printer_event'):
-    service_url = get_config()['notifier']['url']
-    auth_token = get_config()['notifier']['token']
 
-    payload = {
-        'event': event_type,
-        'message': {
-            'text': message,
-        }
-    }
+class NotificationDispatcher:
+    """
+    Delivers notifications on a background thread, so callers only enqueue them and never wait for the server.
+
+    Notifications wait in a bounded in-memory outbox and are sent over a persistent keep-alive session with explicit
+    timeouts. Connection errors, timeouts and 5xx responses are retried up to `retries` times with full jitter
+    exponential backoff, other failures are dropped. When the outbox is full, new notifications are spilled to
+    spill_dir if given (and picked up again once the outbox drains, also after a restart), otherwise the oldest
+    queued one is dropped.
+    """
+
+    def __init__(self, url, token, timeout=10, retries=3, backoff=1, max_backoff=60, outbox_size=100,
+                 spill_dir=None):
+        self._url = url
+        self._token = token
+        self._timeout = timeout
+        self._retries = retries
+        self._backoff = backoff
+        self._max_backoff = max_backoff
+        self._outbox_size = outbox_size
+        self._spill_dir = pathlib.Path(spill_dir) if spill_dir else None
+        if self._spill_dir is not None:
+            self._spill_dir.mkdir(parents=True, exist_ok=True)
+
+        self._session = requests.Session()
+        self._condition = threading.Condition()
+        self._outbox = deque()
+        self._delivering = False
+
+        self._sent = 0
+        self._failed = 0
+        self._dropped = 0
+        self._spilled = 0
+        self._retried = 0
+        self._latencies = deque(maxlen=1000)
+
+        self._closed = threading.Event()
+        self._thread = threading.Thread(target=self._deliver_loop, name='notifier', daemon=True)
+        self._thread.start()
 
-    if image:
-        image_name = "%s.jpg" % str(uuid.uuid4())
-        upload_url = "%s/image?auth_token=%s" % (service_url, auth_token)
+    def submit(self, message, image=None, event_type='printer_event'):
+        """Queues a notification and returns right away."""
+        notification = {'message': message, 'image': image, 'event_type': event_type, 'time': time.time()}
+        with self._condition:
+            if len(self._outbox) < self._outbox_size or self._spill_dir is None:
+                self._enqueue(notification)
+                return
+        # The spill file is written without holding the condition, so the delivery thread and other callers are not
+        # held up by the disk.
+        if not self._spill(notification):
+            with self._condition:
+                self._enqueue(notification)
+
+    def flush(self, timeout=None):
+        """Waits until the notifications queued in memory are delivered or given up on. Returns False on timeout."""
+        deadline = None if timeout is None else time.time() + timeout
+        with self._condition:
+            while self._outbox or self._delivering:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+        return True
+
+    def close(self, timeout=None):
+        """Delivers what it can within the timeout and stops the delivery thread."""
+        self.flush(timeout)
+        self._closed.set()
+        with self._condition:
+            self._condition.notify_all()
+        self._thread.join(timeout)
+        self._session.close()
+
+    def stats(self):
+        """Returns the outbox depth, delivery and spill counters and p99 delivery latency (seconds)."""
+        with self._condition:
+            latencies = sorted(self._latencies)
+            return {
+                'outbox_depth': len(self._outbox),
+                'spilled': self._spilled,
+                'sent': self._sent,
+                'failed': self._failed,
+                'dropped': self._dropped,
+                'retries': self._retried,
+                'delivery_latency_p99': latencies[int(len(latencies) * 0.99)] if latencies else 0.0,
+            }
+
+    def _enqueue(self, notification):
+        """Appends the notification to the outbox, dropping the oldest one when full. Called with the condition held."""
+        if len(self._outbox) >= self._outbox_size:
+            dropped = self._outbox.popleft()
+            self._dropped += 1
+            _notifications.labels('dropped').inc()
+            logging.error(f"Notification outbox full, dropping notification '{dropped['message']}'.")
+        self._outbox.append(notification)
+        _outbox_depth.set(len(self._outbox))
+        self._condition.notify()
+
+    def _spill(self, notification):
+        """Writes the notification to the spill directory. Returns False if that failed."""
+        spilled = dict(notification, image=base64.b64encode(notification['image']).decode('ascii')
+                       if notification['image'] else None)
+        path = self._spill_dir.joinpath(f"{notification['time']:.6f}-{uuid.uuid4()}.json")
         try:
-            requests.put(upload_url, files={image_name: image})
-        except requests.exceptions.RequestException:
-            logging.exception(f"Failed to upload notification image.")
-            return
-
-        payload['message']['image'] = image_name
-        payload['message']['thumbnail'] = image_name
-
-    push_url = "%s/push?auth_token=%s" % (service_url, auth_token)
-    try:
-        requests.post(push_url, json=payload)
-    except requests.exceptions.RequestException:
-        logging.exception(f"Failed to send notification {payload}.")
+            temporary_path = path.with_suffix('.tmp')
+            temporary_path.write_text(json.dumps(spilled))
+            os.replace(temporary_path, path)
+        except OSError:
+            logging.exception(f"Failed to spill notification to {path}.")
+            return False
+        with self._condition:
+            self._spilled += 1
+        _notifications.labels('spilled').inc()
+        return True
+
+    def _unspill(self, room):
+        """Reads back up to `room` spilled notifications, oldest first. Called without the condition held."""
+        notifications = []
+        for path in sorted(self._spill_dir.glob('*.json')):
+            if len(notifications) >= room:
+                break
+            # Claim the file first, another process may share the spill directory.
+            claimed_path = path.with_suffix('.sending')
+            try:
+                os.rename(path, claimed_path)
+                notification = json.loads(claimed_path.read_text())
+                claimed_path.unlink()
+            except (OSError, ValueError):
+                logging.exception(f"Failed to read spilled notification {path}.")
+                continue
+            if notification['image']:
+                notification['image'] = base64.b64decode(notification['image'])
+            notifications.append(notification)
+        return notifications
+
+    def _deliver_loop(self):
+        while not self._closed.is_set():
+            if self._spill_dir is not None:
+                with self._condition:
+                    room = self._outbox_size - len(self._outbox)
+                # Only the delivery thread takes notifications out of the outbox, so the room can only shrink while
+                # the files are read. A submit racing with it may overfill the outbox by the notifications read back.
+                unspilled = self._unspill(room) if room > 0 else []
+                if unspilled:
+                    with self._condition:
+                        self._outbox.extend(unspilled)
+                        _outbox_depth.set(len(self._outbox))
+
+            with self._condition:
+                if not self._outbox:
+                    self._condition.wait(1)
+                    continue
+                notification = self._outbox.popleft()
+                _outbox_depth.set(len(self._outbox))
+                self._delivering = True
+
+            try:
+                delivered = self._deliver(notification)
+            except Exception:
+                logging.exception(f"Unexpected error while sending notification '{notification['message']}'.")
+                delivered = False
+
+            with self._condition:
+                if delivered:
+                    self._sent += 1
+                    self._latencies.append(time.time() - notification['time'])
+                    _delivery_seconds.observe(time.time() - notification['time'])
+                    _notifications.labels('sent').inc()
+                else:
+                    self._failed += 1
+                    _notifications.labels('failed').inc()
+                self._delivering = False
+                self._condition.notify_all()
+
+    def _deliver(self, notification):
+        """Sends a notification, retrying transient failures. Returns whether it was delivered."""
+        payload = {
+            'event': notification['event_type'],
+            'message': {
+                'text': notification['message'],
+            }
+        }
+        image_name = None
+
+        for attempt in range(self._retries + 1):
+            if attempt:
+                with self._condition:
+                    self._retried += 1
+                if self._closed.wait(random.uniform(0, min(self._max_backoff, self._backoff * 2 ** (attempt - 1)))):
+                    return False
+            try:
+                # An uploaded image is not uploaded again when only the push failed.
+                if notification['image'] and image_name is None:
+                    name = "%s.jpg" % str(uuid.uuid4())
+                    upload_url = "%s/image?auth_token=%s" % (self._url, self._token)
+                    self._session.put(upload_url, files={name: notification['image']},
+                                      timeout=self._timeout).raise_for_status()
+                    image_name = name
+                    payload['message']['image'] = image_name
+                    payload['message']['thumbnail'] = image_name
+
+                push_url = "%s/push?auth_token=%s" % (self._url, self._token)
+                self._session.post(push_url, json=payload, timeout=self._timeout).raise_for_status()
+                return True
+            except requests.exceptions.RequestException as e:
+                response = getattr(e, 'response', None)
+                if response is not None and response.status_code < 500:
+                    logging.error(f"Notification '{notification['message']}' rejected: {e}")
+                    return False
+                logging.warning(f"Failed to send notification (attempt {attempt + 1}/{self._retries + 1}): {e}")
+
+        logging.error(f"Giving up on notification '{notification['message']}'.")
+        return False
+
+
+_dispatcher = None
+_dispatcher_pid = None
+_dispatcher_lock = threading.Lock()
+
+
+def _get_dispatcher():
+    """
+    Returns the notification dispatcher of this process, creating it from the `notifier` configuration section on
+    first use. A forked process (the issue detector) gets its own, as the delivery thread is not inherited.
+    """
+    global _dispatcher, _dispatcher_pid
+    with _dispatcher_lock:
+        if _dispatcher is None or _dispatcher_pid != os.getpid():
+            config = get_config()['notifier']
+            _dispatcher = NotificationDispatcher(config['url'], config['token'],
+                                                 timeout=config.get('timeout_seconds', 10),
+                                                 retries=config.get('retries', 3),
+                                                 outbox_size=config.get('outbox_size', 100),
+                                                 spill_dir=config.get('spill_dir'))
+            _dispatcher_pid = os.getpid()
+        return _dispatcher
+
+
+def send_notification(message, image=None, event_type='printer_event'):
+    """Queues the notification for delivery and returns right away."""
+    _get_dispatcher().submit(message, image, event_type)
+
+
+def flush_notifications(timeout=None):
+    """Waits for the queued notifications of this process to be delivered. Returns False on timeout."""
+    return _dispatcher is None or _dispatcher_pid != os.getpid() or _dispatcher.flush(timeout)
+
+
+def notification_stats():
+    """Returns the metrics of the notification dispatcher of this process, empty if nothing was sent yet."""
+    if _dispatcher is None or _dispatcher_pid != os.getpid():
+        return {}
+    return _dispatcher.stats()
+
+
+def format_printer_message(printer, message):
+    """Prefixes the message with the printer name when running in fleet mode."""
+    if printer is not None and printer.get('name'):
+        return f"[{printer['name']}] {message}"
+    return message
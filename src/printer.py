@@ -1,28 +1,182 @@
-import requests
+import json
+import time
+import threading
 import logging
 
-_printer_offline = False
+import requests
+import websocket
+
+from src import metrics
+
+# Timeout of the HTTP queries and the websocket handshake, in seconds.
+REQUEST_TIMEOUT = 5
+# An idle websocket is pinged this often, and considered lost after twice as long without any message.
+PING_INTERVAL = 60
+SUBSCRIBE_REQUEST_ID = 1
+
+_state_changes = metrics.counter('printer_state_changes_total', "Printer state changes.", ('printer', 'state'))
+_websocket_connected = metrics.gauge('printer_websocket_connected',
+                                     "1 while the Moonraker websocket is connected, 0 while polling.", ('printer',))
+_status_queries = metrics.counter('printer_status_queries_total', "HTTP queries of the printer state.", ('printer',))
+
+_offline_printers = set()
+_session = requests.Session()
 
-def get_printer_status(config):
-    """Gets the printer status from the Moonraker API."""
-    global _printer_offline
-    printer_ip = config['printer']['ip']
-    printer_port = config['printer']['port']
+def get_printer_status(config, printer=None):
+    """
+    Gets the printer status from the Moonraker API.
+    `printer` is one of the entries returned by `get_printers`, defaults to the `printer` section of the config.
+    """
+    if printer is None:
+        printer = dict(config['printer'], name=None)
+    printer_name = printer.get('name')
+    printer_ip = printer['ip']
+    printer_port = printer['port']
     url = f"http://{printer_ip}:{printer_port}/printer/objects/query?print_stats"
+    log_prefix = f"[{printer_name}] " if printer_name else ""
+    _status_queries.labels(printer_name or '').inc()
     try:
-        response = requests.get(url)
+        response = _session.get(url, timeout=REQUEST_TIMEOUT)
         response.raise_for_status()
         state = response.json()['result']['status']['print_stats']['state']
-        if _printer_offline:
-            logging.info("Printer is back online.")
-            _printer_offline = False
+        if url in _offline_printers:
+            logging.info(f"{log_prefix}Printer is back online.")
+            _offline_printers.discard(url)
         return state
     except requests.exceptions.RequestException as e:
-        if not _printer_offline:
-            logging.error(f"Failed to get printer status: {e}")
-            logging.info("Printer appears to be offline. Suppressing further connection errors.")
-            _printer_offline = True
+        if url not in _offline_printers:
+            logging.error(f"{log_prefix}Failed to get printer status: {e}")
+            logging.info(f"{log_prefix}Printer appears to be offline. Suppressing further connection errors.")
+            _offline_printers.add(url)
         return "error"
     except (KeyError, TypeError) as e:
-        logging.error(f"Failed to parse printer status response: {e}")
+        logging.error(f"{log_prefix}Failed to parse printer status response: {e}")
         return "error"
+
+
+class PrinterWatcher:
+    """
+    Follows the state of a printer and puts (printer name, state) on the events queue whenever it changes.
+
+    The watcher subscribes to `print_stats` (and with progress=True to `display_status` and `virtual_sdcard`) over the
+    Moonraker JSON-RPC websocket, so state changes arrive as they happen and an idle printer costs a ping a minute.
+    While the websocket is unavailable, or Moonraker sends a message the watcher does not understand, the state is
+    polled over HTTP every polling_interval seconds, and the websocket is retried in between. The state is 'error'
+    while the printer (or Klippy) is unreachable, like get_printer_status.
+    """
+
+    def __init__(self, printer, events, polling_interval, use_websocket=True, progress=False):
+        self._printer = printer
+        self._events = events
+        self._polling_interval = polling_interval
+        self._use_websocket = use_websocket
+        self._objects = {'print_stats': ['state']}
+        if progress:
+            self._objects.update(display_status=['progress'], virtual_sdcard=['progress'])
+        self._url = f"ws://{printer['ip']}:{printer['port']}/websocket"
+        self._log_prefix = f"[{printer['name']}] " if printer['name'] else ""
+
+        self.state = None
+        # The latest values of the subscribed objects, {object name: {field: value}}.
+        self.status = {}
+        self._websocket_failed = False
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    @property
+    def progress(self):
+        """The print progress (0-1) reported by the printer, None if not subscribed or not known yet."""
+        return self.status.get('display_status', {}).get('progress')
+
+    def start(self):
+        self._thread = threading.Thread(target=self._watch, name=f"printer_{self._printer['name']}", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _set_state(self, state):
+        if state != self.state:
+            self.state = state
+            _state_changes.labels(self._printer['name'] or '', state).inc()
+            self._events.put((self._printer['name'], state))
+
+    def _watch(self):
+        while not self._stop_event.is_set():
+            if self._use_websocket:
+                try:
+                    self._watch_websocket()
+                except (websocket.WebSocketException, OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+                    # The last three come from messages of an unexpected shape, e.g. of another Moonraker version.
+                    if not self._websocket_failed:
+                        logging.warning(f"{self._log_prefix}Moonraker websocket unavailable ({e!r}), "
+                                        f"polling the printer state every {self._polling_interval} seconds.")
+                        self._websocket_failed = True
+                if self._stop_event.is_set():
+                    return
+
+            self._set_state(get_printer_status(None, self._printer))
+            self._stop_event.wait(self._polling_interval)
+
+    def _subscribe(self, ws):
+        ws.send(json.dumps({'jsonrpc': '2.0', 'method': 'printer.objects.subscribe',
+                            'params': {'objects': self._objects}, 'id': SUBSCRIBE_REQUEST_ID}))
+
+    def _update_status(self, status):
+        for name, fields in status.items():
+            self.status.setdefault(name, {}).update(fields)
+        state = self.status.get('print_stats', {}).get('state')
+        if state is not None:
+            self._set_state(state)
+
+    def _watch_websocket(self):
+        """Follows the printer state over the websocket until the connection is lost or the watcher is stopped."""
+        ws = websocket.create_connection(self._url, timeout=REQUEST_TIMEOUT)
+        websocket_connected = _websocket_connected.labels(self._printer['name'] or '')
+        websocket_connected.set(1)
+        try:
+            if self._websocket_failed:
+                logging.info(f"{self._log_prefix}Moonraker websocket connected.")
+                self._websocket_failed = False
+            self._subscribe(ws)
+            ws.settimeout(1)
+            last_message_time = last_ping_time = time.time()
+
+            while not self._stop_event.is_set():
+                try:
+                    opcode, data = ws.recv_data(control_frame=True)
+                except websocket.WebSocketTimeoutException:
+                    current_time = time.time()
+                    if current_time - last_message_time >= 2 * PING_INTERVAL:
+                        raise websocket.WebSocketTimeoutException("no message from Moonraker")
+                    if current_time - max(last_message_time, last_ping_time) >= PING_INTERVAL:
+                        ws.ping()
+                        last_ping_time = current_time
+                    continue
+
+                last_message_time = time.time()
+                if opcode == websocket.ABNF.OPCODE_CLOSE:
+                    raise websocket.WebSocketConnectionClosedException("closed by Moonraker")
+                if opcode != websocket.ABNF.OPCODE_TEXT:
+                    continue
+
+                message = json.loads(data)
+                if message.get('id') == SUBSCRIBE_REQUEST_ID:
+                    if 'error' in message:
+                        # Klippy is not ready yet, the subscription is retried on notify_klippy_ready.
+                        logging.warning(f"{self._log_prefix}Failed to subscribe to the printer state: "
+                                        f"{message['error']}")
+                        self._set_state('error')
+                    else:
+                        self._update_status(message['result']['status'])
+                elif message.get('method') == 'notify_status_update':
+                    self._update_status(message['params'][0])
+                elif message.get('method') == 'notify_klippy_ready':
+                    self._subscribe(ws)
+                elif message.get('method') in ('notify_klippy_shutdown', 'notify_klippy_disconnected'):
+                    self._set_state('error')
+        finally:
+            websocket_connected.set(0)
+            ws.close()
@@ -0,0 +1,108 @@
+import cv2
+import numpy as np
+
+# Size of the grayscale thumbnail used to detect scene changes.
+SIGNATURE_SIZE = (64, 36)
+
+
+class FixedRateController:
+    """Runs inference on every frame, once per interval seconds."""
+
+    def __init__(self, interval=1):
+        self._interval = interval
+        self.inferences = 0
+
+    def interval(self, current_time):
+        """Seconds to wait between two frame checks."""
+        return self._interval
+
+    def should_infer(self, frame, current_time):
+        self.inferences += 1
+        return True
+
+    def update(self, max_class_confidences, confidence_thresholds, current_time):
+        pass
+
+    def stats(self):
+        return {'inferences': self.inferences}
+
+
+class AdaptiveRateController:
+    """
+    Decides how often a stream runs inference.
+
+    Frames are checked every base_interval seconds. A frame is only inferred when the scene changed since the last
+    inferred frame (mean absolute difference of a small grayscale thumbnail above change_threshold), or when
+    max_interval seconds passed without inference, so long uneventful prints cost little. Any 'hint' - a class score of
+    at least hint_ratio of its threshold, e.g. a sub-threshold spaghetti - switches to inferring every frame every
+    min_interval seconds for boost_duration seconds, to confirm or dismiss it quickly.
+    """
+
+    def __init__(self, base_interval=1, min_interval=0.25, max_interval=10, change_threshold=2.0, boost_duration=10,
+                 hint_ratio=0.5):
+        self._base_interval = base_interval
+        self._min_interval = min_interval
+        self._max_interval = max_interval
+        self._change_threshold = change_threshold
+        self._boost_duration = boost_duration
+        self._hint_ratio = hint_ratio
+
+        self._boost_until = 0
+        self._last_inference_time = None
+        self._signature = np.empty(SIGNATURE_SIZE[::-1], dtype=np.uint8)
+        self._gray = None
+        self._last_signature = None
+
+        self.inferences = 0
+        self.skipped = 0
+        self.boosts = 0
+
+    def _boosting(self, current_time):
+        return current_time < self._boost_until
+
+    def interval(self, current_time):
+        """Seconds to wait between two frame checks."""
+        return self._min_interval if self._boosting(current_time) else self._base_interval
+
+    def should_infer(self, frame, current_time):
+        """Returns whether the frame needs inference. Cheap, works on a downscaled grayscale copy of the frame."""
+        if self._gray is None or self._gray.shape != frame.shape[:2]:
+            self._gray = np.empty(frame.shape[:2], dtype=np.uint8)
+        cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=self._gray)
+        cv2.resize(self._gray, SIGNATURE_SIZE, dst=self._signature, interpolation=cv2.INTER_AREA)
+
+        changed = (self._last_signature is None or
+                   cv2.norm(self._signature, self._last_signature, cv2.NORM_L1) / self._signature.size
+                   >= self._change_threshold)
+        overdue = self._last_inference_time is None or current_time - self._last_inference_time >= self._max_interval
+
+        if changed or overdue or self._boosting(current_time):
+            if self._last_signature is None:
+                self._last_signature = np.empty_like(self._signature)
+            np.copyto(self._last_signature, self._signature)
+            self._last_inference_time = current_time
+            self.inferences += 1
+            return True
+
+        self.skipped += 1
+        return False
+
+    def update(self, max_class_confidences, confidence_thresholds, current_time):
+        """Boosts the rate if any class with a threshold scored at least hint_ratio of it."""
+        for class_name, threshold in confidence_thresholds.items():
+            if max_class_confidences.get(class_name, 0) >= threshold * self._hint_ratio:
+                if not self._boosting(current_time):
+                    self.boosts += 1
+                self._boost_until = current_time + self._boost_duration
+                return
+
+    def stats(self):
+        return {'inferences': self.inferences, 'skipped': self.skipped, 'boosts': self.boosts}
+
+
+def create_rate_controller(config):
+    """Creates the rate controller for a stream from the `issue_detector` configuration section."""
+    adaptive_rate = config.get('adaptive_rate')
+    if not adaptive_rate:
+        return FixedRateController()
+    return AdaptiveRateController(**(adaptive_rate if isinstance(adaptive_rate, dict) else {}))
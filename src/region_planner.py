@@ -0,0 +1,116 @@
+import math
+
+
+class RegionPlanner:
+    """
+    Decides which regions (x_min, y_min, x_max, y_max) of a frame are inferred.
+
+    Without crop, the whole frame is resized to the model input. With crop, only the area of interest, grown by margin
+    pixels on each side so detections on its edges keep their context, is inferred. The crop is widened or heightened
+    to the aspect ratio of the model input where the frame allows, so it is scaled without distortion. With tiling, a
+    crop larger than the model input is split into up to max_tiles overlapping tiles, each inferred at (close to) the
+    native resolution, instead of being downscaled as a whole.
+
+    The regions are integer pixel coordinates within the frame, also for a fractional area of interest (e.g. scaled
+    to a reduced decode). They only depend on the frame size, so they are computed once per size.
+    """
+
+    def __init__(self, crop=False, margin=32, tiling=False, tile_overlap=0.2, max_tiles=4):
+        if max_tiles < 1:
+            raise ValueError(f"max_tiles must be at least 1, not {max_tiles}")
+        if not 0 <= tile_overlap < 1:
+            raise ValueError(f"tile_overlap must be in [0, 1), not {tile_overlap}")
+        self.crop = crop
+        self.margin = margin
+        self.tiling = tiling
+        self.tile_overlap = tile_overlap
+        self.max_tiles = max_tiles
+        self._regions = {}
+
+    def regions(self, frame_width, frame_height, area_of_interest, input_width, input_height):
+        key = (frame_width, frame_height, tuple(area_of_interest or ()), input_width, input_height)
+        regions = self._regions.get(key)
+        if regions is None:
+            regions = self._regions[key] = self._plan(frame_width, frame_height, area_of_interest, input_width,
+                                                      input_height)
+        return regions
+
+    def _plan(self, frame_width, frame_height, area_of_interest, input_width, input_height):
+        if not self.crop or not area_of_interest:
+            return [(0, 0, frame_width, frame_height)]
+
+        x_min, y_min, x_max, y_max = area_of_interest
+        x_min, x_max = _clamp_span(x_min - self.margin, x_max + self.margin, frame_width)
+        y_min, y_max = _clamp_span(y_min - self.margin, y_max + self.margin, frame_height)
+        width, height = x_max - x_min, y_max - y_min
+
+        regions = [(x_min, y_min, x_max, y_max)]
+        if self.tiling and (width > input_width or height > input_height):
+            regions = self._tiles(x_min, y_min, x_max, y_max, input_width, input_height)
+        return [_fit_aspect_ratio(region, input_width, input_height, frame_width, frame_height) for region in regions]
+
+    def _tiles(self, x_min, y_min, x_max, y_max, input_width, input_height):
+        """Covers the crop with overlapping tiles of the model input size, or larger ones if there would be too many."""
+        width, height = x_max - x_min, y_max - y_min
+        scale = 1.0
+        while True:
+            tile_width = min(round(input_width * scale), width)
+            tile_height = min(round(input_height * scale), height)
+            columns = _tile_count(width, tile_width, self.tile_overlap)
+            rows = _tile_count(height, tile_height, self.tile_overlap)
+            if columns * rows <= self.max_tiles:
+                break
+            scale *= 1.25
+
+        return [(x, y, x + tile_width, y + tile_height)
+                for y in _tile_starts(y_min, height, tile_height, rows)
+                for x in _tile_starts(x_min, width, tile_width, columns)]
+
+
+def _fit_aspect_ratio(region, input_width, input_height, frame_width, frame_height):
+    """Grows the short side of the region to the aspect ratio of the model input, as far as the frame allows."""
+    x_min, y_min, x_max, y_max = region
+    width, height = x_max - x_min, y_max - y_min
+    if width * input_height < height * input_width:
+        x_min, x_max = _grow_span(x_min, x_max, height * input_width // input_height, frame_width)
+    else:
+        y_min, y_max = _grow_span(y_min, y_max, width * input_height // input_width, frame_height)
+    return x_min, y_min, x_max, y_max
+
+
+def _clamp_span(start, end, limit):
+    """Rounds [start, end) out to whole pixels within [0, limit), keeping at least one pixel."""
+    start = min(max(math.floor(start), 0), limit - 1)
+    return start, max(min(math.ceil(end), limit), start + 1)
+
+
+def _grow_span(start, end, length, limit):
+    """Grows [start, end) around its center to length, shifting it to stay within [0, limit)."""
+    length = min(max(length, end - start), limit)
+    start = max(0, min((start + end - length) // 2, limit - length))
+    return start, start + length
+
+
+def _tile_count(length, tile_length, overlap):
+    if tile_length >= length:
+        return 1
+    step = tile_length * (1 - overlap)
+    return math.ceil((length - tile_length) / step) + 1
+
+
+def _tile_starts(start, length, tile_length, count):
+    if count == 1:
+        return [start]
+    step = (length - tile_length) / (count - 1)
+    return [start + round(i * step) for i in range(count)]
+
+
+def create_region_planner(config):
+    """
+    Creates the region planner for a stream from the `issue_detector` configuration section. `crop_to_area_of_interest`
+    is either true or a dict with the RegionPlanner arguments.
+    """
+    crop = config.get('crop_to_area_of_interest')
+    if not crop:
+        return RegionPlanner()
+    return RegionPlanner(crop=True, **(crop if isinstance(crop, dict) else {}))
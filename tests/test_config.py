@@ -0,0 +1,159 @@
+import copy
+import inspect
+import os
+import queue
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import yaml
+
+from src.config import (CONFIG_CHANGED, STREAM_COMPONENT_OPTIONS, ConfigError, ConfigWatcher, get_config,
+                        validate_config)
+from src.detection_tracker import DetectionTracker
+from src.frame_history import FrameHistory
+from src.rate_controller import AdaptiveRateController
+from src.region_planner import RegionPlanner
+
+CONFIG = {
+    'printer': {'ip': '127.0.0.1', 'port': 7125},
+    'notifier': {'url': 'http://test-server', 'token': 'test-token'},
+    'polling_interval_seconds': 30,
+    'issue_detector': {
+        'confidence_thresholds': {'error': 0.75, 'spaghetti': 0.60},
+        'detection_area_of_interest': [100, 120, 590, 320],
+    },
+}
+
+
+class TestConfig(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.config_path = os.path.join(self.directory.name, 'config.yaml')
+        self._write_config(CONFIG)
+        config_patch = patch('src.config._config', CONFIG)
+        config_patch.start()
+        self.addCleanup(config_patch.stop)
+        self.addCleanup(self.directory.cleanup)
+
+    def _write_config(self, config):
+        with open(self.config_path, 'w') as f:
+            yaml.dump(config, f)
+        # Make the change visible even on file systems with a coarse modification time.
+        os.utime(self.config_path, ns=(0, os.stat(self.config_path).st_mtime_ns + 1))
+
+    def test_example_config_is_valid(self):
+        """Test that the example configuration passes the validation."""
+        with open(os.path.join(os.path.dirname(__file__), '..', 'config', 'config.yaml.example')) as f:
+            validate_config(yaml.safe_load(f))
+
+    def test_validate_config_lists_all_problems(self):
+        """Test that invalid detection settings and fleet definitions are reported together."""
+        config = copy.deepcopy(CONFIG)
+        config['issue_detector']['confidence_thresholds']['spaghetti'] = 1.5
+        config['issue_detector']['detection_area_of_interest'] = [590, 120, 100, 320]
+        config['issue_detector']['decoder'] = 'vdpau'
+        config['printers'] = [{'name': 'left', 'ip': '10.0.0.1', 'port': 7125,
+                               'decoder': {'type': 'mjpeg', 'reduce': 3}},
+                              {'name': 'left', 'ip': '10.0.0.2', 'port': 7125, 'detection_area_of_interest': [0, 0]}]
+        with self.assertRaises(ConfigError) as context:
+            validate_config(config)
+        message = str(context.exception)
+        self.assertIn('issue_detector.confidence_thresholds.spaghetti must be a number between 0 and 1', message)
+        self.assertIn('issue_detector.detection_area_of_interest must have x_min < x_max', message)
+        self.assertIn("printers[1].name 'left' is not unique", message)
+        self.assertIn('printers[1].detection_area_of_interest must be null or [x_min, y_min, x_max, y_max]', message)
+        self.assertIn('issue_detector.decoder must be one of opencv, opencv_hw, mjpeg', message)
+        self.assertIn('printers[0].decoder.reduce must be 1, 2, 4 or 8', message)
+
+    def test_validate_decoder(self):
+        """Test that decoder options are checked for the decoder type, and the mjpeg decoder for the stream URL."""
+        config = copy.deepcopy(CONFIG)
+        config['issue_detector']['stream_url'] = 'http://127.0.0.1:8080/?action=stream'
+        config['issue_detector']['decoder'] = {'type': 'mjpeg', 'reduce': 2, 'timeout': 5}
+        validate_config(config)
+
+        config['issue_detector']['decoder'] = {'type': 'opencv', 'reduce': 2}
+        with self.assertRaisesRegex(ConfigError, 'issue_detector.decoder has options reduce the opencv decoder does '
+                                                 r'not take \(none\)'):
+            validate_config(config)
+
+        config['issue_detector']['decoder'] = 'mjpeg'
+        config['issue_detector']['stream_url'] = 'rtsp://127.0.0.1/stream'
+        with self.assertRaisesRegex(ConfigError, 'issue_detector.decoder is mjpeg, which reads HTTP streams only'):
+            validate_config(config)
+
+        # In fleet mode the decoder of the issue_detector section is checked against the streams of the printers
+        # that use it.
+        config['printers'] = [{'name': 'left', 'ip': '10.0.0.1', 'port': 7125, 'stream_url': 'http://left'},
+                              {'name': 'right', 'ip': '10.0.0.2', 'port': 7125, 'stream_url': 'rtsp://right'},
+                              {'name': 'rear', 'ip': '10.0.0.3', 'port': 7125, 'stream_url': 'rtsp://rear',
+                               'decoder': 'opencv'}]
+        with self.assertRaises(ConfigError) as context:
+            validate_config(config)
+        self.assertIn('issue_detector.decoder is mjpeg, which reads HTTP streams only, not rtsp://right',
+                      str(context.exception))
+        self.assertNotIn('rtsp://rear', str(context.exception))
+
+    def test_validate_stream_components(self):
+        """Test that the stream component settings are checked against the arguments of their classes."""
+        classes = {'tracking': DetectionTracker, 'adaptive_rate': AdaptiveRateController,
+                   'crop_to_area_of_interest': RegionPlanner, 'frame_history': FrameHistory}
+        for key, options in STREAM_COMPONENT_OPTIONS.items():
+            arguments = set(inspect.signature(classes[key]).parameters) - {'crop'}
+            self.assertEqual(set(options), arguments, key)
+
+        config = copy.deepcopy(CONFIG)
+        config['issue_detector'].update(tracking={'min_hits': 2}, adaptive_rate=True, frame_history=None,
+                                        crop_to_area_of_interest={'tiling': True, 'max_tiles': 2, 'margin': 16.5})
+        validate_config(config)
+
+        config['issue_detector'].update(tracking={'min_hit': 3}, adaptive_rate='yes',
+                                        crop_to_area_of_interest={'tiling': 1, 'max_tiles': 0, 'tile_overlap': 1},
+                                        frame_history={'interval': '2'})
+        with self.assertRaises(ConfigError) as context:
+            validate_config(config)
+        for error in ('issue_detector.tracking has unknown options min_hit',
+                      'issue_detector.adaptive_rate must be true, false or a mapping',
+                      'issue_detector.crop_to_area_of_interest.tiling must be true or false',
+                      'issue_detector.crop_to_area_of_interest.max_tiles must be an integer of at least 1',
+                      'issue_detector.crop_to_area_of_interest.tile_overlap must be below 1',
+                      'issue_detector.frame_history.interval must be a number of at least 0'):
+            self.assertIn(error, str(context.exception))
+
+    def test_watcher_applies_valid_changes(self):
+        """Test that a changed file replaces the configuration and is put on the events queue."""
+        events = queue.Queue()
+        watcher = ConfigWatcher(events, config_path=self.config_path)
+        self.assertIsNone(watcher.check())
+
+        config = copy.deepcopy(CONFIG)
+        config['issue_detector']['confidence_thresholds']['spaghetti'] = 0.5
+        self._write_config(config)
+        self.assertEqual(watcher.check(), config)
+        self.assertEqual(get_config(), config)
+        self.assertEqual(events.get_nowait(), (CONFIG_CHANGED, config))
+
+    def test_watcher_ignores_invalid_changes(self):
+        """Test that an edit that does not parse or validate keeps the previous configuration."""
+        events = queue.Queue()
+        watcher = ConfigWatcher(events, config_path=self.config_path)
+
+        with open(self.config_path, 'a') as f:
+            f.write("issue_detector: [unbalanced\n")
+        with self.assertLogs(level='ERROR'):
+            self.assertIsNone(watcher.check())
+
+        config = copy.deepcopy(CONFIG)
+        config['issue_detector']['detection_area_of_interest'] = [100, 120, 590]
+        self._write_config(config)
+        with self.assertLogs(level='ERROR') as logs:
+            self.assertIsNone(watcher.check())
+        self.assertIn('keeping the previous configuration', logs.output[0])
+        self.assertIs(get_config(), CONFIG)
+        self.assertTrue(events.empty())
+
+
+if __name__ == '__main__':
+    unittest.main()
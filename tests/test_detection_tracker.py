@@ -0,0 +1,63 @@
+import unittest
+
+from src.detection_tracker import DetectionTracker, create_detection_tracker
+
+
+def _detection(box, name='spaghetti', confidence=0.8):
+    return {'name': name, 'confidence': confidence, 'box': box}
+
+
+class TestDetectionTracker(unittest.TestCase):
+
+    def test_reported_once_persistent(self):
+        """Test that a detection is reported once it was hit in min_hits of the last window frames, and only once."""
+        tracker = DetectionTracker(min_hits=3, window=5)
+        frames = [[_detection([100, 100, 200, 200])], [], [_detection([102, 101, 203, 200])],
+                  [_detection([101, 100, 201, 202])], [_detection([100, 100, 200, 200])]]
+        reported = [tracker.update(detections) for detections in frames]
+        self.assertEqual([len(detections) for detections in reported], [0, 0, 0, 1, 0])
+        self.assertEqual(reported[3][0]['box'], [101, 100, 201, 202])
+
+    def test_flicker_not_reported(self):
+        """Test that isolated hits never reach min_hits within the window."""
+        tracker = DetectionTracker(min_hits=3, window=5)
+        for i in range(20):
+            self.assertEqual(tracker.update([_detection([100, 100, 200, 200])] if i % 3 == 0 else []), [])
+
+    def test_growth_and_new_region_reported_again(self):
+        """Test that a reported track is reported again when it grows, and a new region is reported on its own."""
+        tracker = DetectionTracker(min_hits=2, window=3, growth_ratio=1.5)
+        box = [100, 100, 200, 200]
+        self.assertEqual(tracker.update([_detection(box)]), [])
+        self.assertEqual(len(tracker.update([_detection(box)])), 1)
+        self.assertEqual(tracker.update([_detection([100, 100, 210, 210])]), [])
+
+        grown = tracker.update([_detection([100, 100, 230, 230]), _detection([500, 300, 550, 350])])
+        self.assertEqual([detection['box'] for detection in grown], [[100, 100, 230, 230]])
+        new_region = tracker.update([_detection([100, 100, 230, 230]), _detection([500, 300, 550, 350])])
+        self.assertEqual([detection['box'] for detection in new_region], [[500, 300, 550, 350]])
+
+    def test_classes_tracked_separately_with_smoothed_confidence(self):
+        """Test that detections only match tracks of the same class and the confidence is smoothed."""
+        tracker = DetectionTracker(min_hits=2, window=2, smoothing=0.5)
+        box = [100, 100, 200, 200]
+        tracker.update([_detection(box, confidence=0.6), _detection(box, name='error', confidence=0.9)])
+        reported = tracker.update([_detection(box, confidence=1.0)])
+        self.assertEqual(reported, [_detection(box, confidence=0.8)])
+        self.assertEqual(len(tracker.tracks), 2)
+
+    def test_stale_tracks_dropped(self):
+        """Test that a track is dropped after max_misses frames, so the region is reported again when it returns."""
+        tracker = create_detection_tracker({'tracking': {'min_hits': 1, 'window': 1, 'max_misses': 2}})
+        box = [100, 100, 200, 200]
+        self.assertEqual(len(tracker.update([_detection(box)])), 1)
+        tracker.update([])
+        tracker.update([])
+        self.assertEqual(len(tracker.tracks), 1)
+        tracker.update([])
+        self.assertEqual(tracker.tracks, [])
+        self.assertEqual(len(tracker.update([_detection(box)])), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+import tracemalloc
+import unittest
+
+import cv2
+import numpy as np
+
+from src.frame_history import FrameHistory, build_contact_sheet, create_frame_history, flush_contact_sheets
+
+
+def _frame(value, width=640, height=360):
+    frame = np.full((height, width, 3), value % 256, dtype=np.uint8)
+    # Some detail, so the JPEG sizes are realistic.
+    cv2.putText(frame, str(value), (20, 200), cv2.FONT_HERSHEY_SIMPLEX, 4, (0, 0, 255), 8)
+    return frame
+
+
+class TestFrameHistory(unittest.TestCase):
+
+    def test_disabled_by_default(self):
+        """Test that the frame history is only created when enabled."""
+        self.assertIsNone(create_frame_history({}))
+        self.assertEqual(create_frame_history({'frame_history': True}).pre_frames, 10)
+        self.assertEqual(create_frame_history({'frame_history': {'interval': 5}}).interval, 5)
+
+    def test_ring_buffer_is_sampled_and_capped(self):
+        """Test that frames are sampled every interval and that the frame count and bytes stay within the limits."""
+        history = FrameHistory(interval=2, pre_frames=4, frame_width=160)
+        self.assertTrue(history.add(_frame(0), 0))
+        self.assertFalse(history.add(_frame(1), 1))
+        for second in range(2, 20, 2):
+            self.assertTrue(history.add(_frame(second), second))
+        self.assertEqual([sample_time for sample_time, _ in history._frames], [12, 14, 16, 18])
+        decoded = cv2.imdecode(np.frombuffer(history._frames[-1][1], dtype=np.uint8), cv2.IMREAD_COLOR)
+        self.assertEqual(decoded.shape, (90, 160, 3))
+
+        history = FrameHistory(interval=0, pre_frames=100, max_bytes=20000, frame_width=160)
+        for second in range(100):
+            history.add(_frame(second), second)
+        stats = history.stats()
+        self.assertLessEqual(stats['history_bytes'], 20000)
+        self.assertEqual(stats['history_frames'] + stats['history_dropped'], 100)
+        self.assertEqual(stats['history_bytes'], sum(len(jpeg) for _, jpeg in history._frames))
+
+    def test_contact_sheet_of_frames_around_trigger(self):
+        """Test that a trigger sends one contact sheet with the frames before and after it, built off the stream."""
+        history = FrameHistory(interval=1, pre_frames=3, post_frames=2, frame_width=100, columns=5)
+        sheets = []
+        for second in range(5):
+            history.add(_frame(second, 400, 200), second)
+        self.assertTrue(history.trigger(4, sheets.append))
+        self.assertFalse(history.trigger(4, sheets.append))
+        history.add(_frame(5, 400, 200), 5)
+        self.assertEqual(history.stats()['contact_sheets'], 0)
+        history.add(_frame(6, 400, 200), 6)
+        flush_contact_sheets()
+
+        sheet, = sheets
+        decoded = cv2.imdecode(np.frombuffer(sheet, dtype=np.uint8), cv2.IMREAD_COLOR)
+        # Frames 2-4 before and 5-6 after the trigger, 100x50 thumbnails in one row.
+        self.assertEqual(decoded.shape, (50, 500, 3))
+        self.assertTrue(history.trigger(6, sheets.append))
+
+        # Stopping the stream sends what was collected.
+        history.close()
+        flush_contact_sheets()
+        self.assertEqual(len(sheets), 2)
+        self.assertIsNone(build_contact_sheet([], 0))
+
+    def test_memory_is_constant_over_a_long_print(self):
+        """Test that the memory held by the history stops growing once the ring buffer is full, alerts included."""
+        history = FrameHistory(interval=2, pre_frames=10, post_frames=3, frame_width=160)
+        frames = [_frame(value) for value in range(16)]
+        sheets = []
+
+        def run(start, samples):
+            for i in range(start, start + samples):
+                history.add(frames[i % len(frames)], i * 2)
+                if i % 50 == 0:
+                    history.trigger(i * 2, lambda sheet: sheets.append(len(sheet)))
+            flush_contact_sheets()
+
+        tracemalloc.start()
+        try:
+            run(0, 200)
+            warm_memory = tracemalloc.get_traced_memory()[0]
+            run(200, 2000)
+            memory = tracemalloc.get_traced_memory()[0]
+        finally:
+            tracemalloc.stop()
+        self.assertEqual(len(sheets), 44)
+        self.assertLess(memory - warm_memory, 64 * 1024)
+
+
+if __name__ == '__main__':
+    unittest.main()
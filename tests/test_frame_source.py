@@ -0,0 +1,150 @@
+import http.server
+import tempfile
+import threading
+import time
+import unittest
+
+import cv2
+import numpy as np
+
+from src import frame_source
+from src.frame_source import FrameSource, HardwareFrameSource, MjpegFrameSource, create_frame_source
+
+
+def _write_video(path, frames=40, fps=20):
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'MJPG'), fps, (64, 48))
+    for i in range(frames):
+        writer.write(np.full((48, 64, 3), i * 5, dtype=np.uint8))
+    writer.release()
+
+
+class _MjpegHandler(http.server.BaseHTTPRequestHandler):
+    """Serves 128x96 JPEG frames as an MJPEG stream, with Content-Length headers unless the path is /no-length."""
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'multipart/x-mixed-replace; boundary="frame"')
+        self.end_headers()
+        try:
+            for i in range(200):
+                _, jpeg = cv2.imencode('.jpg', np.full((96, 128, 3), i % 256, dtype=np.uint8))
+                headers = b'Content-Type: image/jpeg\r\n'
+                if self.path != '/no-length':
+                    headers += f'Content-Length: {len(jpeg)}\r\n'.encode()
+                self.wfile.write(b'--frame\r\n' + headers + b'\r\n' + jpeg.tobytes() + b'\r\n')
+                time.sleep(0.02)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestFrameSource(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.video_path = f"{self.directory.name}/stream.avi"
+        _write_video(self.video_path)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_latest_returns_newest_frame(self):
+        """Test that only the newest frame is served and the frames in between are counted as dropped."""
+        source = FrameSource(self.video_path)
+        source.start()
+        try:
+            time.sleep(0.5)
+            frame, frame_time = source.latest()
+            self.assertEqual(frame.shape, (48, 64, 3))
+            self.assertLess(time.time() - frame_time, 0.2)
+
+            # The frame handed out stays untouched while newer frames are captured.
+            held_frame = frame.copy()
+            time.sleep(0.3)
+            np.testing.assert_array_equal(frame, held_frame)
+
+            next_frame, next_frame_time = source.latest()
+            self.assertGreater(next_frame_time, frame_time)
+            stats = source.stats()
+            self.assertGreater(stats['capture_fps'], 0)
+            self.assertGreater(stats['dropped_frames'], 0)
+        finally:
+            source.stop()
+
+    def test_reconnect_with_backoff(self):
+        """Test that a stream that cannot be opened is reported and retried with a growing delay."""
+        delays = []
+        source = FrameSource(f"{self.directory.name}/missing.avi")
+
+        def wait(delay):
+            delays.append(delay)
+            if len(delays) == 3:
+                source._stop_event.set()
+
+        source._stop_event.wait = wait
+        with self.assertLogs(frame_source.logger, level='ERROR'):
+            source._capture()
+        self.assertEqual(source.error, 'open')
+        self.assertEqual(delays, [1, 2, 4])
+        self.assertEqual(source.latest(), (None, None))
+
+
+class TestMjpegFrameSource(unittest.TestCase):
+
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), _MjpegHandler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def _read_frames(self, source):
+        source.start()
+        try:
+            time.sleep(0.5)
+            frame, frame_time = source.latest()
+            # The frame is decoded once, when first used.
+            self.assertIs(source.latest()[0], frame)
+            time.sleep(0.1)
+            next_frame, next_frame_time = source.latest()
+            self.assertGreater(next_frame_time, frame_time)
+            return frame, source.stats()
+        finally:
+            source.stop()
+
+    def test_decodes_only_used_frames(self):
+        """Test that the multipart stream is parsed, and only the frames that are used are decoded."""
+        for path in ('/', '/no-length'):
+            with self.subTest(path=path):
+                source = MjpegFrameSource(self.url + path, 'left')
+                frame, stats = self._read_frames(source)
+                self.assertEqual(frame.shape, (96, 128, 3))
+                self.assertGreater(stats['dropped_frames'], 0)
+                self.assertEqual(stats['decode_errors'], 0)
+                self.assertEqual(stats['decoded_frames'], 2)
+
+    def test_reduced_decode(self):
+        """Test that reduce decodes the frames at a fraction of their size, reported as the scale of the source."""
+        source = create_frame_source(self.url, decoder={'type': 'mjpeg', 'reduce': 4})
+        self.assertEqual(source.scale, 4)
+        frame, _ = self._read_frames(source)
+        self.assertEqual(frame.shape, (24, 32, 3))
+
+    def test_create_frame_source(self):
+        """Test that the decoder setting selects the frame source, and that invalid ones are rejected."""
+        self.assertIs(type(create_frame_source(self.url)), FrameSource)
+        self.assertIs(type(create_frame_source(self.url, decoder='opencv_hw')), HardwareFrameSource)
+        self.assertIs(type(create_frame_source(self.url, decoder='mjpeg')), MjpegFrameSource)
+        with self.assertRaises(ValueError):
+            create_frame_source(self.url, decoder='vdpau')
+        with self.assertRaises(ValueError):
+            create_frame_source(self.url, decoder={'type': 'mjpeg', 'reduce': 3})
+        with self.assertRaises(ValueError):
+            create_frame_source('recordings/print.mp4', decoder='mjpeg')
+
+
+if __name__ == '__main__':
+    unittest.main()
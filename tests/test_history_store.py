@@ -0,0 +1,104 @@
+import os
+import tempfile
+import time
+import unittest
+
+from src.history_store import HistoryStore, class_summaries, connect, downsample, job_summaries
+
+HOUR = 3600
+
+
+def _detection(name, confidence):
+    return {'name': name, 'confidence': confidence, 'box': [0, 0, 10, 10]}
+
+
+class TestHistoryStore(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.path = os.path.join(self.directory.name, 'history', 'history.db')
+
+    def _store(self, **kwargs):
+        store = HistoryStore(self.path, **kwargs)
+        self.addCleanup(store.close, 5)
+        return store
+
+    def test_job_summaries(self):
+        """Test that state changes delimit jobs, and that their inferences and detections are summarized."""
+        store = self._store()
+        start = time.time() - 10 * HOUR
+        store.record_state('left', 'standby', start - 60)
+        store.record_state('left', 'printing', start)
+        store.record_state('right', 'printing', start)
+        # A repeated 'printing' (e.g. after a restart of the monitor) continues the job.
+        store.record_state('left', 'printing', start + 5)
+        for i in range(100):
+            detections = [_detection('spaghetti', 0.7)] if i >= 90 else []
+            reported = [_detection('spaghetti', 0.7)] if i == 95 else []
+            store.record_inference('left', start + 10 + i, (i + 1) / 1000, 0.001, detections, reported)
+        store.record_state('left', 'cancelled', start + 200)
+        store.record_inference('left', start + 300, 0.5, 0.001, [_detection('error', 0.9)])
+        store.record_inference('right', start + 300, 0.02, 0.001, [_detection('error', 0.9)],
+                               [_detection('error', 0.9)])
+        store.record_state('right', 'complete', start + 400)
+        self.assertTrue(store.flush(5))
+        self.assertEqual(store.stats(), {'history_pending': 0, 'history_written': 108, 'history_dropped': 0})
+
+        left, right = job_summaries(connect(self.path))
+        self.assertEqual((left['printer'], left['start'], left['end'], left['result']),
+                         ('left', start, start + 200, 'cancelled'))
+        self.assertEqual(left['frames'], 100)
+        self.assertAlmostEqual(left['latency_p50'], 0.051)
+        self.assertAlmostEqual(left['latency_p99'], 0.1)
+        self.assertAlmostEqual(left['latency_mean'], 0.0505)
+        self.assertEqual(left['classes'], {'spaghetti': {'detections': 10, 'reports': 1}})
+        self.assertEqual(right['classes'], {'error': {'detections': 1, 'reports': 1}})
+        self.assertEqual([job['id'] for job in job_summaries(connect(self.path), printer='right')], [right['id']])
+
+        classes = class_summaries([left, right])
+        self.assertEqual(classes['error']['false_positive_rate'], 1.0)
+        self.assertEqual(classes['spaghetti']['false_positive_rate'], 0.0)
+        self.assertEqual(classes['spaghetti']['jobs_reported'], 1)
+
+    def test_downsampling_and_retention(self):
+        """Test that old inferences are kept per hour and that records beyond the retention are deleted."""
+        store = self._store()
+        now = time.time() // HOUR * HOUR
+        store.record_state('left', 'printing', now - 30 * HOUR)
+        for i in range(10):
+            store.record_inference('left', now - 30 * HOUR + i, 0.01 * (i + 1), 0.001, [])
+        store.record_inference('left', now - 100 * HOUR, 0.01, 0.001, [_detection('error', 0.9)])
+        store.record_state('left', 'complete', now - 29 * HOUR)
+        store.flush(5)
+
+        connection = connect(self.path)
+        with connection:
+            downsample(connection, now - 24 * HOUR, now - 48 * HOUR)
+        self.assertEqual(connection.execute('SELECT COUNT(*) FROM inferences').fetchone()[0], 0)
+        self.assertEqual(connection.execute('SELECT COUNT(*) FROM detections').fetchone()[0], 0)
+        self.assertEqual(connection.execute('SELECT hour, frames FROM inference_hours').fetchall(),
+                         [(now - 30 * HOUR, 10)])
+
+        job, = job_summaries(connection)
+        self.assertEqual(job['frames'], 10)
+        self.assertAlmostEqual(job['latency_mean'], 0.055)
+        self.assertAlmostEqual(job['latency_max'], 0.1)
+        self.assertIsNone(job['latency_p99'])
+
+    def test_recording_does_not_wait_for_the_disk(self):
+        """Test that records are queued and written in batches, and the oldest are dropped beyond max_pending."""
+        store = self._store(flush_interval=60, batch_size=1000, max_pending=50)
+        now = time.time()
+        start_time = time.perf_counter()
+        for i in range(100):
+            store.record_inference('left', now + i, 0.01, 0.001, [])
+        self.assertLess(time.perf_counter() - start_time, 0.1)
+        self.assertEqual(store.stats()['history_dropped'], 50)
+        store.flush(5)
+        rows = connect(self.path).execute('SELECT MIN(time), COUNT(*) FROM inferences').fetchone()
+        self.assertEqual(rows, (now + 50, 50))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,229 @@
+import pathlib
+import tempfile
+import threading
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
+
+import cv2
+import numpy as np
+import openvino as ov
+import openvino.opset13 as ops
+
+from src import inference
+from src.inference import (BatchingInferenceBackend, FailoverInferenceBackend, InferenceBackend, InferenceError,
+                           _prepare_model, load_compiled_model, select_device)
+
+
+def _build_model(batch):
+    """A tiny model with a YOLO-like [N, 3, 32, 32] -> [N, 16, 9] layout."""
+    image = ops.parameter(batch + [3, 32, 32], ov.Type.f32, name='images')
+    weights = np.random.default_rng(0).normal(size=(9, 3, 8, 8)).astype(np.float32)
+    head = ops.convolution(image, ops.constant(weights), [8, 8], [0, 0], [0, 0], [1, 1])
+    head = ops.reshape(head, ops.constant(np.array([0, 9, 16], dtype=np.int64)), True)
+    output = ops.sigmoid(ops.transpose(head, ops.constant(np.array([0, 2, 1], dtype=np.int64))))
+    return ov.Model([output], [image])
+
+
+# Compare in full precision, CPUs with bf16 support infer in bf16 by default.
+F32 = {'INFERENCE_PRECISION_HINT': 'f32'}
+
+
+def _random_frame(seed):
+    return np.random.default_rng(seed).integers(0, 256, size=(48, 64, 3), dtype=np.uint8)
+
+
+class TestInference(unittest.TestCase):
+
+    def test_backend_matches_numpy_pre_processing(self):
+        """Test that the in-graph pre-processing gives the same results as resizing and normalizing with NumPy."""
+        core = ov.Core()
+        reference_model = core.compile_model(_build_model([1]), 'CPU', F32)
+        backend = InferenceBackend(core.compile_model(_prepare_model(_build_model([1])), 'CPU', F32))
+        output = backend.create_output_buffer()
+
+        for seed in range(4):
+            frame = _random_frame(seed)
+            input_frame = cv2.resize(frame, (32, 32)).transpose((2, 0, 1))[None, :, :, :].astype(float) / 255.0
+            expected = reference_model([input_frame])[reference_model.output(0)]
+            np.testing.assert_allclose(backend.infer(frame, output), expected, rtol=1e-5, atol=1e-6)
+
+    def test_batching_backend_matches_single_frame_inference(self):
+        """Test that batched results are routed back to the frame they were computed for."""
+        core = ov.Core()
+        single = InferenceBackend(core.compile_model(_prepare_model(_build_model([1])), 'CPU', F32))
+        batched = BatchingInferenceBackend(
+            core.compile_model(_prepare_model(_build_model([1]), max_batch=4), 'CPU', F32), max_batch=4, max_wait=0.2)
+
+        frames = [_random_frame(i) for i in range(8)]
+        try:
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                results = list(executor.map(lambda frame: batched.infer(frame, batched.create_output_buffer()), frames))
+            stats = batched.stats()
+        finally:
+            batched.close()
+
+        for frame, result in zip(frames, results):
+            np.testing.assert_allclose(result, single.infer(frame, single.create_output_buffer()), rtol=1e-5)
+        self.assertEqual(stats['frames'], 8)
+        self.assertLess(stats['batches'], 8)
+        self.assertEqual(stats['queue_depth'], 0)
+
+    def test_load_compiled_model_uses_cache(self):
+        """Test that the second load imports the exported blob instead of compiling the model again."""
+        with tempfile.TemporaryDirectory() as directory:
+            model_path = f"{directory}/model.xml"
+            ov.save_model(_build_model([1]), model_path)
+            cache_dir = f"{directory}/cache"
+
+            with self.assertLogs(inference.logger, level='INFO') as logs:
+                load_compiled_model(model_path, 'CPU', cache_dir=cache_dir)
+            self.assertTrue(any('Compiled model for CPU' in line for line in logs.output))
+
+            with self.assertLogs(inference.logger, level='INFO') as logs:
+                compiled_model = load_compiled_model(model_path, 'CPU', cache_dir=cache_dir)
+            self.assertTrue(any('Loaded compiled model from' in line for line in logs.output))
+
+            backend = InferenceBackend(compiled_model)
+            self.assertEqual(backend.infer(_random_frame(0), backend.create_output_buffer()).shape, (1, 16, 9))
+
+
+    def test_select_device_skips_missing_and_failing_devices(self):
+        """Test that devices that are not present or fail to compile are skipped, and the others are benchmarked."""
+        compiled_devices = []
+
+        def compile_model(device):
+            compiled_devices.append(device)
+            if device == 'GPU':
+                raise RuntimeError("GPU driver fault")
+            return ov.Core().compile_model(_prepare_model(_build_model([1])), 'CPU')
+
+        with self.assertLogs(inference.logger, level='INFO') as logs:
+            device, compiled_model = select_device(['GPU', 'NPU', 'CPU', 'AUTO:CPU'], compile_model,
+                                                   available_devices=['GPU.0', 'CPU'])
+        self.assertIn(device, ('CPU', 'AUTO:CPU'))
+        self.assertEqual(compiled_devices, ['GPU', 'CPU', 'AUTO:CPU'])
+        self.assertTrue(any('Warm-up inference on AUTO:CPU' in line for line in logs.output))
+
+        with self.assertRaises(InferenceError):
+            select_device(['GPU'], compile_model, available_devices=['GPU'])
+
+    def test_failover_to_fallback_device(self):
+        """Test that a failed inference is retried on the fallback backend, which serves all later inferences."""
+        fallback = InferenceBackend(ov.Core().compile_model(_prepare_model(_build_model([1])), 'CPU', F32))
+
+        class FailingBackend:
+            input_height, input_width = 32, 32
+            calls = 0
+            closed = threading.Event()
+
+            def infer(self, frame, output):
+                self.calls += 1
+                raise RuntimeError("GPU driver fault")
+
+            def create_output_buffer(self):
+                return fallback.create_output_buffer()
+
+            def stats(self):
+                return {}
+
+            def close(self):
+                self.closed.set()
+
+        primary = FailingBackend()
+        backend = FailoverInferenceBackend(primary, lambda: fallback, 'GPU', 'CPU')
+        frame = _random_frame(0)
+        with self.assertLogs(inference.logger, level='ERROR'):
+            result = backend.infer(frame, backend.create_output_buffer())
+        np.testing.assert_allclose(result, fallback.infer(frame, fallback.create_output_buffer()))
+        backend.infer(frame, backend.create_output_buffer())
+        self.assertEqual(primary.calls, 1)
+        self.assertEqual(backend.stats(), {'failovers': 1})
+        self.assertTrue(primary.closed.wait(5))
+
+    def test_concurrent_failover(self):
+        """Test that streams failing on the primary backend at the same time are all retried on one fallback."""
+        fallback = InferenceBackend(ov.Core().compile_model(_prepare_model(_build_model([1])), 'CPU', F32))
+        failing = threading.Barrier(2)
+
+        class HungBackend:
+            input_height, input_width = 32, 32
+
+            def infer(self, frame, output):
+                failing.wait(5)
+                raise RuntimeError("GPU hung")
+
+            def close(self):
+                pass
+
+        fallbacks = []
+        backend = FailoverInferenceBackend(HungBackend(), lambda: fallbacks.append(fallback) or fallback, 'GPU', 'CPU')
+        with self.assertLogs(inference.logger, level='ERROR'), ThreadPoolExecutor(max_workers=2) as executor:
+            results = list(executor.map(
+                lambda seed: backend.infer(_random_frame(seed), fallback.create_output_buffer()), range(2)))
+        self.assertEqual(len(results), 2)
+        self.assertEqual(fallbacks, [fallback])
+
+        # A failure of the fallback itself is raised.
+        with patch.object(fallback, 'infer', side_effect=RuntimeError("CPU fault")):
+            with self.assertRaises(RuntimeError):
+                backend.infer(_random_frame(0), fallback.create_output_buffer())
+
+    def test_backend_timeout_keeps_the_pool_usable(self):
+        """Test that an infer request still running after a timeout is replaced instead of going back to the pool."""
+        backend = InferenceBackend(ov.Core().compile_model(_prepare_model(_build_model([1])), 'CPU', F32),
+                                   pool_size=1)
+        request = backend._requests.get()
+
+        class HungRequest:
+            started = False
+            cancelled = False
+
+            def get_input_tensor(self):
+                return request.get_input_tensor()
+
+            def start_async(self):
+                if self.started:
+                    raise RuntimeError("Infer Request is busy")
+                self.started = True
+
+            def wait_for(self, timeout_ms):
+                return False
+
+            def cancel(self):
+                self.cancelled = True
+
+        hung_request = HungRequest()
+        backend._requests.put(hung_request)
+        with self.assertRaises(InferenceError):
+            backend.infer(_random_frame(0), backend.create_output_buffer())
+        self.assertTrue(hung_request.cancelled)
+        self.assertEqual(backend._stuck_requests, [hung_request])
+        backend.infer(_random_frame(0), backend.create_output_buffer())
+
+    def test_batching_backend_timeout(self):
+        """Test that an inference not done within the timeout raises an InferenceError."""
+        compiled_model = ov.Core().compile_model(_prepare_model(_build_model([1]), max_batch=4), 'CPU')
+        backend = BatchingInferenceBackend(compiled_model, max_batch=4, max_wait=0.5, timeout=0.05)
+        try:
+            with self.assertRaises(InferenceError):
+                backend.infer(_random_frame(0), backend.create_output_buffer())
+        finally:
+            backend.close()
+
+    def test_model_variant(self):
+        """Test that `model_variant` picks the model file next to the bundled one, and unknown variants are rejected."""
+        with tempfile.TemporaryDirectory() as directory:
+            ov.save_model(_build_model([1]), f"{directory}/model_torch_int8.xml")
+            with patch.object(inference, 'MODEL_PATH', pathlib.Path(directory).joinpath('model_torch.xml')):
+                backend = inference.create_inference_backend({'device': 'CPU', 'model_cache': False,
+                                                              'model_variant': 'int8'})
+                self.assertEqual(backend.infer(_random_frame(0), backend.create_output_buffer()).shape, (1, 16, 9))
+
+                with self.assertRaises(FileNotFoundError), self.assertLogs(inference.logger, level='ERROR'):
+                    inference.create_inference_backend({'device': 'CPU', 'model_cache': False})
+                with self.assertRaises(ValueError):
+                    inference.create_inference_backend({'device': 'CPU', 'model_variant': 'int4'})
+
+if __name__ == '__main__':
+    unittest.main()
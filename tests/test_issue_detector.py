@@ -0,0 +1,316 @@
+import http.server
+import queue
+import threading
+import time
+import unittest
+from unittest.mock import ANY, MagicMock, patch
+
+import cv2
+import numpy as np
+
+from src import issue_detector
+from src.config import ConfigError, get_config
+from src.region_planner import RegionPlanner
+
+TEST_CONFIG = {
+    'issue_detector': {
+        'stream_url': 'http://127.0.0.1:8080/?action=stream',
+        'confidence_thresholds': {
+            'error': 0.75,
+            'spaghetti': 0.60
+        },
+        'detection_area_of_interest': [100, 120, 590, 320]
+    }
+}
+CONFIDENCE_THRESHOLDS = TEST_CONFIG['issue_detector']['confidence_thresholds']
+DETECTION_AREA_OF_INTEREST = TEST_CONFIG['issue_detector']['detection_area_of_interest']
+
+
+def _reference_pre_process_detection_results(detection_results, original_width, original_height, input_width,
+                                             input_height):
+    """The original per-row implementation, kept as the reference for the vectorized one."""
+    boxes = []
+    confidences = []
+    class_ids = []
+
+    for detection in detection_results:
+        center_x, center_y, w, h = detection[0:4]
+        objectness_score = detection[4]
+        class_confidences = detection[5:]
+        class_id_raw = np.argmax(class_confidences)
+        confidence = objectness_score * class_confidences[class_id_raw]
+        class_name = issue_detector.MODEL_CLASS_NAMES.get(class_id_raw, f"unknown_class_{class_id_raw}")
+        if confidence < CONFIDENCE_THRESHOLDS.get(class_name, 1.0):
+            continue
+        boxes.append([int((center_x - w / 2) * original_width / input_width),
+                      int((center_y - h / 2) * original_height / input_height),
+                      int((center_x + w / 2) * original_width / input_width),
+                      int((center_y + h / 2) * original_height / input_height)])
+        confidences.append(float(confidence))
+        class_ids.append(class_id_raw)
+
+    indices = cv2.dnn.NMSBoxes(boxes, confidences, 0, 0.4)
+
+    detections = []
+    aoi_x_min, aoi_y_min, aoi_x_max, aoi_y_max = DETECTION_AREA_OF_INTEREST
+    for i in (indices.flatten() if len(indices) > 0 else []):
+        x_min, y_min, x_max, y_max = boxes[i]
+        center_x = (x_min + x_max) / 2
+        center_y = (y_min + y_max) / 2
+        if aoi_x_min <= center_x <= aoi_x_max and aoi_y_min <= center_y <= aoi_y_max:
+            detections.append({
+                "name": issue_detector.MODEL_CLASS_NAMES.get(class_ids[i]),
+                "confidence": confidences[i],
+                "box": boxes[i]
+            })
+    return detections
+
+
+def _random_detection_results(rng, rows=25200, num_classes=4, positives=60):
+    """Builds a YOLOv5-like output tensor where only a handful of rows have a meaningful objectness score."""
+    results = np.zeros((rows, 5 + num_classes), dtype=np.float32)
+    results[:, 0:2] = rng.uniform(0, 640, size=(rows, 2))
+    results[:, 2:4] = rng.uniform(5, 200, size=(rows, 2))
+    results[:, 4] = rng.uniform(0, 0.05, size=rows)
+    results[:, 5:] = rng.uniform(0, 1, size=(rows, num_classes))
+    hot_rows = rng.choice(rows, size=positives, replace=False)
+    results[hot_rows, 4] = rng.uniform(0.5, 1, size=positives)
+    return results
+
+
+class _MjpegHandler(http.server.BaseHTTPRequestHandler):
+    """Serves a 320x240 JPEG frame as an MJPEG stream."""
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'multipart/x-mixed-replace; boundary=frame')
+        self.end_headers()
+        _, jpeg = cv2.imencode('.jpg', np.full((240, 320, 3), 128, dtype=np.uint8))
+        try:
+            for _ in range(100):
+                self.wfile.write(b'--frame\r\nContent-Type: image/jpeg\r\n\r\n' + jpeg.tobytes() + b'\r\n')
+                time.sleep(0.05)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestIssueDetector(unittest.TestCase):
+
+    def setUp(self):
+        # The default thresholds and area of interest are read from the config when a frame is post-processed.
+        config_patch = patch('src.config._config', TEST_CONFIG)
+        config_patch.start()
+        self.addCleanup(config_patch.stop)
+
+    def test_pre_process_detection_results_matches_reference(self):
+        """Test that the vectorized post-processing returns exactly the same detections as the per-row loop."""
+        rng = np.random.default_rng(42)
+        for _ in range(20):
+            detection_results = _random_detection_results(rng)
+            with patch.object(issue_detector, 'logger'):
+                actual = issue_detector._pre_process_detection_results(detection_results, 1280, 720, 640, 640)
+            expected = _reference_pre_process_detection_results(detection_results, 1280, 720, 640, 640)
+            self.assertEqual(actual, expected)
+
+    def test_pre_process_detection_results_empty(self):
+        """Test that an output without any passing detection yields no detections."""
+        detection_results = np.zeros((25200, 9), dtype=np.float32)
+        self.assertEqual(issue_detector._pre_process_detection_results(detection_results, 1280, 720, 640, 640), [])
+
+    def test_pre_process_region_results(self):
+        """Test that region boxes are mapped back to the frame and suppressed across overlapping regions."""
+        detection_results = np.zeros((2, 9), dtype=np.float32)
+        # A spaghetti in the middle of a 320x320 model input.
+        detection_results[0] = [160, 160, 40, 40, 0.9, 0, 0, 0, 0.9]
+        weaker_results = detection_results.copy()
+        weaker_results[0, 4] = 0.8
+        detections = issue_detector._pre_process_region_results([detection_results, weaker_results],
+                                                                [(100, 100, 420, 420), (100, 100, 420, 420)], 320, 320,
+                                                                area_of_interest=[0, 0, 1280, 720])
+        self.assertEqual(detections, [{'name': 'spaghetti', 'confidence': detections[0]['confidence'],
+                                       'box': [240, 240, 280, 280]}])
+        self.assertAlmostEqual(detections[0]['confidence'], 0.81, places=5)
+
+        # A half-size region halves the box.
+        detections = issue_detector._pre_process_region_results([detection_results], [(0, 360, 160, 520)], 320, 320,
+                                                                area_of_interest=[0, 0, 1280, 720])
+        self.assertEqual(detections[0]['box'], [70, 430, 90, 450])
+
+        with self.assertLogs(issue_detector.logger, level='DEBUG') as logs:
+            issue_detector._pre_process_region_results([detection_results], [(100, 100, 420, 420)], 320, 320,
+                                                       area_of_interest=[0, 0, 270, 720], edge_margin=32)
+        self.assertIn('10px inside the area of interest edge', logs.output[0])
+
+        # Without an area of interest, in the arguments or the configuration, the whole frame is kept.
+        with patch('src.config._config', {'issue_detector': dict(TEST_CONFIG['issue_detector'],
+                                                                 detection_area_of_interest=None)}):
+            detections = issue_detector._pre_process_region_results([detection_results], [(2000, 2000, 2320, 2320)],
+                                                                    320, 320, edge_margin=32)
+        self.assertEqual(detections[0]['box'], [2140, 2140, 2180, 2180])
+
+    def test_send_detection_notification(self):
+        """Test that the annotated frame is sent as a JPEG with the detection summary through the given notifier."""
+        frame = np.zeros((720, 1280, 3), dtype=np.uint8)
+        detections = [{'name': 'spaghetti', 'confidence': 0.8, 'box': [100, 100, 300, 300]}]
+        messages = issue_detector._annotate_detections(frame, detections)
+        self.assertEqual(messages, ["'spaghetti' with confidence 0.80"])
+        self.assertTrue(frame.any())
+
+        notifications = []
+        with patch.object(issue_detector, 'logger'):
+            sent = issue_detector._send_detection_notification(
+                {'name': 'q1-left'}, frame, messages, lambda message, image: notifications.append((message, image)))
+        self.assertTrue(sent)
+        (message, image), = notifications
+        self.assertEqual(message, "[q1-left] Detected issues: 'spaghetti' with confidence 0.80")
+        self.assertEqual(cv2.imdecode(np.frombuffer(image, dtype=np.uint8), cv2.IMREAD_COLOR).shape, frame.shape)
+
+
+    def test_apply_config_change(self):
+        """Test that a reloaded configuration reaches the running streams, and an invalid one changes nothing."""
+        config = {
+            'printers': [{'name': 'left', 'ip': '10.0.0.1', 'port': 7125, 'stream_url': 'http://left'},
+                         {'name': 'right', 'ip': '10.0.0.2', 'port': 7125, 'stream_url': 'http://right'}],
+            'notifier': {'url': 'http://test-server', 'token': 'test-token'},
+            'polling_interval_seconds': 30,
+            'issue_detector': dict(TEST_CONFIG['issue_detector'], tracking={'min_hits': 3}),
+        }
+        printers_by_name = {printer['name']: printer for printer in issue_detector.get_printers(config)}
+        left_updates = queue.Queue()
+        right_worker = (MagicMock(), MagicMock(), queue.Queue())
+        stream_workers = {'left': (MagicMock(), MagicMock(), left_updates), 'right': right_worker}
+
+        new_config = dict(config, issue_detector=dict(config['issue_detector'], tracking={'min_hits': 2},
+                                                      confidence_thresholds={'spaghetti': 0.5}, device='GPU'))
+        new_config['printers'] = [config['printers'][0], dict(config['printers'][1], stream_url='http://right2')]
+        with patch.object(issue_detector, '_start_stream') as start_stream, \
+                self.assertLogs(issue_detector.logger, level='WARNING') as logs:
+            detector_config, new_printers_by_name = issue_detector._apply_config_change(
+                new_config, config['issue_detector'], printers_by_name, stream_workers, MagicMock())
+
+        self.assertIs(get_config(), new_config)
+        self.assertIs(detector_config, new_config['issue_detector'])
+        self.assertIn('Changes of device take effect when the issue detector is started again.', logs.output[0])
+        update = left_updates.get_nowait()
+        self.assertEqual(update['printer']['confidence_thresholds'], {'spaghetti': 0.5})
+        self.assertEqual(update['tracker']._min_hits, 2)
+        self.assertNotIn('rate_controller', update)
+        # The stream whose URL changed is reconnected.
+        right_worker[1].set.assert_called_once()
+        right_worker[0].join.assert_called_once()
+        self.assertTrue(right_worker[2].empty())
+        start_stream.assert_called_once_with(new_printers_by_name['right'], ANY, detector_config)
+        self.assertIs(stream_workers['right'], start_stream.return_value)
+
+        invalid_config = dict(new_config, issue_detector=dict(new_config['issue_detector'],
+                                                              confidence_thresholds={'spaghetti': 5}))
+        with self.assertRaises(ConfigError):
+            issue_detector._apply_config_change(invalid_config, detector_config, new_printers_by_name,
+                                                {'left': (MagicMock(), MagicMock(), left_updates)}, MagicMock())
+        self.assertIs(get_config(), new_config)
+        self.assertTrue(left_updates.empty())
+
+    def test_stream_handles_frame_source_errors(self):
+        """Test that a frame source that can't be created ends the stream thread through its error handling."""
+        printer = {'name': 'left', 'stream_url': 'rtsp://left', 'decoder': 'mjpeg', 'confidence_thresholds': {},
+                   'detection_area_of_interest': None}
+        frame_history = MagicMock()
+        with patch.object(issue_detector, 'get_history_store', return_value=None), \
+                self.assertLogs(issue_detector.logger, level='ERROR') as logs:
+            issue_detector._detect_issues_in_stream(printer, MagicMock(), MagicMock(), MagicMock(), MagicMock(),
+                                                    threading.Event(), frame_history=frame_history)
+        self.assertIn('The mjpeg decoder reads HTTP streams, not rtsp://left', logs.output[0])
+        frame_history.close.assert_called_once()
+
+    def test_stream_handles_component_errors(self):
+        """Test that stream component settings a class rejects end that stream thread only, as a failed stream."""
+        printer = {'name': 'left', 'stream_url': 'http://left', 'decoder': None, 'confidence_thresholds': {},
+                   'detection_area_of_interest': None}
+        config = dict(TEST_CONFIG['issue_detector'], tracking={'min_hit': 3})
+        with patch.object(issue_detector, '_detect_issues_in_stream') as detect_issues, \
+                self.assertLogs(issue_detector.logger, level='ERROR') as logs:
+            thread, stop_event, _ = issue_detector._start_stream(printer, MagicMock(), config)
+            thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertFalse(stop_event.is_set())
+        detect_issues.assert_not_called()
+        self.assertIn("[left] Failed to create the stream components", logs.output[0])
+
+    def test_stream_crops_reduced_decode(self):
+        """Test that an area of interest scaled to a reduced mjpeg decode is cropped in whole pixels."""
+        self.assertEqual(issue_detector._scale_area_of_interest([101, 51, 301, 151], 2), [50, 25, 151, 76])
+
+        server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), _MjpegHandler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        printer = {'name': 'left', 'stream_url': f"http://127.0.0.1:{server.server_address[1]}/",
+                   'decoder': {'type': 'mjpeg', 'reduce': 2}, 'confidence_thresholds': CONFIDENCE_THRESHOLDS,
+                   'detection_area_of_interest': [101, 51, 301, 151]}
+
+        stop_event = threading.Event()
+        crops = []
+
+        def infer(crop, output_buffer):
+            crops.append(crop.shape)
+            stop_event.set()
+            return output_buffer
+
+        backend = MagicMock(input_width=64, input_height=64, infer=infer,
+                            **{'create_output_buffer.return_value': np.zeros((1, 10, 9), dtype=np.float32)})
+        with patch.object(issue_detector, 'get_history_store', return_value=None), \
+                patch.object(issue_detector, 'logger') as logger:
+            timer = threading.Timer(10, stop_event.set)
+            timer.start()
+            issue_detector._detect_issues_in_stream(printer, backend, issue_detector.create_rate_controller({}),
+                                                    MagicMock(**{'update.return_value': []}),
+                                                    RegionPlanner(crop=True, margin=0), stop_event)
+            timer.cancel()
+        logger.exception.assert_not_called()
+        # The 101x51 scaled area is grown to the square model input within the 160x120 frame.
+        self.assertEqual(crops, [(101, 101, 3)])
+
+    def test_restart_failed_streams(self):
+        """Test that a stream thread that ended on an error is restarted with a growing delay, notified once."""
+        printers_by_name = {'left': {'name': 'left'}, 'right': {'name': 'right'}}
+        failed_worker = (MagicMock(**{'is_alive.return_value': False}), threading.Event(), queue.Queue())
+        running_worker = (MagicMock(**{'is_alive.return_value': True}), threading.Event(), queue.Queue())
+        stopped_worker = (MagicMock(**{'is_alive.return_value': False}), threading.Event(), queue.Queue())
+        stopped_worker[1].set()
+        stream_workers = {'left': failed_worker, 'right': stopped_worker}
+        failed_streams = {}
+        config = TEST_CONFIG['issue_detector']
+
+        def restart(current_time):
+            with patch.object(issue_detector.time, 'time', return_value=current_time):
+                issue_detector._restart_failed_streams(stream_workers, printers_by_name, MagicMock(), config,
+                                                       failed_streams)
+
+        with patch.object(issue_detector, '_start_stream', side_effect=[failed_worker, running_worker]) as start, \
+                patch.object(issue_detector, 'send_notification') as send_notification, \
+                self.assertLogs(issue_detector.logger, level='ERROR') as logs:
+            restart(1000)
+            self.assertEqual(failed_streams, {'left': (1, 1001, None)})
+            start.assert_not_called()
+            restart(1001)
+            start.assert_called_once_with(printers_by_name['left'], ANY, config)
+            # Failing again right after the restart doubles the delay, without another notification.
+            restart(1010)
+            restart(1011)
+            self.assertEqual(start.call_count, 1)
+            restart(1012)
+            self.assertIs(stream_workers['left'], running_worker)
+            # A stream running for long enough starts over with the initial delay.
+            restart(1012 + issue_detector.STREAM_RESTART_MAX_DELAY)
+        self.assertEqual(failed_streams, {})
+        self.assertIs(stream_workers['right'], stopped_worker)
+        send_notification.assert_called_once_with(
+            "[left] Issue detection stopped on an error, restarting it in 1 seconds")
+        self.assertIn('restarting it in 2 seconds', logs.output[1])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+import multiprocessing
+import threading
+import time
+import unittest
+import urllib.request
+
+from src import metrics
+
+
+def _child_process(metrics_queue):
+    metrics.counter('test_child_total', "Incremented by the child process.").inc(3)
+    stop_event = threading.Event()
+    exporter = metrics.start_exporter(metrics_queue, 'detector', stop_event)
+    stop_event.set()
+    exporter.join()
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_render(self):
+        """Test the Prometheus text format of counters, gauges and histograms, with the process label."""
+        counter = metrics.counter('test_render_total', "A counter.", ('printer',))
+        counter.labels('left').inc()
+        counter.labels('left').inc(2)
+        metrics.gauge('test_render_depth', "A gauge.").set(4)
+        histogram = metrics.histogram('test_render_seconds', "A histogram.", buckets=(0.1, 1))
+        for value in (0.05, 0.5, 0.5, 5):
+            histogram.observe(value)
+        self.assertIs(metrics.counter('test_render_total', "A counter.", ('printer',)), counter)
+
+        text = metrics.render({'monitor': metrics.snapshot()})
+        self.assertIn('# TYPE printer_monitor_test_render_total counter\n', text)
+        self.assertIn('printer_monitor_test_render_total{process="monitor",printer="left"} 3\n', text)
+        self.assertIn('printer_monitor_test_render_depth{process="monitor"} 4\n', text)
+        self.assertIn('printer_monitor_test_render_seconds_bucket{process="monitor",le="0.1"} 1\n', text)
+        self.assertIn('printer_monitor_test_render_seconds_bucket{process="monitor",le="1"} 3\n', text)
+        self.assertIn('printer_monitor_test_render_seconds_bucket{process="monitor",le="+Inf"} 4\n', text)
+        self.assertIn('printer_monitor_test_render_seconds_sum{process="monitor"} 6.05\n', text)
+        self.assertIn('printer_monitor_test_render_seconds_count{process="monitor"} 4\n', text)
+
+    def test_server_aggregates_processes(self):
+        """Test that the endpoint serves the metrics of this process and the ones sent by a forked child process."""
+        metrics.counter('test_parent_total', "Incremented by this process.").inc()
+        server = metrics.start_metrics_server(port=0)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        process = multiprocessing.Process(target=_child_process, args=(metrics.collector_queue(),))
+        process.start()
+        process.join(10)
+
+        url = f"http://127.0.0.1:{server.server_address[1]}/metrics"
+        deadline = time.time() + 5
+        while True:
+            text = urllib.request.urlopen(url, timeout=5).read().decode()
+            if 'process="detector"' in text or time.time() > deadline:
+                break
+            time.sleep(0.05)
+        self.assertIn('printer_monitor_test_parent_total{process="monitor"} 1\n', text)
+        self.assertIn('printer_monitor_test_child_total{process="detector"} 3\n', text)
+        self.assertNotIn('printer_monitor_test_child_total{process="monitor"}', text)
+        # The forked child starts from zero, instead of exporting the values it inherited as its own.
+        self.assertNotIn('printer_monitor_test_parent_total{process="detector"}', text)
+
+    def test_sample_stacks(self):
+        """Test that the profiler reports the stacks of the other threads with the thread name as the root."""
+        stop_event = threading.Event()
+
+        def busy_stage():
+            while not stop_event.is_set():
+                sum(range(1000))
+
+        thread = threading.Thread(target=busy_stage, name='stream_test')
+        thread.start()
+        try:
+            folded_stacks = metrics.sample_stacks(0.2, interval=0.01)
+        finally:
+            stop_event.set()
+            thread.join()
+
+        stage_stacks = [line for line in folded_stacks.splitlines() if line.startswith('stream_test;')]
+        self.assertTrue(stage_stacks)
+        self.assertIn('busy_stage (test_metrics.py:', stage_stacks[0])
+        self.assertGreater(sum(int(line.rsplit(' ', 1)[1]) for line in stage_stacks), 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
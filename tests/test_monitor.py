@@ -1,13 +1,33 @@
+import json
+import queue
+import subprocess
+import sys
 import unittest
-from unittest.mock import patch, MagicMock
+from unittest.mock import ANY, patch, MagicMock
 import yaml
 import os
 import requests
 
 from src.monitor import main
-from src.config import get_config
+from src.config import CONFIG_CHANGED, get_config, get_printers
 from src.printer import get_printer_status
-from src.notifier import send_notification
+from src.notifier import send_notification, flush_notifications
+
+# Imports the monitor in a fresh interpreter and prints the import time, the resident memory and the heavy modules
+# it pulled in.
+IDLE_MONITOR_SCRIPT = '''
+import json, os, sys, time
+start_time = time.perf_counter()
+import src.monitor
+import_seconds = time.perf_counter() - start_time
+with open(f"/proc/{os.getpid()}/statm") as f:
+    rss_mb = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+print(json.dumps({'import_seconds': import_seconds, 'rss_mb': rss_mb,
+                  'heavy_modules': sorted({'cv2', 'numpy', 'openvino'} & set(sys.modules))}))
+'''
+# Resident memory budget of the idle monitor, in MB. It is about 30 MB, and about 75 MB with the inference
+# dependencies loaded.
+IDLE_MONITOR_RSS_MB = 50
 
 class TestMonitor(unittest.TestCase):
 
@@ -39,7 +59,7 @@ class TestMonitor(unittest.TestCase):
         config = get_config()
         self.assertEqual(config, self.config)
 
-    @patch('requests.get')
+    @patch('requests.Session.get')
     def test_get_printer_status_printing(self, mock_get):
         """Test getting printer status when printing."""
         mock_response = MagicMock()
@@ -56,33 +76,144 @@ class TestMonitor(unittest.TestCase):
         status = get_printer_status(self.config)
         self.assertEqual(status, 'printing')
 
-    @patch('requests.post')
+    @patch('requests.Session.post')
     def test_send_notification(self, mock_post):
         """Test sending a notification."""
         send_notification("Test message")
+        self.assertTrue(flush_notifications(timeout=5))
         mock_post.assert_called_once()
         args, kwargs = mock_post.call_args
         self.assertIn('json', kwargs)
         self.assertEqual(kwargs['json']['event'], 'printer_event')
         self.assertEqual(kwargs['json']['message']['text'], 'Test message')
 
-    @patch('src.monitor.get_printer_status')
+    @patch('src.monitor.PrinterWatcher')
     @patch('src.monitor.send_notification') # Patch the function in the module where it's used
-    @patch('src.config.get_config') # Patch the function in its new module
-    @patch('time.sleep') # Patch time.sleep
-    def test_main_loop_state_change(self, mock_sleep, mock_get_config, mock_send_notification, mock_get_printer_status):
+    @patch('src.monitor.update_issue_detector')
+    @patch('src.monitor.queue.Queue')
+    def test_main_loop_state_change(self, mock_queue, mock_update, mock_send_notification, mock_watcher):
         """Test the main loop detects a state change and sends a notification."""
-        mock_get_config.return_value = self.config
-        # Simulate the state change from printing to complete
-        mock_get_printer_status.side_effect = ['printing', 'complete']
-        mock_sleep.side_effect = SystemExit # Exit after first sleep
+        # Simulate the state change from printing to complete, then exit
+        mock_queue.return_value.get.side_effect = [(None, 'printing'), (None, 'complete'), SystemExit]
 
         try:
             main()
         except SystemExit:
             pass # Expected exit
 
+        mock_watcher.return_value.start.assert_called_once()
+        mock_watcher.return_value.stop.assert_called_once()
+        mock_update.assert_called_with(ANY, frozenset(), False)
+
         mock_send_notification.assert_called_once_with("Printer state changed from 'printing' to 'complete'.")
 
+    @patch('src.monitor.PrinterWatcher')
+    @patch('src.monitor.send_notification')
+    @patch('src.monitor.update_issue_detector')
+    @patch('src.monitor.queue.Queue')
+    def test_main_loop_reports_progress(self, mock_queue, mock_update, mock_send_notification, mock_watcher):
+        """Test that print_progress subscribes to the progress and a print that did not complete reports it."""
+        mock_queue.return_value.get.side_effect = [(None, 'printing'), (None, 'cancelled'), SystemExit]
+        mock_watcher.return_value.progress = 0.42
+
+        with patch('src.monitor.get_config', return_value=dict(self.config, print_progress=True)):
+            try:
+                main()
+            except SystemExit:
+                pass
+
+        self.assertTrue(mock_watcher.call_args.args[4])
+        mock_send_notification.assert_called_once_with(
+            "Printer state changed from 'printing' to 'cancelled'. The print was 42% done.")
+
+    def test_get_printers_fleet(self):
+        """Test that fleet printers inherit the detection settings from the issue_detector section."""
+        config = {
+            'issue_detector': {
+                'confidence_thresholds': {'spaghetti': 0.6},
+                'detection_area_of_interest': [0, 0, 100, 100]
+            },
+            'printers': [
+                {'name': 'left', 'ip': '10.0.0.1', 'port': 7125, 'stream_url': 'http://left'},
+                {'name': 'right', 'ip': '10.0.0.2', 'port': 7125, 'stream_url': 'http://right',
+                 'confidence_thresholds': {'spaghetti': 0.8}}
+            ]
+        }
+        left, right = get_printers(config)
+        self.assertEqual(left['confidence_thresholds'], {'spaghetti': 0.6})
+        self.assertEqual(right['confidence_thresholds'], {'spaghetti': 0.8})
+        self.assertEqual(right['detection_area_of_interest'], [0, 0, 100, 100])
+        self.assertEqual(get_printers(self.config)[0]['name'], None)
+
+    @patch('src.monitor.start_issue_detector_process')
+    @patch('src.monitor.PrinterWatcher')
+    @patch('src.monitor.send_notification')
+    @patch('src.monitor.queue.Queue')
+    def test_main_loop_fleet(self, mock_queue, mock_send_notification, mock_watcher, mock_start):
+        """Test that a single detector process is told which printers are printing."""
+        config = dict(self.config)
+        del config['printer']
+        config['printers'] = [
+            {'name': 'left', 'ip': '10.0.0.1', 'port': 7125},
+            {'name': 'right', 'ip': '10.0.0.2', 'port': 7125}
+        ]
+        # Timeouts without any state change only check on the detector process.
+        mock_queue.return_value.get.side_effect = [('left', 'printing'), ('right', 'standby'), queue.Empty,
+                                                   ('right', 'printing'), ('left', 'complete'), SystemExit]
+        mock_process = MagicMock()
+        mock_control_queue = MagicMock()
+        mock_start.return_value = (mock_process, MagicMock(), mock_control_queue)
+
+        with patch('src.monitor.get_config', return_value=config):
+            try:
+                main()
+            except SystemExit:
+                pass
+
+        mock_start.assert_called_once()
+        self.assertEqual(mock_control_queue.put.call_count, 3)
+        mock_control_queue.put.assert_any_call(('active', frozenset({'left', 'right'})))
+        mock_control_queue.put.assert_called_with(('active', frozenset({'right'})))
+        mock_send_notification.assert_called_once_with("[left] Printer state changed from 'printing' to 'complete'.")
+
+
+    @patch('src.monitor.start_issue_detector_process')
+    @patch('src.monitor.PrinterWatcher')
+    @patch('src.monitor.ConfigWatcher')
+    @patch('src.monitor.queue.Queue')
+    def test_main_loop_config_change(self, mock_queue, mock_config_watcher, mock_watcher, mock_start):
+        """Test that a reloaded configuration is sent to the detector process and used when it is started again."""
+        config = dict(self.config, issue_detector={'confidence_thresholds': {'spaghetti': 0.6}})
+        new_config = dict(self.config, issue_detector={'confidence_thresholds': {'spaghetti': 0.5}})
+        mock_queue.return_value.get.side_effect = [(None, 'printing'), (CONFIG_CHANGED, new_config),
+                                                   (None, 'complete'), (None, 'printing'), SystemExit]
+        mock_control_queue = MagicMock()
+        mock_start.return_value = (MagicMock(), MagicMock(), mock_control_queue)
+
+        with patch('src.monitor.get_config', return_value=config), patch('src.monitor.send_notification'):
+            try:
+                main()
+            except SystemExit:
+                pass
+
+        mock_config_watcher.assert_called_once_with(mock_queue.return_value, 2)
+        mock_config_watcher.return_value.stop.assert_called_once()
+        mock_control_queue.put.assert_any_call(('config', new_config))
+        self.assertEqual(mock_start.call_count, 2)
+        (printers,), _ = mock_start.call_args
+        self.assertEqual(printers[0]['confidence_thresholds'], {'spaghetti': 0.5})
+
+class TestMonitorStartup(unittest.TestCase):
+
+    def test_idle_monitor_is_lightweight(self):
+        """Test that the monitor imports without a config and without the inference dependencies."""
+        output = subprocess.run([sys.executable, '-c', IDLE_MONITOR_SCRIPT], capture_output=True, text=True,
+                                check=True, cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        result = json.loads(output.stdout.strip().splitlines()[-1])
+        summary = f"import {result['import_seconds'] * 1000:.0f} ms, RSS {result['rss_mb']:.1f} MB"
+        self.assertEqual(result['heavy_modules'], [], summary)
+        self.assertLess(result['rss_mb'], IDLE_MONITOR_RSS_MB, summary)
+
+
 if __name__ == '__main__':
     unittest.main()
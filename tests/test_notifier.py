@@ -0,0 +1,168 @@
+import json
+import pathlib
+import tempfile
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+from src.notifier import NotificationDispatcher
+
+
+class _StubNotificationServer(ThreadingHTTPServer):
+    """A local notification service that records the requests and answers with the queued status codes."""
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), _StubHandler)
+        self.requests = []
+        self.statuses = []
+        self.delay = 0
+        self.url = f"http://127.0.0.1:{self.server_address[1]}"
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+
+    def _handle(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        time.sleep(self.server.delay)
+        self.server.requests.append((self.command, self.path, body))
+        self.send_response(self.server.statuses.pop(0) if self.server.statuses else 200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    do_PUT = _handle
+    do_POST = _handle
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestNotifier(unittest.TestCase):
+
+    def setUp(self):
+        self.server = _StubNotificationServer()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def _dispatcher(self, **kwargs):
+        dispatcher = NotificationDispatcher(self.server.url, 'token', backoff=0.01, **kwargs)
+        self.addCleanup(dispatcher.close, 5)
+        return dispatcher
+
+    def test_image_uploaded_then_pushed(self):
+        """Test that the image is uploaded and referenced by the push."""
+        dispatcher = self._dispatcher()
+        dispatcher.submit("Detected issues", image=b'jpeg bytes')
+        self.assertTrue(dispatcher.flush(5))
+
+        (put_method, put_path, put_body), (post_method, post_path, post_body) = self.server.requests
+        self.assertEqual((put_method, put_path), ('PUT', '/image?auth_token=token'))
+        self.assertIn(b'jpeg bytes', put_body)
+        self.assertEqual((post_method, post_path), ('POST', '/push?auth_token=token'))
+        payload = json.loads(post_body)
+        self.assertEqual(payload['event'], 'printer_event')
+        self.assertEqual(payload['message']['text'], "Detected issues")
+        self.assertIn(payload['message']['image'].encode(), put_body)
+        self.assertEqual(dispatcher.stats()['sent'], 1)
+
+    def test_submit_does_not_wait_for_server(self):
+        """Test that a slow server does not block the caller."""
+        self.server.delay = 0.5
+        dispatcher = self._dispatcher()
+        start_time = time.perf_counter()
+        dispatcher.submit("Printer state changed")
+        self.assertLess(time.perf_counter() - start_time, 0.1)
+        self.assertEqual(dispatcher.stats()['outbox_depth'] + dispatcher._delivering, 1)
+        self.assertTrue(dispatcher.flush(5))
+        self.assertGreaterEqual(dispatcher.stats()['delivery_latency_p99'], 0.5)
+
+    def test_transient_failures_retried(self):
+        """Test that 5xx responses are retried without uploading the image again, and 4xx ones are not retried."""
+        self.server.statuses = [200, 503, 502]
+        dispatcher = self._dispatcher(retries=3)
+        dispatcher.submit("Detected issues", image=b'jpeg bytes')
+        self.assertTrue(dispatcher.flush(5))
+        self.assertEqual([method for method, _, _ in self.server.requests], ['PUT', 'POST', 'POST', 'POST'])
+
+        self.server.statuses = [401]
+        dispatcher.submit("Printer state changed")
+        self.assertTrue(dispatcher.flush(5))
+        self.assertEqual(len(self.server.requests), 5)
+        stats = dispatcher.stats()
+        self.assertEqual((stats['sent'], stats['failed'], stats['retries']), (1, 1, 2))
+
+    def test_unreachable_server_times_out(self):
+        """Test that delivery gives up after the retries when the server does not answer in time."""
+        self.server.delay = 1
+        dispatcher = self._dispatcher(timeout=0.1, retries=1)
+        dispatcher.submit("Printer state changed")
+        self.assertTrue(dispatcher.flush(5))
+        self.assertEqual(dispatcher.stats()['failed'], 1)
+
+    def test_full_outbox_drops_oldest(self):
+        """Test that the oldest queued notification is dropped when the outbox is full."""
+        self.server.delay = 0.3
+        dispatcher = self._dispatcher(outbox_size=2)
+        for i in range(4):
+            dispatcher.submit(f"message {i}")
+            time.sleep(0.05)
+        self.assertTrue(dispatcher.flush(5))
+        texts = [json.loads(body)['message']['text'] for _, _, body in self.server.requests]
+        self.assertEqual(texts, ["message 0", "message 2", "message 3"])
+        self.assertEqual(dispatcher.stats()['dropped'], 1)
+
+    def test_full_outbox_spills_to_disk(self):
+        """Test that notifications spilled when the outbox is full are delivered once it drains, with their image."""
+        self.server.delay = 0.3
+        with tempfile.TemporaryDirectory() as spill_dir:
+            dispatcher = self._dispatcher(outbox_size=1, spill_dir=spill_dir)
+            for i in range(4):
+                dispatcher.submit(f"message {i}", image=b'jpeg bytes' if i == 3 else None)
+                time.sleep(0.05)
+            self.assertGreaterEqual(dispatcher.stats()['spilled'], 1)
+
+            deadline = time.time() + 10
+            while len(self.server.requests) < 5 and time.time() < deadline:
+                time.sleep(0.05)
+            pushes = [json.loads(body)['message']['text'] for method, _, body in self.server.requests
+                      if method == 'POST']
+            self.assertEqual(sorted(pushes), [f"message {i}" for i in range(4)])
+            self.assertEqual(dispatcher.stats()['dropped'], 0)
+
+    def test_spill_io_does_not_hold_the_outbox(self):
+        """Test that writing and reading back spill files happens without holding the outbox lock."""
+        self.server.delay = 0.3
+        with tempfile.TemporaryDirectory() as spill_dir:
+            dispatcher = self._dispatcher(outbox_size=1, spill_dir=spill_dir)
+            held = []
+            write_text, read_text = pathlib.Path.write_text, pathlib.Path.read_text
+
+            def checked(method):
+                def call(path, *args, **kwargs):
+                    held.append(dispatcher._condition._is_owned())
+                    return method(path, *args, **kwargs)
+                return call
+
+            with mock.patch.object(pathlib.Path, 'write_text', checked(write_text)), \
+                    mock.patch.object(pathlib.Path, 'read_text', checked(read_text)):
+                for i in range(4):
+                    dispatcher.submit(f"message {i}")
+                    time.sleep(0.05)
+                deadline = time.time() + 10
+                while len(self.server.requests) < 4 and time.time() < deadline:
+                    time.sleep(0.05)
+            self.assertEqual(len(self.server.requests), 4)
+            self.assertGreaterEqual(len(held), 2)
+            self.assertFalse(any(held))
+
+
+if __name__ == '__main__':
+    unittest.main()
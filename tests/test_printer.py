@@ -0,0 +1,217 @@
+import base64
+import hashlib
+import json
+import queue
+import struct
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from src.printer import PrinterWatcher
+
+WEBSOCKET_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+
+class _FakeMoonraker(ThreadingHTTPServer):
+    """
+    A local Moonraker with the `/printer/objects/query` endpoint and, unless websocket is False, the JSON-RPC websocket
+    with `printer.objects.subscribe`. Status changes are pushed to the subscribed websocket clients.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, websocket=True, port=0, state='standby'):
+        super().__init__(('127.0.0.1', port), _FakeMoonrakerHandler)
+        self.websocket = websocket
+        self.status = {'print_stats': {'state': state}, 'display_status': {'progress': 0.0}}
+        self.http_queries = 0
+        self.messages = []
+        self._clients = []
+        self._lock = threading.Lock()
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def printer(self):
+        return {'name': 'fake', 'ip': '127.0.0.1', 'port': self.server_address[1]}
+
+    def update(self, name, **fields):
+        with self._lock:
+            self.status[name].update(fields)
+        self.notify({'jsonrpc': '2.0', 'method': 'notify_status_update', 'params': [{name: fields}, time.time()]})
+
+    def notify(self, message):
+        with self._lock:
+            for handler in self._clients:
+                handler.send_message(message)
+
+    def stop(self):
+        with self._lock:
+            for handler in self._clients:
+                handler.send_frame(0x8, b'')
+        self.shutdown()
+        self.server_close()
+
+
+class _FakeMoonrakerHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path == '/printer/objects/query?print_stats':
+            self.server.http_queries += 1
+            body = json.dumps({'result': {'status': {'print_stats': self.server.status['print_stats']}}}).encode()
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        elif self.path == '/websocket' and self.server.websocket:
+            self._serve_websocket()
+        else:
+            self.send_error(404)
+
+    def send_frame(self, opcode, payload):
+        header = bytes([0x80 | opcode])
+        if len(payload) < 126:
+            header += bytes([len(payload)])
+        elif len(payload) < 65536:
+            header += bytes([126]) + struct.pack('>H', len(payload))
+        else:
+            header += bytes([127]) + struct.pack('>Q', len(payload))
+        self.wfile.write(header + payload)
+        self.wfile.flush()
+
+    def send_message(self, message):
+        self.send_frame(0x1, json.dumps(message).encode())
+
+    def _read_frame(self):
+        first, second = self.rfile.read(2)
+        length = second & 0x7f
+        if length == 126:
+            length, = struct.unpack('>H', self.rfile.read(2))
+        elif length == 127:
+            length, = struct.unpack('>Q', self.rfile.read(8))
+        mask = self.rfile.read(4)
+        payload = bytes(byte ^ mask[i % 4] for i, byte in enumerate(self.rfile.read(length)))
+        return first & 0x0f, payload
+
+    def _serve_websocket(self):
+        accept = base64.b64encode(hashlib.sha1((self.headers['Sec-WebSocket-Key'] + WEBSOCKET_GUID).encode()).digest())
+        self.send_response(101)
+        self.send_header('Upgrade', 'websocket')
+        self.send_header('Connection', 'Upgrade')
+        self.send_header('Sec-WebSocket-Accept', accept.decode())
+        self.end_headers()
+        self.wfile.flush()
+
+        try:
+            while True:
+                opcode, payload = self._read_frame()
+                if opcode == 0x8:
+                    return
+                if opcode == 0x9:
+                    self.send_frame(0xA, payload)
+                    continue
+
+                message = json.loads(payload)
+                self.server.messages.append(message)
+                if message['method'] == 'printer.objects.subscribe':
+                    with self.server._lock:
+                        status = {name: dict(self.server.status.get(name, {}))
+                                  for name in message['params']['objects']}
+                        self.send_message({'jsonrpc': '2.0', 'result': {'eventtime': time.time(), 'status': status},
+                                           'id': message['id']})
+                        self.server._clients.append(self)
+        except (ValueError, OSError):
+            pass
+        finally:
+            with self.server._lock:
+                if self in self.server._clients:
+                    self.server._clients.remove(self)
+        self.close_connection = True
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestPrinterWatcher(unittest.TestCase):
+
+    def _watch(self, moonraker, **kwargs):
+        events = queue.Queue()
+        watcher = PrinterWatcher(moonraker.printer, events, **kwargs)
+        watcher.start()
+        self.addCleanup(watcher.stop)
+        return watcher, events
+
+    def test_state_changes_pushed_over_websocket(self):
+        """Test that state changes arrive as events right away, without any HTTP polling."""
+        moonraker = _FakeMoonraker()
+        self.addCleanup(moonraker.stop)
+        watcher, events = self._watch(moonraker, polling_interval=30, progress=True)
+        self.assertEqual(events.get(timeout=5), ('fake', 'standby'))
+
+        start_time = time.time()
+        moonraker.update('print_stats', state='printing')
+        self.assertEqual(events.get(timeout=5), ('fake', 'printing'))
+        self.assertLess(time.time() - start_time, 1)
+
+        # Progress updates do not change the state.
+        moonraker.update('display_status', progress=0.5)
+        moonraker.update('print_stats', state='complete')
+        self.assertEqual(events.get(timeout=5), ('fake', 'complete'))
+        self.assertEqual(watcher.progress, 0.5)
+        self.assertTrue(events.empty())
+
+        self.assertEqual(moonraker.http_queries, 0)
+        subscribe, = moonraker.messages
+        self.assertEqual(subscribe['params']['objects'], {'print_stats': ['state'], 'display_status': ['progress'],
+                                                          'virtual_sdcard': ['progress']})
+
+    def test_falls_back_to_http_polling(self):
+        """Test that the state is polled over HTTP when the websocket is unavailable."""
+        moonraker = _FakeMoonraker(websocket=False)
+        self.addCleanup(moonraker.stop)
+        watcher, events = self._watch(moonraker, polling_interval=0.1)
+        self.assertEqual(events.get(timeout=5), ('fake', 'standby'))
+
+        moonraker.update('print_stats', state='printing')
+        self.assertEqual(events.get(timeout=5), ('fake', 'printing'))
+        self.assertGreaterEqual(moonraker.http_queries, 2)
+        self.assertIsNone(watcher.progress)
+
+    def test_reconnects_after_connection_loss(self):
+        """Test that a lost websocket reports the printer as offline and the watcher resubscribes once it is back."""
+        moonraker = _FakeMoonraker()
+        port = moonraker.server_address[1]
+        watcher, events = self._watch(moonraker, polling_interval=0.1)
+        self.assertEqual(events.get(timeout=5), ('fake', 'standby'))
+
+        moonraker.stop()
+        self.assertEqual(events.get(timeout=5), ('fake', 'error'))
+
+        # Restart the printer on the same port, already printing.
+        moonraker = _FakeMoonraker(port=port, state='printing')
+        self.addCleanup(moonraker.stop)
+
+        self.assertEqual(events.get(timeout=5), ('fake', 'printing'))
+
+    def test_unexpected_message_falls_back_to_polling(self):
+        """Test that a message of an unexpected shape is handled as a lost websocket instead of ending the watcher."""
+        moonraker = _FakeMoonraker()
+        self.addCleanup(moonraker.stop)
+        watcher, events = self._watch(moonraker, polling_interval=0.1)
+        self.assertEqual(events.get(timeout=5), ('fake', 'standby'))
+
+        moonraker.notify({'jsonrpc': '2.0', 'method': 'notify_status_update', 'params': {'print_stats': {}}})
+        deadline = time.time() + 5
+        while moonraker.http_queries == 0 and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertGreaterEqual(moonraker.http_queries, 1)
+        self.assertTrue(watcher._thread.is_alive())
+
+        # Polled, and followed over the websocket again once resubscribed.
+        moonraker.update('print_stats', state='printing')
+        self.assertEqual(events.get(timeout=5), ('fake', 'printing'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+import unittest
+
+import numpy as np
+
+from src.rate_controller import AdaptiveRateController, FixedRateController, create_rate_controller
+
+THRESHOLDS = {'error': 0.75, 'spaghetti': 0.60}
+
+
+def _frame(value):
+    return np.full((72, 128, 3), value, dtype=np.uint8)
+
+
+class TestRateController(unittest.TestCase):
+
+    def test_unchanged_frames_are_skipped_until_overdue(self):
+        """Test that a static scene is only inferred once per max_interval."""
+        controller = AdaptiveRateController(base_interval=1, max_interval=10)
+        inferred = [controller.should_infer(_frame(100), t) for t in range(21)]
+        self.assertEqual([t for t, infer in enumerate(inferred) if infer], [0, 10, 20])
+        self.assertEqual(controller.stats(), {'inferences': 3, 'skipped': 18, 'boosts': 0})
+
+    def test_changed_frame_is_inferred(self):
+        """Test that a scene change triggers inference right away."""
+        controller = AdaptiveRateController(change_threshold=2.0)
+        self.assertTrue(controller.should_infer(_frame(100), 0))
+        self.assertFalse(controller.should_infer(_frame(101), 1))
+        self.assertTrue(controller.should_infer(_frame(120), 2))
+        # The reference is the last inferred frame, not the last checked one.
+        self.assertFalse(controller.should_infer(_frame(121), 3))
+
+    def test_sub_threshold_hit_boosts_rate(self):
+        """Test that a sub-threshold hit shortens the interval and infers every frame for boost_duration seconds."""
+        controller = AdaptiveRateController(base_interval=1, min_interval=0.25, boost_duration=5, hint_ratio=0.5)
+        controller.should_infer(_frame(100), 0)
+        controller.update({'spaghetti': 0.2, 'error': 0.1}, THRESHOLDS, 0)
+        self.assertEqual(controller.interval(1), 1)
+
+        controller.update({'spaghetti': 0.35}, THRESHOLDS, 1)
+        self.assertEqual(controller.interval(1), 0.25)
+        self.assertTrue(controller.should_infer(_frame(100), 1.25))
+        controller.update({'spaghetti': 0.35}, THRESHOLDS, 1.25)
+        self.assertEqual(controller.stats()['boosts'], 1)
+
+        self.assertEqual(controller.interval(6.3), 1)
+        self.assertFalse(controller.should_infer(_frame(100), 6.3))
+
+    def test_create_rate_controller(self):
+        """Test that the adaptive controller is opt-in and takes its settings from the config."""
+        self.assertIsInstance(create_rate_controller({}), FixedRateController)
+        self.assertIsInstance(create_rate_controller({'adaptive_rate': True}), AdaptiveRateController)
+        controller = create_rate_controller({'adaptive_rate': {'max_interval': 5}})
+        self.assertEqual(controller.interval(0), 1)
+        self.assertTrue(controller.should_infer(_frame(100), 0))
+        self.assertFalse(controller.should_infer(_frame(100), 4))
+        self.assertTrue(controller.should_infer(_frame(100), 5))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+import unittest
+
+from src.region_planner import RegionPlanner, create_region_planner
+
+AREA_OF_INTEREST = [100, 120, 590, 320]
+
+
+class TestRegionPlanner(unittest.TestCase):
+
+    def test_full_frame_without_crop(self):
+        """Test that the whole frame is inferred unless cropping is enabled and there is an area of interest."""
+        self.assertEqual(create_region_planner({}).regions(1280, 720, AREA_OF_INTEREST, 640, 640),
+                         [(0, 0, 1280, 720)])
+        self.assertEqual(RegionPlanner(crop=True).regions(1280, 720, None, 640, 640), [(0, 0, 1280, 720)])
+
+    def test_crop_covers_area_of_interest_with_margin(self):
+        """Test that the crop covers the area of interest and margin, grown to the model aspect ratio in the frame."""
+        planner = create_region_planner({'crop_to_area_of_interest': {'margin': 32}})
+        (x_min, y_min, x_max, y_max), = planner.regions(1280, 720, AREA_OF_INTEREST, 640, 640)
+        self.assertLessEqual((x_min, y_min), (100 - 32, 120 - 32))
+        self.assertGreaterEqual((x_max, y_max), (590 + 32, 320 + 32))
+        self.assertEqual(x_max - x_min, y_max - y_min)
+        self.assertGreaterEqual(y_min, 0)
+
+        # The aspect ratio gives way to the frame bounds.
+        (x_min, y_min, x_max, y_max), = planner.regions(1280, 300, [0, 0, 1280, 100], 640, 640)
+        self.assertEqual((x_min, x_max), (0, 1280))
+        self.assertEqual((y_min, y_max), (0, 300))
+
+    def test_tiles_cover_large_area_of_interest(self):
+        """Test that a large area of interest is split into at most max_tiles overlapping tiles covering all of it."""
+        planner = RegionPlanner(crop=True, margin=0, tiling=True, max_tiles=4)
+        tiles = planner.regions(1920, 1080, [100, 100, 1800, 1000], 640, 640)
+        self.assertLessEqual(len(tiles), 4)
+        self.assertGreater(len(tiles), 1)
+        for x in range(100, 1800, 10):
+            for y in range(100, 1000, 10):
+                self.assertTrue(any(x_min <= x < x_max and y_min <= y < y_max for x_min, y_min, x_max, y_max in tiles))
+        for x_min, y_min, x_max, y_max in tiles:
+            self.assertEqual(x_max - x_min, y_max - y_min)
+            self.assertTrue(0 <= x_min < x_max <= 1920 and 0 <= y_min < y_max <= 1080)
+
+        # An area of interest smaller than the model input is not tiled.
+        self.assertEqual(len(planner.regions(1920, 1080, AREA_OF_INTEREST, 640, 640)), 1)
+
+    def test_fractional_area_of_interest(self):
+        """Test that a fractional area of interest gives integer regions covering it, within the frame."""
+        planner = RegionPlanner(crop=True, margin=0, tiling=True, max_tiles=4)
+        for area_of_interest in ([25.5, 30.25, 147.5, 80.75], [-10.5, 100.5, 2000.25, 1079.5]):
+            for region in planner.regions(1920, 1080, area_of_interest, 640, 640):
+                self.assertTrue(all(isinstance(value, int) for value in region), region)
+                x_min, y_min, x_max, y_max = region
+                self.assertTrue(0 <= x_min < x_max <= 1920 and 0 <= y_min < y_max <= 1080, region)
+        (x_min, y_min, x_max, y_max), = RegionPlanner(crop=True, margin=0).regions(1920, 1080,
+                                                                                   [25.5, 30.25, 147.5, 80.75], 64, 64)
+        self.assertLessEqual((x_min, y_min), (25, 30))
+        self.assertGreaterEqual((x_max, y_max), (148, 81))
+
+    def test_invalid_tiling(self):
+        """Test that tiling settings that cannot cover the crop are rejected."""
+        with self.assertRaises(ValueError):
+            RegionPlanner(crop=True, tiling=True, max_tiles=0)
+        with self.assertRaises(ValueError):
+            RegionPlanner(crop=True, tiling=True, tile_overlap=1)
+
+
+if __name__ == '__main__':
+    unittest.main()